@@ -4,16 +4,26 @@ The main object is Computation, which takes a runner and subject and
 runs them against each other
 """
 import os
+import sys
 import time
+import errno
+import signal
+import select
 import subprocess
-import threading
 import shutil
 import json
+import uuid
+import gzip
+import Queue
+import multiprocessing
+from collections import deque
 from contextlib import contextmanager
 
 import kimunits
 import kimquery
 import kimobjects
+import properties
+import sandbox
 
 import config as cf
 from logger import logging
@@ -23,54 +33,357 @@ logger = logging.getLogger("pipeline").getChild("compute")
 # a class to be able to timeout on a command
 #================================================================
 class Command(object):
-    def __init__(self, cmd, stdin=None, stdout=None, stderr=None):
+    def __init__(self, cmd, stdin=None, stdout=None, stderr=None, cgroup=None):
         """
         A class to provide time limits to sub processes. Accepts
         a command as an array (similar to check_output) and file
-        handles with which to communicate on stdin, stdout, stderr
+        handles with which to communicate on stdin, stdout, stderr,
+        and optionally a ``CGroup`` to run it in.  stdout and stderr
+        may also be ``OutputCapture`` objects, which are fed through
+        pipes while waiting
+
+        The command is started in its own process group so that on a
+        timeout it and everything it forked can be signalled at once, and
+        it is waited on with ``os.wait4`` from the calling thread, which
+        also gives us its resource usage in ``rusage``.  While waiting, the
+        combined memory of its process tree is sampled from /proc at most
+        every ``RUNNER_SAMPLE_INTERVAL`` seconds, the largest seen being
+        kept in ``mempeak`` (KB)
         """
         self.cmd = cmd
         self.process = None
         self.stdin = stdin
         self.stdout = stdout
         self.stderr = stderr
+        self.cgroup = cgroup
+        self.returncode = None
+        self.rusage = None
+        self.mempeak = 0
+        self.sampled = 0
+        self.captures = {}
+
+    def start(self):
+        def setup():
+            os.setpgrp()
+            if self.cgroup:
+                self.cgroup.join()
+
+        pipe = lambda f: subprocess.PIPE if isinstance(f, OutputCapture) else f
+        self.process = subprocess.Popen(self.cmd, stdin=self.stdin,
+                stdout=pipe(self.stdout), stderr=pipe(self.stderr), shell=True,
+                preexec_fn=setup)
+
+        for capture, f in ((self.stdout, self.process.stdout), (self.stderr, self.process.stderr)):
+            if isinstance(capture, OutputCapture):
+                self.captures[f.fileno()] = (f, capture)
+
+    def pump(self, timeout):
+        """ Wait up to timeout seconds for output, handing any to the captures """
+        if not self.captures:
+            time.sleep(timeout)
+            return
+
+        try:
+            ready = select.select(list(self.captures), [], [], timeout)[0]
+        except select.error as e:
+            if e.args[0] == errno.EINTR:
+                return
+            raise
+        for fd in ready:
+            data = os.read(fd, cf.PIPELINE_MSGSIZE)
+            if data:
+                self.captures[fd][1].write(data)
+            else:
+                f, capture = self.captures.pop(fd)
+                f.close()
+
+    def drain(self, timeout):
+        """ Collect the output that is left once the command has exited """
+        deadline = time.time() + timeout
+        while self.captures and time.time() < deadline:
+            self.pump(deadline - time.time())
+        for f, capture in self.captures.values():
+            f.close()
+        self.captures = {}
+
+    def wait(self, timeout=None):
+        """
+        Wait for the command to exit for at most timeout seconds (forever
+        if None), returning whether it did.  The exit is polled for with a
+        growing interval so that short runs are noticed quickly.
+        """
+        if self.returncode is not None:
+            return True
+
+        deadline = time.time() + timeout if timeout is not None else None
+        delay = 1e-3
+        while True:
+            try:
+                pid, status, rusage = os.wait4(self.process.pid, os.WNOHANG)
+            except OSError as e:
+                if e.errno == errno.EINTR:
+                    continue
+                raise
+            if pid:
+                if os.WIFSIGNALED(status):
+                    self.returncode = -os.WTERMSIG(status)
+                else:
+                    self.returncode = os.WEXITSTATUS(status)
+                self.process.returncode = self.returncode
+                self.rusage = rusage
+                return True
+
+            if time.time() - self.sampled >= cf.RUNNER_SAMPLE_INTERVAL:
+                self.sample()
+            if deadline is not None:
+                left = deadline - time.time()
+                if left <= 0:
+                    return False
+                self.pump(min(delay, left))
+            else:
+                self.pump(delay)
+            delay = min(2*delay, cf.RUNNER_POLL_INTERVAL)
 
     def run(self, timeout):
         """
-        Run the command, cutting it off abruptly at timeout,
-        where timeout is given in seconds.
+        Run the command, cutting it off at timeout, where timeout is given
+        in seconds.  On the timeout its process group is sent SIGTERM and,
+        if it has not exited ``RUNNER_KILL_GRACE`` seconds later, SIGKILL.
+        Anything left in the group after the command exits is killed too.
         """
+        self.start()
+
+        if not self.wait(timeout):
+            logger.warning("Timed out, terminating process group %r", self.process.pid)
+            self.terminate()
+            if not self.wait(cf.RUNNER_KILL_GRACE):
+                logger.warning("Process group %r did not terminate, killing", self.process.pid)
+                self.kill()
+                self.wait()
+            self.kill()
+            self.drain(cf.RUNNER_KILL_GRACE)
+            raise cf.PipelineTimeout
+
+        self.kill()
+        self.drain(cf.RUNNER_KILL_GRACE)
+        return self.returncode
+
+    def sample(self):
+        """ Record the memory of the whole process tree """
+        self.sampled = time.time()
+        self.mempeak = max(self.mempeak, tree_rss(self.process.pid))
+
+    def signal(self, sig):
+        """ Send a signal to the whole process group of the command """
+        try:
+            os.killpg(self.process.pid, sig)
+        except OSError as e:
+            if e.errno != errno.ESRCH:
+                raise
 
-        def target():
-            self.process = subprocess.Popen(self.cmd, stdin=self.stdin,
-                    stdout=self.stdout, stderr=self.stderr, shell=True)
-            self.process.communicate()
+    def poll(self):
+        return self.returncode
 
-        thread = threading.Thread(target=target)
-        thread.start()
+    def terminate(self):
+        return self.signal(signal.SIGTERM)
 
-        thread.join(timeout)
-        if thread.is_alive():
-            self.process.terminate()
-            thread.join()
-            raise PipelineTimeout
+    def kill(self):
+        self.signal(signal.SIGKILL)
+        if self.cgroup:
+            self.cgroup.kill()
 
-        # be sure to grab the returncode (poll is to activate it)
-        self.process.poll()
-        return self.process.returncode
 
-    def poll(self):
-        return self.process.poll()
+#================================================================
+# capturing runner output
+#================================================================
+class OutputCapture(object):
+    LINE_MAX = 4096
 
-    def terminate(self):
-        return self.process.terminate()
+    def __init__(self, filename, limit=None, compress=None, lines=None):
+        """
+        The destination of one of the output streams of a runner.  What
+        is written goes to filename, gzipped (to filename.gz) if compress,
+        until limit bytes have been written, after which the rest is only
+        counted.  The last lines (each cut to ``LINE_MAX``) are also kept
+        in memory for error reports.  Defaults are ``RUNNER_OUTPUT_MAX``,
+        ``RUNNER_OUTPUT_COMPRESS`` and ``RUNNER_OUTPUT_TAIL``.
+        """
+        self.limit = limit if limit is not None else cf.RUNNER_OUTPUT_MAX
+        compress = compress if compress is not None else cf.RUNNER_OUTPUT_COMPRESS
+        self.nlines = lines or cf.RUNNER_OUTPUT_TAIL
+
+        if compress:
+            self.filename = filename+".gz"
+            self.file = gzip.open(self.filename, 'wb')
+        else:
+            self.filename = filename
+            self.file = open(self.filename, 'wb')
+
+        self.written = 0
+        self.dropped = 0
+        self.lines = deque(maxlen=self.nlines)
+        self.partial = ""
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def _remember(self, data):
+        parts = (self.partial + data).rsplit("\n", self.nlines + 1)
+        if len(parts) > self.nlines + 1:
+            parts = parts[1:]
+        for line in parts[:-1]:
+            self.lines.append(line[-self.LINE_MAX:] + "\n")
+        self.partial = parts[-1][-self.LINE_MAX:]
+
+    def write(self, data):
+        self._remember(data)
+        if self.limit is not None and self.written + len(data) > self.limit:
+            room = max(self.limit - self.written, 0)
+            self.dropped += len(data) - room
+            data = data[:room]
+        self.file.write(data)
+        self.written += len(data)
+
+    def tail(self):
+        """ The last lines written, as a string """
+        return "".join(self.lines) + self.partial
+
+    def close(self):
+        if self.file.closed:
+            return
+        if self.dropped:
+            logger.warning("Dropped %r bytes of output over the limit to %s", self.dropped, self.filename)
+            self.file.write("\n[output truncated after %i bytes, %i more dropped]\n" % (
+                self.written, self.dropped))
+        self.file.close()
+
+
+#================================================================
+# per job control groups
+#================================================================
+CGROUP_CONTROLLERS = ("memory", "cpu", "pids", "io")
+
+class CGroup(object):
+    def __init__(self, name, parent=None):
+        """
+        A cgroup v2 leaf that a single runner and everything it starts is
+        placed in, under the delegated ``RUNNER_CGROUP``, to bound its
+        memory, cpu and number of processes and to account for them.
+        """
+        self.parent = parent or cf.RUNNER_CGROUP
+        self.path = os.path.join(self.parent, name)
+
+    def _write(self, name, value, path=None):
+        with open(os.path.join(path or self.path, name), 'w') as f:
+            f.write(str(value))
+
+    def read(self, name):
+        """ The contents of one of the cgroup files, None if it has none """
+        try:
+            with open(os.path.join(self.path, name)) as f:
+                return f.read()
+        except (IOError, OSError):
+            return None
+
+    def stat(self, name):
+        """ A flat keyed file such as cpu.stat or memory.events as a dict """
+        out = {}
+        for line in (self.read(name) or "").splitlines():
+            key, value = line.split()
+            out[key] = int(value)
+        return out
+
+    def create(self, memory_max=None, cpu_max=None, pids_max=None):
+        """ Make the leaf and set those limits that are given, removing it
+            again if they can't be """
+        # one at a time, as a write fails whole if any controller is missing
+        for controller in CGROUP_CONTROLLERS:
+            try:
+                self._write("cgroup.subtree_control", "+"+controller, self.parent)
+            except (IOError, OSError) as e:
+                logger.debug("Could not enable %s in %s: %r", controller, self.parent, e)
+
+        os.mkdir(self.path)
+        try:
+            if memory_max is not None:
+                self._write("memory.max", memory_max)
+                try:
+                    self._write("memory.swap.max", 0)
+                except (IOError, OSError) as e:
+                    # only there with swap accounting
+                    logger.debug("Could not disallow swap in %s: %r", self.path, e)
+            if cpu_max is not None:
+                self._write("cpu.max", cpu_max)
+            if pids_max is not None:
+                self._write("pids.max", pids_max)
+        except:
+            self.remove()
+            raise
+
+    def join(self):
+        """ Move the calling process into the cgroup """
+        self._write("cgroup.procs", 0)
+
+    def kill(self):
+        """ Kill every process left in the cgroup """
+        try:
+            self._write("cgroup.kill", 1)
+            return
+        except (IOError, OSError):
+            pass
+        for pid in (self.read("cgroup.procs") or "").split():
+            try:
+                os.kill(int(pid), signal.SIGKILL)
+            except OSError:
+                pass
+
+    def remove(self, timeout=5):
+        """ Kill what is left and remove the leaf """
+        self.kill()
+        deadline = time.time() + timeout
+        while True:
+            try:
+                os.rmdir(self.path)
+                return
+            except OSError as e:
+                # busy until the killed processes are gone
+                if e.errno != errno.EBUSY or time.time() > deadline:
+                    logger.error("Could not remove cgroup %s: %r", self.path, e)
+                    return
+                time.sleep(0.01)
+
+    def info(self):
+        """ The profiling entries from the cgroup's accounting, memory in KB """
+        info = {}
+        peak = self.read("memory.peak")
+        if peak:
+            info["mempeak"] = int(peak) / 1024
+
+        cpu = self.stat("cpu.stat")
+        if cpu:
+            info["cpu-usage"] = cpu.get("usage_usec", 0) / 1e6
+            info["cpu-throttled"] = cpu.get("throttled_usec", 0) / 1e6
+
+        io = self.read("io.stat")
+        if io is not None:
+            info["io-read-bytes"] = info["io-write-bytes"] = 0
+            for line in io.splitlines():
+                fields = dict(field.split("=") for field in line.split()[1:])
+                info["io-read-bytes"] += int(fields.get("rbytes", 0))
+                info["io-write-bytes"] += int(fields.get("wbytes", 0))
+
+        info["oom-kills"] = self.stat("memory.events").get("oom_kill", 0)
+        return info
 
 
 #================================================================
 # the actual computation class
 #================================================================
 class Computation(object):
-    def __init__(self, runner=None, subject=None, result_code="", verify=True):
+    def __init__(self, runner=None, subject=None, result_code="", verify=True, runner_temp=None):
         """
         A pipeline computation object that utilizes all of the pipeline
         machinery to calculate a result (test or verification or otherwise).
@@ -82,11 +395,19 @@ class Computation(object):
                 to the appropriate location
             * verify : whether the result should be verified against
                 the property definitions held by official repo
+            * runner_temp : an existing running directory of the runner
+                (as a kim object) to use instead of making one, i.e.
+                one shared by the runs of a ``BatchComputation``
         """
         self.runner = runner
         self.subject = subject
-        self.runner_temp = runner
+        self.runner_temp = runner_temp or runner
+        self.shared_temp = runner_temp is not None
         self.runtime = None
+        self.rusage = None
+        self.mempeak = None
+        self.cgroup_info = None
+        self.output_tails = {}
         self.result_code = result_code
         self.info_dict = None
         self.verify = verify
@@ -95,10 +416,10 @@ class Computation(object):
         self.full_result_path = os.path.join(cf.KIM_REPOSITORY_DIR, self.result_path)
 
     def _create_tempdir(self):
-        """ Create a temporary running directory and copy over the test contents """
+        """ Create a temporary running directory and fill it with the test contents """
         tempname = self.runner.kim_code_name+"_running"+self.result_code+"__"+self.runner.kim_code_id
         self.runner_temp = kimobjects.kim_obj(self.runner.kim_code, search=False, subdir=tempname)
-        shutil.copytree(self.runner.path, self.runner_temp.path)
+        sandbox.create(self.runner.path, self.runner_temp.path)
 
     def _create_output_dir(self):
         """ Make sure that the ``output`` directory exists for results """
@@ -115,13 +436,30 @@ class Computation(object):
                 pass
 
     def _delete_tempdir(self):
-        shutil.rmtree(self.runner_temp.path)
+        sandbox.remove(self.runner_temp.path)
+
+    def _reset_tempdir(self):
+        """ Return a shared running directory to the state it was made in,
+            as far as the files that runs write to are concerned """
+        for name in (cf.OUTPUT_DIR, "kim.log"):
+            target = os.path.join(self.runner_temp.path, name)
+            if os.path.isdir(target):
+                shutil.rmtree(target)
+            elif os.path.exists(target):
+                os.remove(target)
+
+            source = os.path.join(self.runner.path, name)
+            if os.path.isdir(source):
+                shutil.copytree(source, target)
+            elif os.path.exists(source):
+                shutil.copy2(source, target)
 
     @contextmanager
     def tempdir(self):
         """
-        Create a temporary directory and copy all objects over so that
-        they can run independently of other processes on a single machine.
+        Create a temporary directory holding all objects so that they can
+        run independently of other processes on a single machine.  How it
+        is built is set by ``SANDBOX_STRATEGY``, see ``sandbox``.
 
         A context manager so that you can say:
 
@@ -129,7 +467,10 @@ class Computation(object):
                 ... do something ...
         """
         if self.result_code:
-            self._create_tempdir()
+            if self.shared_temp:
+                self._reset_tempdir()
+            else:
+                self._create_tempdir()
 
             cwd = os.getcwd()
             os.chdir(self.runner_temp.path)
@@ -144,46 +485,58 @@ class Computation(object):
         finally:
             if self.result_code:
                 os.chdir(cwd)
-                self._delete_tempdir()
+                if not self.shared_temp:
+                    self._delete_tempdir()
 
     def execute_in_place(self):
         """
         Execute the runner with the subject as set in the object.  Do this in
         the current directory, wherever that may be.  In the process, also
-        collect runtime information using /usr/bin/time profilling
+        collect the resource usage of the runner for profiling
         """
         logger.info("running %r with %r",self.runner,self.subject)
 
         executable = self.runner_temp.executable
         libc_redirect = "LIBC_FATAL_STDERR_=1 "
-        timeblock = "/usr/bin/time --format={\\\"usertime\\\":%U,\\\"memmax\\\":%M,\\\"memavg\\\":%K} "
 
         # run the runner in its own directory
         with self.runner_temp.in_dir():
             with self.runner_temp.processed_infile(self.subject) as kim_stdin_file,  \
-                    open(cf.STDOUT_FILE,'w') as stdout_file, \
-                    open(cf.STDERR_FILE,'w') as stderr_file:
+                    OutputCapture(cf.STDOUT_FILE) as stdout_capture, \
+                    OutputCapture(cf.STDERR_FILE) as stderr_capture:
                 start_time = time.time()
 
+                cgroup = None
+                if cf.RUNNER_CGROUP:
+                    cgroup = CGroup("%s_%i" % (self.result_code or self.runner.kim_code, os.getpid()))
+                    cgroup.create(cf.RUNNER_MEMORY_MAX, cf.RUNNER_CPU_MAX, cf.RUNNER_PIDS_MAX)
+
                 logger.info("launching run...")
-                process = Command(libc_redirect+timeblock+executable,stdin=kim_stdin_file,
-                        stdout=stdout_file,stderr=stderr_file)
+                process = Command(libc_redirect+executable,stdin=kim_stdin_file,
+                        stdout=stdout_capture,stderr=stderr_capture,cgroup=cgroup)
 
                 try:
                     self.retcode = process.run(timeout=cf.RUNNER_TIMEOUT)
-                except PipelineTimeout:
+                except cf.PipelineTimeout:
                     logger.error("runner %r timed out",self.runner)
-                    raise PipelineTimeout, "your executable timed out at %r hours" % (cf.RUNNER_TIMEOUT / 3600)
+                    raise cf.PipelineTimeout, "your executable timed out at %r hours" % (cf.RUNNER_TIMEOUT / 3600)
+                finally:
+                    self.rusage = process.rusage
+                    self.mempeak = process.mempeak
+                    self.output_tails = {cf.STDOUT_FILE: stdout_capture.tail(),
+                                         cf.STDERR_FILE: stderr_capture.tail()}
+                    if cgroup:
+                        self.cgroup_info = cgroup.info()
+                        cgroup.remove()
 
                 end_time = time.time()
 
-        # It seems the runner didn't finish
-        if process.poll() is None:
-            process.kill()
-            raise cf.KIMRuntimeError, "Your test did not respond to timeout request and did not exit"
-
         self.runtime = end_time - start_time
         logger.info("Run completed in %r seconds" % self.runtime)
+        if self.cgroup_info and self.cgroup_info["oom-kills"]:
+            logger.error("Runner was killed for exceeding its memory limit")
+            raise cf.PipelineOutOfMemory("Executable %r was killed for exceeding its memory limit of %r bytes" % (
+                self.runner_temp, cf.RUNNER_MEMORY_MAX))
         if self.retcode != 0:
             logger.error("Runner returned error code %r, %r" % (self.retcode, os.strerror(self.retcode)) )
             raise cf.KIMRuntimeError("Executable %r returned error code %r" % (self.runner_temp, self.retcode))
@@ -209,7 +562,7 @@ class Computation(object):
                 raise cf.KIMRuntimeError, "Test did not produce valid EDN %s" % cf.RESULT_FILE
 
             if self.verify:
-                valid, reply = test_result_valid(cf.RESULT_FILE)
+                valid, reply = test_result_valid(cf.RESULT_FILE, doc)
                 if not valid:
                     raise cf.KIMRuntimeError, "Test result did not conform to property definition\n%r" % reply
 
@@ -233,14 +586,11 @@ class Computation(object):
         if extrainfo:
             info_dict.update(extrainfo)
 
-        # get the information from the timing script
-        with self.runner_temp.in_dir():
-            if os.path.exists(cf.STDERR_FILE):
-                with open(cf.STDERR_FILE) as stderr_file:
-                    stderr = stderr_file.read()
-                time_str = stderr.splitlines()[-1]
-                time_dat = json.loads(time_str)
-                info_dict.update(time_dat)
+        # the resource usage of the runner process tree
+        if self.rusage:
+            info_dict.update(rusage_info(self.rusage, self.mempeak))
+        if self.cgroup_info:
+            info_dict.update(self.cgroup_info)
 
         logger.debug("Caching profile information")
         self.info_dict = info_dict
@@ -306,8 +656,8 @@ class Computation(object):
 
     def run(self, extrainfo=None):
         """
-        Run a runner with the corresponding subject, with /usr/bin/time
-        profilling, capture the output as a dict, and return or run a V{T,M}
+        Run a runner with the corresponding subject, with resource usage
+        profiling, capture the output as a dict, and return or run a V{T,M}
         with the corresponding {TE,MO}
 
         If result_code is set, then run in a temporary directory, otherwise
@@ -326,12 +676,15 @@ class Computation(object):
             except Exception as e:
                 import traceback
                 trace = traceback.format_exc()
+                exc_info = sys.exc_info()
 
                 self.gather_profiling_info(extrainfo)
                 self.write_result(error=True)
+                if isinstance(e, cf.PipelineOutOfMemory):
+                    raise exc_info[0], exc_info[1], exc_info[2]
 
                 files = [cf.STDOUT_FILE, cf.STDERR_FILE, cf.KIMLOG_FILE]
-                tails = last_output_lines(self.runner_temp, files)
+                tails = last_output_lines(self.runner_temp, files, known=self.output_tails)
 
                 outs = trace+"\n"
                 for f, t in zip(files, tails):
@@ -340,27 +693,173 @@ class Computation(object):
                     outs += append_newline(t)+"\n"
                 raise cf.PipelineRuntimeError(e, outs)
 
+#================================================================
+# running many subjects through one runner
+#================================================================
+class BatchComputation(object):
+    def __init__(self, runner, subjects, result_codes, verify=True, parallel=1):
+        """
+        Run a runner against many subjects, building its running
+        directory once rather than once per subject.  The subjects are
+        run in sequence through the one directory or, with parallel > 1,
+        split between that many processes each with its own directory.
+        Every run is a ``Computation`` and leaves the same result tree.
+
+        Files a runner writes outside of ``output`` and kim.log are left
+        in place for the runs after it.
+
+        Parameters:
+            * runner : A Test or {Test|Model} Verification object
+            * subjects : the Tests or Models to run it with
+            * result_codes : the result code of each of the runs
+            * verify, as for ``Computation``
+            * parallel : the number of runs at a time
+        """
+        self.runner = runner
+        self.subjects = list(subjects)
+        self.result_codes = list(result_codes)
+        self.verify = verify
+        self.parallel = max(1, min(parallel, len(self.subjects)))
+
+    def _run_slot(self, slot, jobs, report, extrainfo=None):
+        """ Run (index, subject, result_code) jobs through one running directory,
+            calling report(index, error) after each """
+        # named as in Computation._create_tempdir, so never a valid kim code
+        tempname = self.runner.kim_code_name+"_running"+str(uuid.uuid4())+"__"+self.runner.kim_code_id
+        runner_temp = kimobjects.kim_obj(self.runner.kim_code, search=False, subdir=tempname)
+        sandbox.create(self.runner.path, runner_temp.path)
+
+        try:
+            for index, subject, result_code in jobs:
+                logger.info("Running combination <%r, %r>", self.runner, subject)
+                comp = Computation(self.runner, subject, result_code,
+                        verify=self.verify, runner_temp=runner_temp)
+                try:
+                    comp.run(extrainfo=extrainfo)
+                    report(index, None)
+                except Exception as e:
+                    logger.error("Combination <%r, %r> failed", self.runner, subject)
+                    report(index, str(e))
+        finally:
+            sandbox.remove(runner_temp.path)
+
+    def run(self, extrainfo=None):
+        """
+        Run all of the combinations, returning for each subject None if it
+        succeeded and the error as a string if not
+        """
+        jobs = zip(range(len(self.subjects)), self.subjects, self.result_codes)
+        errors = ["Not run"]*len(jobs)
+
+        if self.parallel == 1:
+            def report(index, error):
+                errors[index] = error
+            self._run_slot(0, jobs, report, extrainfo)
+            return errors
+
+        queue = multiprocessing.Queue()
+        procs = [ multiprocessing.Process(target=self._run_slot,
+                    args=(slot, jobs[slot::self.parallel], lambda *a: queue.put(a), extrainfo))
+                for slot in xrange(self.parallel) ]
+        for proc in procs:
+            proc.start()
+
+        done = 0
+        while done < len(jobs):
+            try:
+                index, error = queue.get(timeout=cf.PIPELINE_WAIT)
+                errors[index] = error
+                done += 1
+            except Queue.Empty:
+                if not any(proc.is_alive() for proc in procs) and queue.empty():
+                    logger.error("Batch processes exited with %i runs unreported", len(jobs) - done)
+                    break
+        for proc in procs:
+            proc.join()
+        return errors
+
+
 #================================================================
 # helper functions
 #================================================================
+PAGESIZE_KB = os.sysconf('SC_PAGE_SIZE') / 1024
+
+def process_tree(pid):
+    """ The pids of a process and all of its descendants, read from /proc """
+    pids, todo = [], [pid]
+    while todo:
+        pid = todo.pop()
+        pids.append(pid)
+        try:
+            for tid in os.listdir("/proc/%d/task" % pid):
+                with open("/proc/%d/task/%s/children" % (pid, tid)) as f:
+                    todo.extend(int(child) for child in f.read().split())
+        except (IOError, OSError):
+            pass
+    return pids
+
+def process_memory(pid):
+    """ The memory (KB) of a process, its proportional share of the pages it
+        shares with others where the kernel tells us, its resident set if not """
+    try:
+        with open("/proc/%d/smaps_rollup" % pid) as f:
+            for line in f:
+                if line.startswith("Pss:"):
+                    return int(line.split()[1])
+    except (IOError, OSError, IndexError, ValueError):
+        pass
+    try:
+        with open("/proc/%d/statm" % pid) as f:
+            return int(f.read().split()[1])*PAGESIZE_KB
+    except (IOError, OSError, IndexError, ValueError):
+        return 0
+
+def tree_rss(pid):
+    """ The total memory (KB) of a process and its descendants """
+    return sum(process_memory(child) for child in process_tree(pid))
+
+def rusage_info(rusage, mempeak=None):
+    """ The profiling entries for the resource usage of a run, memory in KB """
+    info = {
+        "usertime": rusage.ru_utime,
+        "systime": rusage.ru_stime,
+        "memmax": rusage.ru_maxrss,
+        "pagefaults-minor": rusage.ru_minflt,
+        "pagefaults-major": rusage.ru_majflt,
+        "ctxswitch-voluntary": rusage.ru_nvcsw,
+        "ctxswitch-involuntary": rusage.ru_nivcsw,
+        "blocks-in": rusage.ru_inblock,
+        "blocks-out": rusage.ru_oublock,
+    }
+    if mempeak:
+        info["mempeak"] = mempeak
+    return info
+
 def tail(f, n=5):
     """
-    Return the last ``n`` lines of a file ``f`` using
-    the unix tool tail and popen.  ``f`` is a str object
+    Return the last ``n`` lines of a file ``f``, reading
+    backwards from its end.  ``f`` is a str object
     """
     try:
-        stdin,stdout = os.popen2("tail -n "+str(n)+" "+f)
-        stdin.close()
-        lines = stdout.readlines();
-        stdout.close()
+        with open(f, 'rb') as fi:
+            fi.seek(0, os.SEEK_END)
+            pos, data, block = fi.tell(), "", 4096
+            while pos > 0 and data.count("\n") <= n:
+                step = min(block, pos)
+                pos -= step
+                fi.seek(pos)
+                data = fi.read(step) + data
+        lines = data.splitlines(True)[-n:]
     except Exception as e:
         lines = [""]
     return "".join(lines)
 
-def last_output_lines(kimobj, files, n=20):
-    """ Return the last lines of all output files """
+def last_output_lines(kimobj, files, n=20, known=None):
+    """ Return the last lines of all output files, using those already
+        known (i.e. kept by an ``OutputCapture``) where we have them """
+    known = known or {}
     with kimobj.in_dir():
-        tails = [ tail(f, n) for f in files ]
+        tails = [ known[f] if f in known else tail(f, n) for f in files ]
     return tails
 
 def append_newline(string):
@@ -369,15 +868,26 @@ def append_newline(string):
         string += "\n"
     return string
 
-def test_result_valid(flname):
+def test_result_valid(flname, doc=None):
     """
-    Queries pipeline.openkim.org to figure out if the given
-    flname is a valid property based on the property definitions
-    available in the official repository:
+    Figure out if the given flname (already read as doc, if given) is a
+    valid property based on the property definitions available in the
+    official repository:
 
         https://github.com/openkim/openkim-properties
+
+    from a local checkout, see ``properties``.  Results with properties
+    not found there are sent to pipeline.openkim.org if
+    ``PROPERTY_VALIDATOR_REMOTE`` is set.
     """
-    reply = json.loads(kimquery.query_property_validator(flname))
+    if doc is None:
+        doc = cf.loadedn(flname)
+
+    missing = properties.unknown(doc)
+    if missing and cf.PROPERTY_VALIDATOR_REMOTE:
+        logger.info("No local definition of %r, asking the remote validator", missing)
+        reply = json.loads(kimquery.query_property_validator(flname))
+    else:
+        reply = properties.validate(doc)
     valid = all([ rep['valid'] for rep in reply ])
     return (valid, reply)
-
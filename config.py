@@ -11,9 +11,7 @@ and this module is imported in star from at the top of all of the scripts::
 """
 import os
 import re
-import clj
-import json
-from functools import partial
+import edn
 
 def tostr(cls):
     return ".".join(map(str, cls))
@@ -74,6 +72,7 @@ KIM_LOG_DIR        = os.path.join(KIM_PIPELINE_DIR, "logs")
 KIM_API_DIR        = os.path.join(HOME,"kim-api")
 KIM_API_LIB_DIR    = os.path.join(KIM_API_DIR,"KIM_API")
 KIM_API_CHECK_MATCH_UTIL = os.path.join(KIM_API_LIB_DIR,"kim-api-descriptor-file-match")
+KIM_PROPERTIES_DIR = os.path.join(HOME,"openkim-properties")
 
 OUTPUT_DIR      = "output"
 TEST_EXECUTABLE = "runner"
@@ -89,9 +88,17 @@ RESULT_FILE     = os.path.join(OUTPUT_DIR,"results.edn")
 PIPELINESPEC_FILE = "pipelinespec.edn"
 PIPELINESPEC_TPL_FILE = "pipelinespec.edn.tpl"
 DEPENDENCY_FILE = "dependencies.edn"
+REPOSITORY_INDEX_FILE = ".pipeline-index.sqlite"
+MATCH_MATRIX_FILE = ".pipeline-matches.sqlite"
+UNIT_CACHE_FILE = ".pipeline-units.sqlite"
+DEPENDENCY_GRAPH_FILE = ".pipeline-dependencies.sqlite"
+TEMPLATE_CACHE_DIR = ".pipeline-templates"
+QUERY_CACHE_FILE = ".pipeline-queries.sqlite"
+QUERY_RECORD_FILE = os.path.join(OUTPUT_DIR,"pipeline.queries.edn")
 
 INTERMEDIATE_FILES = [TEMP_INPUT_FILE, STDOUT_FILE, STDERR_FILE, 
-        KIMLOG_FILE, RESULT_FILE]
+        STDOUT_FILE+".gz", STDERR_FILE+".gz",
+        KIMLOG_FILE, RESULT_FILE, QUERY_RECORD_FILE]
 
 #==============================
 # Settings for remote access
@@ -114,6 +121,11 @@ RSYNC_LOCAL_ROOT = KIM_REPOSITORY_DIR
 RSYNC_REMOTE_ROOT = GATEWAY_ROOT
 RSYNC_EXCLUDE_FILE = KIM_PIPELINE_DIR+"/.rsync-exclude"
 
+QUERY_TIMEOUT = 60      # seconds to wait on the query and validator servers
+QUERY_RETRIES = 3       # times a failed query is retried
+QUERY_BACKOFF = 1.0     # seconds before the first retry, doubling after
+QUERY_GZIP    = True    # ask for compressed responses
+
 if PIPELINE_DEBUG:
     BEAN_PORT = 14174
     PORT_TX   = 14173
@@ -144,16 +156,56 @@ TUBE_RESULTS     = "results"
 TUBE_JOBS        = "jobs"
 TUBE_ERRORS      = "errors"
 TUBE_LOGS        = "logs"
+TUBE_WAVES       = "waves"
 
 PIPELINE_WAIT    = 1
 PIPELINE_TIMEOUT = 60
 PIPELINE_MSGSIZE = 2**16
 PIPELINE_JOB_TIMEOUT = 3600*24
 
+WAVE_POLL_INTERVAL  = 60        # sec between checks that a finished wave's results are in
+WAVE_SETTLE_TIMEOUT = 3600*6    # sec to wait for them before giving up on the rest of a plan
+
 #============================
 # Runner Internals
 #============================
 RUNNER_TIMEOUT = 60*60*24*5 # sec-min-hr-days
+RUNNER_KILL_GRACE = 10       # sec between SIGTERM and SIGKILL on a timeout
+RUNNER_POLL_INTERVAL = 1.0   # longest sec between checks whether a runner exited
+RUNNER_SAMPLE_INTERVAL = 0.5 # shortest sec between samples of a runner's memory
+RUNNER_OUTPUT_MAX = 2**27    # bytes of each of stdout, stderr kept, None for all
+RUNNER_OUTPUT_COMPRESS = False # gzip stdout, stderr to pipeline.std{out,err}.gz
+RUNNER_OUTPUT_TAIL = 20      # lines of stdout, stderr kept for error reports
+
+# per job cgroup v2 limits, used only if RUNNER_CGROUP names a cgroup
+# directory delegated to the pipeline user, e.g. /sys/fs/cgroup/pipeline
+RUNNER_CGROUP     = None
+RUNNER_MEMORY_MAX = None      # bytes, memory.max (swap is then disallowed)
+RUNNER_CPU_MAX    = None      # "quota period" in usec, cpu.max
+RUNNER_PIDS_MAX   = None      # pids.max
+SANDBOX_STRATEGY = "reflink" # copy, reflink, link or overlay, see sandbox.py
+
+#============================
+# Result verification
+#============================
+# results using properties that are not defined in KIM_PROPERTIES_DIR
+# are sent to the remote validator if this is set, else they are invalid
+PROPERTY_VALIDATOR_REMOTE = True
+
+#============================
+# Match checking
+#============================
+MATCH_POOL_SIZE     = None    # children in the match pool, None for cpu_count
+MATCH_POOL_REQUESTS = 1000    # requests a child serves before it is recycled
+MATCH_TIMEOUT       = 60      # sec before a match check is considered hung
+
+#============================
+# Caches
+#============================
+KIMSPEC_CACHE_SIZE = 4096   # parsed kimspec files kept per process
+UNIT_CACHE_SIZE    = 1024   # unit conversion factors kept on disk
+QUERY_CACHE_SIZE   = 4096   # template query responses kept on disk
+QUERY_CACHE_TTL    = 3600   # seconds a template query response is reused
 
 #====================================
 # KIM ERRORS
@@ -179,6 +231,9 @@ class PipelineFileMissing(Exception):
 class PipelineTimeout(Exception):
     """ If a test time outs """
 
+class PipelineOutOfMemory(Exception):
+    """ If a test is killed for going over its memory limit """
+
 class PipelineDataMissing(Exception):
     """ If requested data doesn't exist """
 
@@ -214,11 +269,8 @@ def success(func, *args, **kwargs):
         return 0
 
 #=======================================
-# FIXME - this is by no means long-term
-# temporary loc for edn2json
+# reading and writing edn, see edn.py
 #=======================================
-jedns = partial(json.dumps, separators=(' ', ' '), indent=4)
-
 def replace_nones(o):
     if isinstance(o, list):
         return [ replace_nones(i) for i in o ]
@@ -233,17 +285,26 @@ def loadedn(f):
         try:
             f = open(f)
         except IOError as e:
-            return clj.loads(f)
-    return clj.load(f)
+            return edn.loads(f)
+    with f:
+        return edn.load(f)
+
+def iter_edn_documents(f):
+    """ generate the documents in an edn file (file or filename) one by one,
+        the elements of a top level vector or else the single value it holds """
+    if isinstance(f, basestring):
+        f = open(f)
+    with f:
+        for doc in edn.iter_documents(f):
+            yield doc
 
 def dumpedn(o, f, allow_nils=True):
     if not allow_nils:
         o = replace_nones(o)
-    o = jedns(o)
 
     if isinstance(f, basestring):
         with open(f, 'w') as fi:
-            fi.write(o)
+            edn.dump(o, fi)
     else:
-        f.write(o)
+        edn.dump(o, f)
 
@@ -3,13 +3,16 @@ Set of methods for querying the database in one form or the other
 
 As well as parsing and handling kim_codes
 
-Currently these calls mostly glob on the database, could be replaced by something more elegant later
+Lookups of partial kim_codes are served by a ``RepositoryIndex`` which lists
+each leader directory once, rescans it only when the directory itself changes
+on disk and persists what it found next to the repository
 
 """
 import re
 import os
-import glob
-import operator
+import json
+import fnmatch
+import sqlite3
 
 import config as cf
 from logger import logging
@@ -44,25 +47,309 @@ def isuuid(kimcode):
 def iskimcode(kimcode):
     return re.match(RE_KIMID, kimcode) is not None
 
-def kim_code_finder(name,leader,num,version):
-    """ Do a glob to look for possible matches
-        returns a list of possible matches, where the matches are kim_codes """
-    logger.debug("looking up kim_code for (%r,%r,%r,%r)", name,leader,num,version)
-    start_path = os.path.join(cf.KIM_REPOSITORY_DIR,leader.lower())
-    name = name
-    version = version or '*'
-    kim_code = format_kim_code(name,leader,num,version)
-    if not name:
-        kim_code = "*"+kim_code
+#-------------------------------------------------
+# Repository index
+#-------------------------------------------------
+RE_KIMID_FULL = RE_KIMID + "$"
+RE_UUID_FULL  = RE_UUID + "$"
+
+def _indexable(entry):
+    """ Whether a directory entry is an item of the repository, rather than
+        e.g. a running directory or the layers of an overlay """
+    return (re.match(RE_KIMID_FULL, entry) is not None or
+            re.match(RE_UUID_FULL, entry) is not None)
+
+INDEX_SCHEMA = """
+CREATE TABLE IF NOT EXISTS leaders (
+    leader TEXT PRIMARY KEY, mtime REAL, nlink INTEGER
+);
+CREATE TABLE IF NOT EXISTS items (
+    leader TEXT, entry TEXT, name TEXT, num TEXT, version TEXT,
+    path TEXT, mtime REAL, kimspec TEXT, driver TEXT,
+    PRIMARY KEY (leader, entry)
+);
+CREATE INDEX IF NOT EXISTS items_code ON items (leader, num);
+CREATE INDEX IF NOT EXISTS items_driver ON items (driver);
+"""
+
+class RepositoryIndex(object):
+    """ An index of the items in the repository
+
+    Every leader directory (``te``, ``mo``, ``tr``, ...) is listed once and
+    its entries are kept keyed by (leader, number), holding every name and
+    version found.  Before answering for a leader the directory is stat'ed,
+    and it is only listed again if its (mtime, nlink) stamp has changed, so
+    that new objects from rsync or finished computations are picked up.
+
+    The index is persisted in ``REPOSITORY_INDEX_FILE`` (SQLite) at the root
+    of the repository along with the path, version, kimspec and driver of
+    every item, so a new process whose leader stamps match the stored ones
+    starts without listing anything.  When a leader has changed only the
+    entries that are new, gone or modified are read again, and as running
+    directories come and go without changing the items of a leader nothing
+    is written then.  Only entries that are kim_codes or uuids are indexed.
+    Items are assumed to be immutable once in place, a kimspec edited
+    without touching its leader directory is only seen by ``touch`` or
+    ``refresh(deep=True)``.
+    """
+    def __init__(self, root=None, dbfile=None):
+        self._root = root
+        self._dbfile = dbfile
+        self._db = None
+        self._pid = None
+        self.leaders = {}
+
+    @property
+    def root(self):
+        return self._root or cf.KIM_REPOSITORY_DIR
+
+    @property
+    def dbfile(self):
+        return self._dbfile or os.path.join(self.root, cf.REPOSITORY_INDEX_FILE)
+
+    @property
+    def db(self):
+        """ The connection to the index file, or None if it can't be used,
+            reopened after a fork since connections can't be shared """
+        if self._pid != os.getpid():
+            self._pid = os.getpid()
+            try:
+                self._db = sqlite3.connect(self.dbfile, timeout=60)
+                self._db.text_factory = str
+                self._db.executescript(INDEX_SCHEMA)
+            except sqlite3.Error as e:
+                logger.warning("Could not use repository index %r: %r", self.dbfile, e)
+                self._db = None
+        return self._db
+
+    def _stamp(self, path):
+        try:
+            st = os.stat(path)
+        except OSError:
+            return None
+        return (st.st_mtime, st.st_nlink)
+
+    def _entry(self, stamp, names):
+        """ Group the kim_codes of a leader directory by (leader, number) """
+        codes = {}
+        for entry in names:
+            match = re.match(RE_KIMID_FULL, entry)
+            if not match or not match.group(4):
+                continue
+            name, lead, num, version = match.groups()
+            codes.setdefault((lead, num), []).append((name, lead, num, version))
+
+        for versions in codes.itervalues():
+            versions.sort(key=lambda x: x[-1])
+
+        return {"stamp": stamp, "names": set(names), "codes": codes}
+
+    def _item(self, leader, entry, mtime):
+        """ Build the stored row for a single entry of a leader directory """
+        path = os.path.join(self.root, leader, entry)
+        match = re.match(RE_KIMID_FULL, entry)
+        name, lead, num, version = match.groups() if match else (None,)*4
+
+        spec, driver = None, None
+        try:
+            spec = cf.loadedn(open(os.path.join(path, cf.CONFIG_FILE)))
+            driver = spec.get("test-driver") or spec.get("model-driver")
+        except Exception as e:
+            spec = spec if isinstance(spec, dict) else None
+
+        return (leader, entry, name, num, version, path, mtime,
+                json.dumps(spec) if spec is not None else None, driver)
+
+    def _mtime(self, path):
+        """ The latest modification of a directory or its kimspec """
+        mtimes = [0]
+        for p in (path, os.path.join(path, cf.CONFIG_FILE)):
+            try:
+                mtimes.append(os.stat(p).st_mtime)
+            except OSError:
+                pass
+        return max(mtimes)
+
+    def _store(self, db, leader, stamp, names, deep=False):
+        """ Bring the stored rows of a leader up to date with its listing """
+        logger.debug("updating the repository index for %r", leader)
+        known = dict(db.execute("SELECT entry, mtime FROM items WHERE leader=?", (leader,)))
 
-    full_possibilities = glob.glob(os.path.join(start_path,kim_code))
-    short_possibilities = [ os.path.basename(x) for x in full_possibilities ]
+        rows = []
+        for entry in names:
+            if entry in known and not deep:
+                continue
+            mtime = self._mtime(os.path.join(self.root, leader, entry))
+            if known.get(entry) != mtime:
+                rows.append(self._item(leader, entry, mtime))
+        gone = [ (leader, entry) for entry in known if entry not in names ]
+        if not rows and not gone and not deep:
+            # only running directories came or went, the stored rows still hold
+            return
 
-    if len(short_possibilities) == 0:
+        with db:
+            db.executemany("DELETE FROM items WHERE leader=? AND entry=?", gone)
+            db.executemany("INSERT OR REPLACE INTO items VALUES (?,?,?,?,?,?,?,?,?)", rows)
+            if stamp:
+                db.execute("INSERT OR REPLACE INTO leaders VALUES (?,?,?)", (leader,)+stamp)
+            else:
+                db.execute("DELETE FROM leaders WHERE leader=?", (leader,))
+
+    def _scan(self, leader, stamp, deep=False):
+        """ Read a leader from the index file if it is current, otherwise
+            list the directory and update the index file """
+        db = self.db
+        if db and not deep:
+            row = db.execute("SELECT mtime, nlink FROM leaders WHERE leader=?", (leader,)).fetchone()
+            if row and tuple(row) == stamp:
+                names = [ r[0] for r in db.execute("SELECT entry FROM items WHERE leader=?", (leader,)) ]
+                return self._entry(stamp, filter(_indexable, names))
+
+        logger.debug("indexing the %r directory", leader)
+        path = os.path.join(self.root, leader)
+        names = filter(_indexable, os.listdir(path)) if stamp else []
+        if db:
+            try:
+                self._store(db, leader, stamp, names, deep=deep)
+            except sqlite3.Error as e:
+                logger.warning("Could not update repository index for %r: %r", leader, e)
+        return self._entry(stamp, names)
+
+    def leader(self, leader):
+        """ Return the (fresh) index entry for a single leader directory """
+        leader = leader.lower()
+        stamp = self._stamp(os.path.join(self.root, leader))
+        entry = self.leaders.get(leader)
+        if entry is None or entry["stamp"] != stamp:
+            entry = self._scan(leader, stamp)
+            self.leaders[leader] = entry
+        return entry
+
+    def refresh(self, leaders=None, deep=False):
+        """ Bring the given leaders (all by default) up to date, e.g. after
+            an rsync.  With deep, every entry is stat'ed for changes """
+        for leader in (leaders or LEADERS_OBJS+LEADERS_DATA):
+            leader = leader.lower()
+            if deep:
+                stamp = self._stamp(os.path.join(self.root, leader))
+                self.leaders[leader] = self._scan(leader, stamp, deep=True)
+            else:
+                self.leader(leader)
+
+    def touch(self, leader, entries=None):
+        """ Pick up changes to a leader after something (rsync) has written
+            into it, reading again the rows of the given entries, which may
+            be glob patterns, if they were modified in place """
+        leader = leader.lower()
+        if leader not in LEADERS_OBJS+LEADERS_DATA:
+            return
+        names = self.leader(leader)["names"]
+
+        db = self.db
+        if not entries or not db:
+            return
+        names = [ name for name in names if any(fnmatch.fnmatch(name, e) for e in entries) ]
+        known = dict(db.execute("SELECT entry, mtime FROM items WHERE leader=?", (leader,)))
+        rows = []
+        for entry in names:
+            mtime = self._mtime(os.path.join(self.root, leader, entry))
+            if known.get(entry) != mtime:
+                rows.append(self._item(leader, entry, mtime))
+        if rows:
+            try:
+                with db:
+                    db.executemany("INSERT OR REPLACE INTO items VALUES (?,?,?,?,?,?,?,?,?)", rows)
+            except sqlite3.Error as e:
+                logger.warning("Could not update repository index for %r: %r", leader, e)
+
+    def find(self, name, leader, num, version):
+        """ Return the parsed kim_codes matching the given pieces, oldest first,
+            where name and version may be None to match anything """
+        versions = self.leader(leader)["codes"].get((leader.upper(), num), [])
+        return [ code for code in versions if
+                    (not name or code[0] == name) and
+                    (not version or code[-1] == version) ]
+
+    def contains(self, leader, entry):
+        """ Whether the leader directory has an entry of that exact name """
+        return entry in self.leader(leader)["names"]
+
+    def kim_codes(self, leader):
+        """ All of the full kim_codes under a leader, sorted """
+        codes = self.leader(leader)["codes"]
+        return sorted( format_kim_code(*code) for versions in codes.itervalues()
+                        for code in versions )
+
+    def item(self, leader, entry):
+        """ The stored information for an entry as a dict with the keys
+            leader, entry, name, num, version, path, kimspec and driver """
+        leader = leader.lower()
+        if not self.contains(leader, entry):
+            return None
+
+        keys = ("leader", "entry", "name", "num", "version", "path", "mtime", "kimspec", "driver")
+        row = None
+        if self.db:
+            row = self.db.execute("SELECT * FROM items WHERE leader=? AND entry=?",
+                    (leader, entry)).fetchone()
+        if row is None:
+            row = self._item(leader, entry, None)
+
+        item = dict(zip(keys, row))
+        item["kimspec"] = json.loads(item["kimspec"]) if item["kimspec"] else None
+        return item
+
+    def kimspec(self, leader, entry):
+        """ The kimspec of an entry as of its last indexing, or None """
+        item = self.item(leader, entry)
+        return item["kimspec"] if item else None
+
+    def driven_by(self, leader, driver):
+        """ The entries under leader whose kimspec names driver as their
+            test-driver or model-driver """
+        leader = leader.lower()
+        self.leader(leader)
+        if self.db:
+            return sorted( r[0] for r in self.db.execute(
+                "SELECT entry FROM items WHERE leader=? AND driver=?", (leader, str(driver))) )
+        return sorted( entry for entry in self.leader(leader)["names"]
+                if self._item(leader, entry, None)[-1] == str(driver) )
+
+    def invalidate(self, leader=None):
+        """ Forget one (or every) leader so it is read again on next use """
+        if leader:
+            self.leaders.pop(leader.lower(), None)
+        else:
+            self.leaders.clear()
+
+_index = None
+
+def repository_index():
+    """ The process wide ``RepositoryIndex``, created on first use """
+    global _index
+    if _index is None:
+        _index = RepositoryIndex()
+    return _index
+
+def find_kim_codes(name,leader,num,version):
+    """ Look in the repository index for possible matches, returns a list
+        of parsed kim_codes (name,leader,num,version) sorted on version """
+    logger.debug("looking up kim_code for (%r,%r,%r,%r)", name,leader,num,version)
+    possibilities = repository_index().find(name,leader,num,version)
+
+    if len(possibilities) == 0:
         #none found
+        kim_code = format_kim_code(name,leader,num,version or '*')
+        if not name:
+            kim_code = "*"+kim_code
         logger.error("Failed to find any matches for %r", kim_code)
         raise cf.PipelineSearchError, "Failed to find any matches for {}".format(kim_code)
-    return short_possibilities
+    return possibilities
+
+def kim_code_finder(name,leader,num,version):
+    """ Look in the repository index for possible matches
+        returns a list of possible matches, where the matches are kim_codes """
+    return [ format_kim_code(*code) for code in find_kim_codes(name,leader,num,version) ]
 
 def look_for_name(leader,num,version):
     """ Look for a name given the other pieces of a kim code,
@@ -83,16 +370,14 @@ def get_latest_version(name,leader,num):
     return the full kim_code for the newest version in the database"""
     logger.debug("Looking for the newest verison of (%r,%r,%r)",name,leader,num)
     version = None
-    possibilities = kim_code_finder(name,leader,num,version)
-    parsed_possibilities = [ parse_kim_code(code) for code in possibilities ]
-    #sort the list on its version number
-    newest = sorted(parsed_possibilities,key=operator.itemgetter(-1)).pop()
+    #the index keeps the possibilities sorted on their version number
+    newest = find_kim_codes(name,leader,num,version)[-1]
     return newest
 
 def get_new_version(name,leader,num):
     """ Get the new version code for the information given, i.e. increments the
     largest version number found by 1 """
-    version_int = int(get_latest_version(name,leader,num)) + 1
+    version_int = int(get_latest_version(name,leader,num)[-1]) + 1
     return "{:03d}".format(version_int)
 
 def get_leader(kimcode):
@@ -105,8 +390,9 @@ def get_leader(kimcode):
         return None
 
 def get_leader_by_search(kimcode):
+    index = repository_index()
     for lead in LEADERS_OBJS+LEADERS_DATA:
-        if len(glob.glob(os.path.join(cf.KIM_REPOSITORY_DIR, lead, kimcode))):
+        if index.contains(lead, kimcode):
             return lead.upper()
     return None
 
@@ -35,30 +35,59 @@ If we are told that a new test result has come in:
     * Send these updates through the original channels
 
 Local dependency resolution
+
+The runtime dependencies of every test are kept in a ``DependencyGraph``,
+so that the tests depending on a result are found through its reverse
+index rather than by reading every dependencies.edn in the repository.
 """
+import os
+import sqlite3
+
+import config as cf
+import database
 import kimobjects
 import kimquery
 
 from logger import logging
 logger = logging.getLogger("pipeline").getChild("dependencies")
 
-def result_inqueue(test, model):
-    query = {"database": "job", "test": str(test), "model": str(model),
-             "project": ["tube"], "limit": 1}
+# pairs asked about in a single query
+QUERY_BATCH_SIZE = 256
 
-    tube = kimquery.query(query, decode=True)
-    return len(tube) > 0
+def _key(pair):
+    return tuple(str(item) for item in pair)
 
-def result_exists(test, model):
-    query = {"project": ["uuid"], "database": "obj", "query":
-                {
-                    "runner.kimcode": str(test),
-                    "subject.kimcode": str(model),
-                },
-            "limit": 1}
+def _batches(pairs):
+    pairs = list(pairs)
+    for i in xrange(0, len(pairs), QUERY_BATCH_SIZE):
+        yield pairs[i:i+QUERY_BATCH_SIZE]
+
+def results_inqueue(pairs):
+    """ The set of (test, model) kim code pairs, out of a list of pairs,
+        which have jobs in the queue, asking once per batch """
+    found = set()
+    for batch in _batches(set(_key(p) for p in pairs)):
+        query = {"database": "job", "project": ["test", "model"],
+                 "query": {"$or": [ {"test": te, "model": mo} for te, mo in batch ]}}
+        found.update(_key(pair) for pair in kimquery.query(query, decode=True))
+    return found
+
+def results_exist(pairs):
+    """ The set of (test, model) kim code pairs, out of a list of pairs,
+        which have results, asking once per batch """
+    found = set()
+    for batch in _batches(set(_key(p) for p in pairs)):
+        query = {"database": "obj", "project": ["runner.kimcode", "subject.kimcode"],
+                 "query": {"$or": [ {"runner.kimcode": te, "subject.kimcode": mo}
+                                     for te, mo in batch ]}}
+        found.update(_key(pair) for pair in kimquery.query(query, decode=True))
+    return found
+
+def result_inqueue(test, model):
+    return _key((test, model)) in results_inqueue([(test, model)])
 
-    result = kimquery.query(query, decode=True)
-    return len(result) > 0
+def result_exists(test, model):
+    return _key((test, model)) in results_exist([(test, model)])
 
 def result_pair(uuid):
     query = {"database": "obj", "limit": 1,
@@ -72,50 +101,316 @@ def list2obj(l):
         kimobjects.kim_obj(l[1], search=True)
     )
 
-def get_run_list(target, depth=0, tree=False, display=False):
-    if hasattr(target, '__iter__'):
-        # we have a (test,model) pair which needs updating
-        torun = set()
-        satisfied = True
-
-        te, mo = target
-        deps = te.runtime_dependencies(mo)
-
-        for dep in deps:
-            if hasattr(dep, '__iter__'):
-                tmp_te, tmp_mo = list2obj(dep)
-
-                if not result_exists(tmp_te, tmp_mo):
-                    # there are results that need be collected, wait for them
-                    satisfied = False
-
-                    if not result_inqueue(tmp_te, tmp_mo):
-                        # they are not on the queue, let's get around to run
-                        for dep in get_run_list((tmp_te, tmp_mo),
-                                        depth=depth+1, display=display):
-                            torun.add(dep)
-
-        if satisfied:
-            if not result_exists(te, mo):
-                return [(te, mo)]
-            logger.debug("Result exists for (%r, %r), skipping..." % (te, mo))
+#=================================
+# the dependency graph
+#=================================
+GRAPH_SCHEMA = """
+CREATE TABLE IF NOT EXISTS tests (
+    test TEXT PRIMARY KEY, mtime REAL
+);
+CREATE TABLE IF NOT EXISTS edges (
+    test TEXT, dep_raw TEXT, dep TEXT, model_raw TEXT, model TEXT
+);
+CREATE INDEX IF NOT EXISTS edges_test ON edges (test);
+CREATE INDEX IF NOT EXISTS edges_dep ON edges (dep);
+"""
+
+class DependencyGraph(object):
+    """ The runtime dependencies between tests, forwards and backwards
+
+    Every test's dependencies.edn is read into edges from the test to the
+    test whose results it uses, with the model fixed if the dependency
+    names one and left empty if the test is run against the same model.
+    Edges are kept in ``DEPENDENCY_GRAPH_FILE`` next to the repository,
+    indexed both ways, along with the mtime of the file they were read
+    from.
+
+    The first use in a process brings the graph up to date with the tests
+    in the repository, reading only the files that changed, after which new
+    tests are added with ``update``.  Dependencies given without a version
+    are resolved again whenever a version of the test they name is added or
+    removed, as it may be their newest.  If the file can't be used the graph
+    is kept in memory for the life of the process.
+    """
+    def __init__(self, dbfile=None):
+        self._dbfile = dbfile
+        self._db = None
+        self._pid = None
+        self.fresh = False
+
+    @property
+    def dbfile(self):
+        return self._dbfile or os.path.join(cf.KIM_REPOSITORY_DIR, cf.DEPENDENCY_GRAPH_FILE)
+
+    @property
+    def db(self):
+        """ The connection to the graph file, or to one in memory if it
+            can't be used, reopened after a fork """
+        if self._pid != os.getpid():
+            self._pid = os.getpid()
+            try:
+                self._db = self._connect(self.dbfile)
+            except sqlite3.Error as e:
+                logger.warning("Could not use dependency graph %r: %r", self.dbfile, e)
+                self._db = self._connect(":memory:")
+                self.fresh = False
+        return self._db
+
+    def _connect(self, dbfile):
+        db = sqlite3.connect(dbfile, timeout=60)
+        db.text_factory = str
+        db.executescript(GRAPH_SCHEMA)
+        return db
+
+    def _stamp(self, test):
+        try:
+            return os.stat(test.depfile_path).st_mtime
+        except OSError:
+            return 0
+
+    def _resolve(self, kim_code):
+        try:
+            return kimobjects.kim_obj(kim_code, search=True)
+        except Exception as e:
+            logger.warning("Could not find dependency %r: %r", kim_code, e)
+            return None
+
+    def _edges(self, test):
+        """ The (dep_raw, dep, model_raw, model) edges out of a test """
+        if not os.path.isfile(test.depfile_path):
             return []
-        return list(torun)
 
-    else:
-        # we have a test result that has come in
-        te, mo = result_pair(target)
+        edges = []
+        for dep in cf.loadedn(test.depfile_path):
+            if isinstance(dep, basestring):
+                obj = self._resolve(dep)
+                if isinstance(obj, kimobjects.Test):
+                    edges.append((dep, str(obj), '', ''))
+            elif hasattr(dep, '__iter__'):
+                te, mo = self._resolve(dep[0]), self._resolve(dep[1])
+                if te and mo:
+                    edges.append((dep[0], str(te), dep[1], str(mo)))
+        return edges
+
+    def _store(self, test):
+        edges = self._edges(test)
+        code = str(test)
+        with self.db as db:
+            db.execute("DELETE FROM edges WHERE test=?", (code,))
+            db.executemany("INSERT INTO edges VALUES (?,?,?,?,?)",
+                    [ (code,) + edge for edge in edges ])
+            db.execute("INSERT OR REPLACE INTO tests VALUES (?,?)", (code, self._stamp(test)))
+
+    def _reresolve(self, codes):
+        """ Read again the tests with dependencies given without a version
+            that name one of the items (by kim codes) that came or went """
+        ids = set()
+        for code in codes:
+            name, leader, num, version = database.parse_kim_code(code)
+            ids.add("%s_%s" % (leader, num))
+
+        stale = set()
+        for kim_id in ids:
+            rows = self.db.execute("SELECT DISTINCT test FROM edges WHERE "
+                    "(dep_raw != dep AND instr(dep_raw, ?) > 0) OR "
+                    "(model_raw != model AND instr(model_raw, ?) > 0)", (kim_id, kim_id))
+            stale.update(code for (code,) in rows)
+        for code in stale:
+            test = self._resolve(code)
+            if test:
+                self._store(test)
 
-        torun = set()
+    def refresh(self):
+        """ Bring the graph up to date with the tests in the repository """
+        stored = dict(self.db.execute("SELECT test, mtime FROM tests").fetchall())
+
+        changed, current = [], set()
         for test in kimobjects.Test.all():
-            deps = test.runtime_dependencies(mo)
+            code = str(test)
+            current.add(code)
+            if stored.get(code) != self._stamp(test):
+                self._store(test)
+                changed.append(code)
+
+        gone = set(stored) - current
+        if gone:
+            self._remove(gone)
+        added = [ code for code in changed if code not in stored ]
+        if added or gone:
+            self._reresolve(added + list(gone))
+        self.fresh = True
+        logger.debug("Dependency graph refreshed, %i tests read, %i gone", len(changed), len(gone))
+
+    def _remove(self, codes):
+        with self.db as db:
+            for code in codes:
+                db.execute("DELETE FROM edges WHERE test=?", (code,))
+                db.execute("DELETE FROM tests WHERE test=?", (code,))
 
-            for dep in deps:
-                if hasattr(dep, '__iter__'):
-                    tmpte, tmpmo = list2obj(dep)
+    def update(self, test):
+        """ Add a test, or read its dependencies again """
+        self._store(test)
+        self._reresolve([str(test)])
+
+    def remove(self, test):
+        self._remove([str(test)])
+        self._reresolve([str(test)])
+
+    def _ready(self):
+        if not self.fresh:
+            self.refresh()
+        return self.db
+
+    def dependencies(self, test):
+        """ The (test, model) kim codes a test depends on, model None when
+            it is the model the test is run against """
+        rows = self._ready().execute("SELECT dep, model FROM edges WHERE test=?", (str(test),))
+        return [ (dep, model or None) for dep, model in rows ]
+
+    def dependents(self, test, model):
+        """ The kim codes of the tests using the result of test with model """
+        rows = self._ready().execute("SELECT DISTINCT test FROM edges WHERE dep=? "
+                "AND (model='' OR model=?)", (str(test), str(model)))
+        return [ code for (code,) in rows ]
+
+_graph = None
+
+def dependency_graph():
+    """ The process wide ``DependencyGraph``, created on first use """
+    global _graph
+    if _graph is None:
+        _graph = DependencyGraph()
+    return _graph
+
+#=================================
+# resolution
+#=================================
+def _walk(pairs):
+    """
+    Walk the runtime dependencies down from a list of (test, model) pairs,
+    one level of the tree at a time, asking about the whole level in a
+    single batched query for results and another for queued jobs.
+
+    Returns the nodes walked, {key: (pair, [keys of dependencies without
+    results])}, and which of the keys seen have results.  Dependencies
+    without results that are already queued are not walked further.
+    """
+    graph = dependency_graph()
+    exists, inqueue = {}, {}
+    nodes, seen = {}, set()
+
+    level = [ tuple(pair) for pair in pairs ]
+    while level:
+        seen.update(_key(pair) for pair in level)
+
+        deps = {}
+        for te, mo in level:
+            deps[(te, mo)] = [ (kimobjects.kim_obj(dep, search=True),
+                                kimobjects.kim_obj(model, search=True) if model else mo)
+                               for dep, model in graph.dependencies(te) ]
+
+        # everything on this level, and what it depends on, that we don't know about
+        asked = set([ _key(p) for p in level ])
+        asked.update(_key(d) for ds in deps.itervalues() for d in ds)
+        asked.difference_update(exists)
+        found = results_exist(asked) if asked else set()
+        exists.update((k, k in found) for k in asked)
+
+        missing = set(_key(d) for ds in deps.itervalues() for d in ds
+                      if not exists[_key(d)])
+        missing.difference_update(inqueue)
+        found = results_inqueue(missing) if missing else set()
+        inqueue.update((k, k in found) for k in missing)
+
+        nextlevel = []
+        for pair in level:
+            waiting = [ d for d in deps[pair] if not exists[_key(d)] ]
+            nodes[_key(pair)] = (pair, [ _key(d) for d in waiting ])
+
+            # there are results that need be collected, run the ones not queued
+            for dep in waiting:
+                if not inqueue[_key(dep)] and _key(dep) not in seen:
+                    seen.add(_key(dep))
+                    nextlevel.append(dep)
+        level = nextlevel
+
+    return nodes, exists
+
+def resolve(pairs):
+    """
+    The (test, model) pairs to run so that each of the given pairs is
+    brought up to date, as far as their runtime dependencies allow.
+
+    A pair whose dependencies all have results is run if it has none
+    itself.  Otherwise each dependency without a result that isn't already
+    queued is resolved in turn, see ``_walk``.
+    """
+    nodes, exists = _walk(pairs)
+
+    torun = []
+    for key, (pair, waiting) in nodes.iteritems():
+        if waiting:
+            continue
+        if exists[key]:
+            logger.debug("Result exists for (%r, %r), skipping..." % pair)
+        else:
+            torun.append(pair)
+    return torun
+
+def wave_plan(pairs):
+    """
+    Every pair that has to run to bring the given pairs up to date, in
+    waves that can each run once the ones before them are done.  The first
+    wave is what ``resolve`` gives, and each pair is in the wave after the
+    last of its dependencies.  Pairs waiting on a job that is already
+    queued, or on a cycle, are left out, to be picked up as results come in.
+    """
+    nodes, exists = _walk(pairs)
+    depths = {}
+
+    def depth(key, stack=()):
+        if key not in depths:
+            if key not in nodes or key in stack:
+                return None
+            pair, waiting = nodes[key]
+            d = 0
+            for dep in waiting:
+                sub = depth(dep, stack + (key,))
+                if sub is None:
+                    d = None
+                    break
+                d = max(d, sub + 1)
+            depths[key] = d
+        return depths[key]
+
+    waves = []
+    for key, (pair, waiting) in nodes.iteritems():
+        if exists[key]:
+            continue
+        d = depth(key)
+        if d is None:
+            continue
+        while len(waves) <= d:
+            waves.append([])
+        waves[d].append(pair)
+    return waves
+
+def _targets(target):
+    """ The pairs to bring up to date for a (test, model) pair, or for the
+        uuid of a result that has come in, the pairs that depend on it """
+    if hasattr(target, '__iter__'):
+        # we have a (test,model) pair which needs updating
+        return [target]
+
+    # we have a test result that has come in
+    te, mo = result_pair(target)
+    return [ (kimobjects.kim_obj(test), mo)
+             for test in dependency_graph().dependents(te, mo) ]
+
+def get_run_list(target, depth=0, tree=False, display=False):
+    return resolve(_targets(target))
 
-                    if te == tmpte and mo == tmpmo:
-                        for m in get_run_list((test,mo),
-                                depth=depth+1, display=display):
-                            torun.add(m)
-        return list(torun)
+def get_wave_plan(targets):
+    """ One wave plan for all the targets of an update, so that each level
+        of their dependencies is asked about in a single query """
+    return wave_plan([ pair for target in targets for pair in _targets(target) ])
@@ -0,0 +1,291 @@
+"""
+A small EDN reader and writer for the files the pipeline handles itself,
+kimspec.edn, pipelinespec.edn, dependencies.edn and results.edn
+
+Only the subset of EDN these files actually use is understood:
+
+    * maps ``{}``, vectors ``[]`` (lists ``()`` and sets ``#{}`` are read too)
+    * strings, integers and floats
+    * keywords, which are read as plain strings without the leading colon
+    * ``nil``, ``true`` and ``false`` (``null`` is read as ``nil`` since the
+      pipeline itself has always written it)
+    * ``;`` comments and commas as whitespace
+
+The reader tokenizes with a single regular expression over a buffer that is
+refilled from the file in chunks, and builds values with an explicit stack
+so that deeply nested documents don't hit the recursion limit.
+
+The writer produces exactly the layout the pipeline has always written,
+that of ``json.dumps(o, separators=(' ', ' '), indent=4)``, but streams it
+out in pieces instead of building the whole string in the pure python json
+encoder.
+"""
+import re
+import json
+import itertools
+
+CHUNK_SIZE = 2**16
+
+class EDNDecodeError(ValueError):
+    """ Raised when the input is not EDN that we understand """
+
+#=================================
+# reading
+#=================================
+_DELIM = r'[^\s,\[\]{}()";]'
+_TOKEN = re.compile(r"""
+    (?P<ws>(?:[\s,]+|;[^\n]*)+)
+   |(?P<open>[\[{(]|\#\{)
+   |(?P<close>[\]})])
+   |(?P<string>"(?:[^"\\]|\\.)*")
+   |(?P<number>[-+]?(?:\d+\.?\d*|\.\d+)(?:[eE][-+]?\d+)?[MN]?(?=[\s,\[\]{}()";]|$))
+   |(?P<keyword>:%s+)
+   |(?P<symbol>%s+)
+""" % (_DELIM, _DELIM), re.VERBOSE)
+
+_ESCAPE = re.compile(r'\\(u[0-9a-fA-F]{4}|.)')
+_ESCAPES = {'"': '"', '\\': '\\', '/': '/', 'n': '\n', 't': '\t',
+            'r': '\r', 'b': '\b', 'f': '\f'}
+_SYMBOLS = {'nil': None, 'null': None, 'true': True, 'false': False}
+_CLOSERS = {'[': ']', '(': ')', '{': '}', '#{': '}'}
+
+def _unescape(match):
+    esc = match.group(1)
+    if len(esc) == 5:
+        return unichr(int(esc[1:], 16)).encode('utf-8')
+    return _ESCAPES.get(esc, esc)
+
+def _string(text):
+    """ Strings are returned as they were in the file (utf-8) with
+        escapes, including unicode ones, resolved """
+    text = text[1:-1]
+    if '\\' in text:
+        text = _ESCAPE.sub(_unescape, text)
+    return text
+
+def _number(text):
+    if text[-1] in 'MN':
+        text = text[:-1]
+    if '.' in text or 'e' in text or 'E' in text:
+        return float(text)
+    return int(text)
+
+def tokenize(f, chunk_size=CHUNK_SIZE):
+    """ Generate (kind, text) tokens from a file object, reading it in
+        chunks so that only the current token needs to be in memory """
+    buf, pos, eof = '', 0, False
+    match = _TOKEN.match
+    while True:
+        if pos >= len(buf):
+            if eof:
+                return
+            buf, pos = f.read(chunk_size), 0
+            eof = not buf
+            continue
+
+        m = match(buf, pos)
+        # a token running into the end of the buffer might continue in the
+        # next chunk, as might a string whose closing quote we haven't seen
+        if not eof and (m is None or m.end() == len(buf)):
+            more = f.read(chunk_size)
+            if more:
+                buf, pos = buf[pos:] + more, 0
+                continue
+            eof = True
+            m = match(buf, pos)
+
+        if m is None:
+            raise EDNDecodeError("Invalid EDN near %r" % buf[pos:pos+40])
+
+        pos = m.end()
+        kind = m.lastgroup
+        if kind != 'ws':
+            yield kind, m.group(kind)
+
+def _atom(kind, text):
+    if kind == 'string':
+        return _string(text)
+    if kind == 'number':
+        return _number(text)
+    if kind == 'keyword':
+        return text[1:]
+    return _SYMBOLS.get(text, text)
+
+def _container(opener, items):
+    if opener == '{':
+        if len(items) % 2:
+            raise EDNDecodeError("Map literal with an odd number of forms")
+        it = iter(items)
+        return dict(zip(it, it))
+    if opener == '#{':
+        return set(items)
+    return items
+
+def iter_values(tokens, closer=None):
+    """ Build values from a token stream, generating each top level value.
+        If closer is given the values are the elements of a container whose
+        opening token has already been consumed, and generation stops at its
+        closing token """
+    stack = []
+    for kind, text in tokens:
+        if kind == 'close' and not stack and text == closer:
+            return
+
+        if kind == 'open':
+            stack.append((text, []))
+            continue
+
+        if kind == 'close':
+            if not stack or _CLOSERS[stack[-1][0]] != text:
+                raise EDNDecodeError("Unbalanced %r" % text)
+            opener, items = stack.pop()
+            value = _container(opener, items)
+        else:
+            value = _atom(kind, text)
+
+        if stack:
+            stack[-1][1].append(value)
+        else:
+            yield value
+
+    if stack or closer:
+        raise EDNDecodeError("Unexpected end of input, unclosed %r" %
+                (stack[-1][0] if stack else closer))
+
+def load(f):
+    """ Read the first EDN value from a file object """
+    for value in iter_values(tokenize(f)):
+        return value
+    raise EDNDecodeError("No EDN value found")
+
+def loads(s):
+    """ Read the first EDN value from a string """
+    for value in iter_values(tokenize(_StringReader(s))):
+        return value
+    raise EDNDecodeError("No EDN value found")
+
+def iter_documents(f, chunk_size=CHUNK_SIZE):
+    """ Generate the documents of a file holding either a single EDN value
+        or a vector of them, one at a time, so that only the document being
+        built is ever held in memory """
+    tokens = tokenize(f, chunk_size)
+    for kind, text in tokens:
+        if kind == 'open' and text == '[':
+            for value in iter_values(tokens, closer=']'):
+                yield value
+        else:
+            for value in iter_values(itertools.chain([(kind, text)], tokens)):
+                yield value
+                break
+        return
+
+class _StringReader(object):
+    """ Hands a whole string to ``tokenize`` as a single chunk """
+    def __init__(self, s):
+        self.s = s
+
+    def read(self, size=-1):
+        s, self.s = self.s, ''
+        return s
+
+#=================================
+# writing
+#=================================
+INDENT = 4
+_encode_string = json.encoder.encode_basestring_ascii
+
+def _floatstr(o):
+    if o != o:
+        return 'NaN'
+    if o == float('inf'):
+        return 'Infinity'
+    if o == float('-inf'):
+        return '-Infinity'
+    return repr(o)
+
+def _scalar(o):
+    """ The encoding of a non-container value, or None if it is one """
+    if isinstance(o, basestring):
+        return _encode_string(o)
+    if o is None:
+        return 'null'
+    if o is True:
+        return 'true'
+    if o is False:
+        return 'false'
+    if isinstance(o, (int, long)):
+        return str(o)
+    if isinstance(o, float):
+        return _floatstr(o)
+    return None
+
+def _key(k):
+    if isinstance(k, basestring):
+        return _encode_string(k)
+    if isinstance(k, float):
+        return _encode_string(_floatstr(k))
+    out = _scalar(k)
+    if out is None:
+        raise TypeError("key %r is not a string" % (k,))
+    return _encode_string(out)
+
+def iterencode(o, level=0):
+    """ Generate the pieces of the EDN encoding of o """
+    out = _scalar(o)
+    if out is not None:
+        yield out
+        return
+
+    if isinstance(o, dict):
+        if not o:
+            yield '{}'
+            return
+        newline = '\n' + ' '*(INDENT*(level+1))
+        yield '{' + newline
+        first = True
+        for k, v in o.iteritems():
+            if not first:
+                yield ' ' + newline
+            first = False
+            yield _key(k) + ' '
+            out = _scalar(v)
+            if out is not None:
+                yield out
+            else:
+                for chunk in iterencode(v, level+1):
+                    yield chunk
+        yield '\n' + ' '*(INDENT*level) + '}'
+
+    elif isinstance(o, (list, tuple)):
+        if not o:
+            yield '[]'
+            return
+        newline = '\n' + ' '*(INDENT*(level+1))
+        yield '[' + newline
+        separator = ' ' + newline
+        scalars = [ _scalar(v) for v in o ]
+        if None not in scalars:
+            # flat vectors of numbers and strings are the bulk of large results
+            yield separator.join(scalars)
+        else:
+            for i, (v, out) in enumerate(zip(o, scalars)):
+                if i:
+                    yield separator
+                if out is not None:
+                    yield out
+                else:
+                    for chunk in iterencode(v, level+1):
+                        yield chunk
+        yield '\n' + ' '*(INDENT*level) + ']'
+
+    else:
+        raise TypeError("%r is not EDN serializable" % (o,))
+
+def dumps(o):
+    """ Encode o as an EDN string """
+    return ''.join(iterencode(o))
+
+def dump(o, f):
+    """ Write the EDN encoding of o to a file object """
+    for chunk in iterencode(o):
+        f.write(chunk)
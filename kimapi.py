@@ -4,6 +4,14 @@ that build the libraries and use the Python interface kimservice
 to test if tests and models match.
 """
 import os
+import time
+import errno
+import atexit
+import select
+import signal
+import hashlib
+import sqlite3
+from multiprocessing import cpu_count
 from subprocess import check_output, check_call, CalledProcessError
 from contextlib import contextmanager
 from packaging import version
@@ -108,53 +116,439 @@ def valid_match_util(test,model):
     return False
 
 
+#======================================
+# Match checking pool
+#======================================
+def _match_child(req, res):
+    """ The loop run by a pool child: read ``kimfile<TAB>model`` lines and
+        answer each with a line of 1 (match), 0 (no match) or E (error) """
+    reader = os.fdopen(req)
+    try:
+        for line in iter(reader.readline, ""):
+            kimfile, model = line.rstrip("\n").split("\t")
+            try:
+                match, pkim = kimservice.KIM_API_file_init(kimfile, model)
+                if match:
+                    kimservice.KIM_API_free(pkim)
+                answer = "1\n" if match else "0\n"
+            except Exception as e:
+                answer = "E\n"
+            os.write(res, answer)
+    finally:
+        os._exit(0)
+
+class MatchPool(object):
+    """ A pool of long lived forked children that answer match requests
+
+    Each child is fed one (descriptor path, model name) request at a time
+    over a pipe and runs ``KIM_API_file_init`` on it.  A child that dies
+    (e.g. segfaults inside the KIM API) or does not answer within
+    ``MATCH_TIMEOUT`` is killed and respawned, and only its request is
+    reported as failed.  Children are also recycled after
+    ``MATCH_POOL_REQUESTS`` requests to bound what the API accumulates.
+    """
+    def __init__(self, size=None, timeout=None, maxrequests=None):
+        self.size = size or cf.MATCH_POOL_SIZE or cpu_count()
+        self.timeout = timeout or cf.MATCH_TIMEOUT
+        self.maxrequests = maxrequests or cf.MATCH_POOL_REQUESTS
+        self.children = []
+        self._pid = os.getpid()
+
+    def _spawn(self):
+        req_r, req_w = os.pipe()
+        res_r, res_w = os.pipe()
+        pid = os.fork()
+        if pid == 0:
+            try:
+                os.close(req_w)
+                os.close(res_r)
+                for child in self.children:
+                    os.close(child["req"])
+                    os.close(child["res"])
+            finally:
+                _match_child(req_r, res_w)
+
+        os.close(req_r)
+        os.close(res_w)
+        child = {"pid": pid, "req": req_w, "res": res_r, "served": 0}
+        self.children.append(child)
+        return child
+
+    def _reap(self, child, kill=False):
+        """ Remove a child from the pool, killing it if asked """
+        self.children.remove(child)
+        if kill:
+            try:
+                os.kill(child["pid"], signal.SIGKILL)
+            except OSError:
+                pass
+        os.close(child["req"])
+        os.close(child["res"])
+        try:
+            status = os.waitpid(child["pid"], 0)[1]
+        except OSError:
+            status = None
+        return status
+
+    def _respawn(self, child, kill=True):
+        status = self._reap(child, kill=kill)
+        logger.debug("respawning match child %r (status %r)", child["pid"], status)
+        return self._spawn()
+
+    def _readline(self, child):
+        """ Read an answer from a child, empty if it went away """
+        line = ""
+        while not line.endswith("\n"):
+            try:
+                chunk = os.read(child["res"], 64)
+            except OSError:
+                chunk = ""
+            if not chunk:
+                return ""
+            line += chunk
+        return line.strip()
+
+    def start(self):
+        """ Bring the pool up to size, starting over after a fork """
+        if self._pid != os.getpid():
+            self.children, self._pid = [], os.getpid()
+        while len(self.children) < self.size:
+            self._spawn()
+
+    def close(self):
+        """ Close the request pipes so the children exit, and reap them """
+        if self._pid != os.getpid():
+            return
+        for child in list(self.children):
+            self._reap(child)
+
+    def match(self, requests):
+        """ Check a list of (kimfile, model name) requests across the pool.
+            Returns a list of True/False, or None where the check failed """
+        self.start()
+        results = [None]*len(requests)
+        todo = list(reversed(list(enumerate(requests))))
+        idle = list(self.children)
+        busy = {}
+
+        while todo or busy:
+            while todo and idle:
+                child = idle.pop()
+                i, (kimfile, model) = todo.pop()
+                try:
+                    os.write(child["req"], "%s\t%s\n" % (kimfile, model))
+                except OSError as e:
+                    if e.errno != errno.EPIPE:
+                        raise
+                    # the child died between requests, try again on a new one
+                    todo.append((i, (kimfile, model)))
+                    idle.append(self._respawn(child))
+                    continue
+                busy[child["res"]] = (child, i, time.time() + self.timeout)
+
+            if not busy:
+                continue
+
+            wait = max(0, min(deadline for _, _, deadline in busy.values()) - time.time())
+            ready = select.select(busy.keys(), [], [], wait)[0]
+
+            for fd in ready:
+                child, i, deadline = busy.pop(fd)
+                answer = self._readline(child)
+                if answer in ("0", "1"):
+                    results[i] = answer == "1"
+                else:
+                    logger.debug("match child failed on %r", requests[i])
+
+                child["served"] += 1
+                if not answer:
+                    idle.append(self._respawn(child))
+                elif child["served"] >= self.maxrequests:
+                    idle.append(self._respawn(child, kill=False))
+                else:
+                    idle.append(child)
+
+            now = time.time()
+            for fd, (child, i, deadline) in busy.items():
+                if deadline < now:
+                    logger.debug("match child timed out on %r", requests[i])
+                    busy.pop(fd)
+                    idle.append(self._respawn(child))
+
+        return results
+
+_pool = None
+
+def match_pool():
+    """ The process wide ``MatchPool``, created on first use """
+    global _pool
+    if _pool is None or _pool._pid != os.getpid():
+        _pool = MatchPool()
+        atexit.register(_pool.close)
+    return _pool
+
+def valid_match_codes_many(pairs):
+    """ Check a list of (test, model) pairs through the KIM API in parallel,
+        returns a list of bools, or None for the pairs whose check failed """
+    requests = [ (str(test.kimfile_name), str(model)) for test, model in pairs ]
+    return match_pool().match(requests)
+
 def valid_match_codes(test,model):
     """ Test to see if a test and model match using the kim API, returns bool
 
-        Tests through ``kimservice.KIM_API_init``, running in its own forked process
+        Tests through ``kimservice.KIM_API_file_init``, running in a child
+        of the match pool
     """
-    #logger.debug("attempting to match %r with %r",testname,modelname)
     logger.debug("invoking KIMAPI for (%r,%r)",test,model)
-    pid = os.fork()
-    if (pid==0):
-        logger.debug("in fork")
-        match, pkim = kimservice.KIM_API_file_init(str(test.kimfile_name), str(model))
-        if match:
-            kimservice.KIM_API_free(pkim)
-            os._exit(0)
-        os._exit(1)
-
-    # try to get the exit code from the kim api process
-    exitcode = os.waitpid(pid,0)[1]/256
-    logger.debug("got exitcode: %r" , exitcode )
-    if exitcode == 0:
-        match = True
-    elif exitcode == 1:
-        match = False
-    else:
+    match = valid_match_codes_many([(test, model)])[0]
+    if match is None:
         logger.error("We seem to have a Kim init error on (%r,%r)", test, model)
         raise cf.KIMRuntimeError
-        match = False
+    return match
 
-    if match:
-        return True
-    else:
+#======================================
+# Match matrix
+#======================================
+MATCH_SCHEMA = """
+CREATE TABLE IF NOT EXISTS subjects (
+    hash TEXT PRIMARY KEY, bit INTEGER UNIQUE
+);
+CREATE TABLE IF NOT EXISTS runners (
+    api TEXT, hash TEXT, known TEXT, match TEXT,
+    PRIMARY KEY (api, hash)
+);
+"""
+
+_descriptor_hashes = {}
+
+def descriptor_hash(path):
+    """ The sha1 of a descriptor (.kim) file, remembered for as long as the
+        file keeps its mtime and size """
+    st = os.stat(path)
+    key = (path, st.st_mtime, st.st_size)
+    if key not in _descriptor_hashes:
+        with open(path) as f:
+            _descriptor_hashes[key] = hashlib.sha1(f.read()).hexdigest()
+    return _descriptor_hashes[key]
+
+class MatchMatrix(object):
+    """ A persistent record of which runners match which subjects
+
+    Runners and subjects are keyed by the content hash of their descriptor
+    file rather than their kim_code, so a new version whose .kim file did
+    not change reuses the answers of the old one while any real change
+    simply gets a new key.  Each subject hash is assigned a bit and each
+    runner row holds two bitsets over those bits, ``known`` and ``match``,
+    for the running KIM API version.  Rows live in ``MATCH_MATRIX_FILE``
+    next to the repository, or in memory for the life of the process if
+    that can't be used.
+    """
+    def __init__(self, dbfile=None, api=None):
+        self._dbfile = dbfile
+        self.api = api or cf.__kim_api_version__
+        self._db = None
+        self._pid = None
+        self.bits = {}
+        self.rows = {}
+
+    @property
+    def dbfile(self):
+        return self._dbfile or os.path.join(cf.KIM_REPOSITORY_DIR, cf.MATCH_MATRIX_FILE)
+
+    @property
+    def db(self):
+        """ The connection to the matrix file, or to one in memory if it
+            can't be used, reopened after a fork """
+        if self._pid != os.getpid():
+            self._pid = os.getpid()
+            self.bits, self.rows = {}, {}
+            try:
+                self._db = self._connect(self.dbfile)
+            except sqlite3.Error as e:
+                logger.warning("Could not use match matrix %r: %r", self.dbfile, e)
+                self._db = self._connect(":memory:")
+        return self._db
+
+    def _connect(self, dbfile):
+        db = sqlite3.connect(dbfile, timeout=60)
+        db.text_factory = str
+        db.executescript(MATCH_SCHEMA)
+        return db
+
+    def _bit(self, subject_hash):
+        """ The bit position of a subject hash, assigning a new one if needed """
+        if subject_hash not in self.bits:
+            db = self.db
+            with db:
+                db.execute("INSERT OR IGNORE INTO subjects (hash, bit) VALUES (?, "
+                    "(SELECT COALESCE(MAX(bit)+1, 0) FROM subjects))", (subject_hash,))
+            row = db.execute("SELECT bit FROM subjects WHERE hash=?", (subject_hash,)).fetchone()
+            self.bits[subject_hash] = row[0]
+        return self.bits[subject_hash]
+
+    def _row(self, runner_hash, reload=False):
+        """ The (known, match) bitsets of a runner as integers """
+        if reload or runner_hash not in self.rows:
+            row = self.db.execute("SELECT known, match FROM runners WHERE api=? AND hash=?",
+                    (self.api, runner_hash)).fetchone()
+            self.rows[runner_hash] = [int(row[0], 16), int(row[1], 16)] if row else [0, 0]
+        return self.rows[runner_hash]
+
+    def lookup(self, runner_hash, subject_hashes):
+        """ For each subject hash return True or False if its match against
+            the runner hash is already known, otherwise None """
+        bits = [ 1 << self._bit(subject_hash) for subject_hash in subject_hashes ]
+        known, match = self._row(runner_hash)
+        if any(not known & bit for bit in bits):
+            # another worker may have recorded them since we last looked
+            known, match = self._row(runner_hash, reload=True)
+        return [ bool(match & bit) if known & bit else None for bit in bits ]
+
+    def record(self, runner_hash, results):
+        """ Store the outcome of (subject hash, matched) pairs against a runner hash """
+        bits = [ (1 << self._bit(subject_hash), matched) for subject_hash, matched in results ]
+
+        # read the row again under the write lock so that the bits other
+        # workers have recorded meanwhile are kept
+        db = self.db
+        db.execute("BEGIN IMMEDIATE")
+        try:
+            row = self._row(runner_hash, reload=True)
+            for bit, matched in bits:
+                row[0] |= bit
+                row[1] = row[1] | bit if matched else row[1] & ~bit
+            db.execute("INSERT OR REPLACE INTO runners VALUES (?,?,?,?)",
+                (self.api, runner_hash, "%x" % row[0], "%x" % row[1]))
+        except:
+            db.rollback()
+            self.rows.pop(runner_hash, None)
+            raise
+        db.commit()
+
+_matrix = None
+
+def match_matrix():
+    """ The process wide ``MatchMatrix``, created on first use """
+    global _matrix
+    if _matrix is None:
+        _matrix = MatchMatrix()
+    return _matrix
+
+#======================================
+# Batch matching
+#======================================
+KIM_API_SPEC = version.Specifier(__kim_api_version_spec__)
+PIPELINE_API_SPEC = version.Specifier(__pipeline_version_spec__)
+
+def version_match(obj, runner=False):
+    """ Whether an object's kim-api-version (and pipeline-api-version for
+        runners) satisfy what this pipeline supports """
+    try:
+        ok = version.Version(obj.kim_api_version) in KIM_API_SPEC
+        if runner:
+            ok = ok and version.Version(obj.pipeline_api_version) in PIPELINE_API_SPEC
+    except (TypeError, version.InvalidVersion) as e:
+        logger.debug("Could not read the versions of %r: %r", obj, e)
         return False
+    return ok
+
+def valid_match_pairs(pairs):
+    """ Test a list of (runner, subject) pairs for matches, returns a list of
+        bools, or None for the pairs on which the KIM API failed (crashed,
+        timed out or raised) rather than answering
+
+        The version requirements and descriptor file of each object are
+        checked once however many pairs it is in, pairs already in the match
+        matrix are answered from it, and only the rest go to the KIM API
+        through the match pool, in parallel, with their answers recorded
+    """
+    pairs = list(pairs)
+    results = [False]*len(pairs)
+
+    versions, descriptors = {}, {}
+    def checked(obj, runner=False):
+        """ (kimfile, hash) of an object passing the version checks, or None """
+        code = str(obj)
+        if code not in versions:
+            versions[code] = version_match(obj, runner=runner)
+        if not versions[code]:
+            return None
+        if code not in descriptors:
+            try:
+                kimfile = obj.kimfile_name
+                descriptors[code] = (kimfile, descriptor_hash(kimfile))
+            except (IOError, OSError) as e:
+                logger.error("No descriptor file for %r: %r", obj, e)
+                descriptors[code] = None
+        return descriptors[code]
+
+    matrix = match_matrix()
+    todo = []
+    for i, (runner, subject) in enumerate(pairs):
+        rdesc, sdesc = checked(runner, runner=True), checked(subject)
+        if not rdesc or not sdesc:
+            continue
+
+        known = None
+        if matrix:
+            try:
+                known = matrix.lookup(rdesc[1], [sdesc[1]])[0]
+            except sqlite3.Error as e:
+                logger.warning("Match matrix unavailable: %r", e)
+                matrix = None
+
+        if known is None:
+            todo.append((i, rdesc, sdesc, str(pairs[i][1])))
+        else:
+            results[i] = known
+
+    logger.debug("Checking %i pairs, %i not in the match matrix", len(pairs), len(todo))
+    answers = []
+    if todo:
+        answers = match_pool().match([ (rdesc[0], subject) for i, rdesc, sdesc, subject in todo ])
+
+    byrunner = {}
+    for (i, rdesc, sdesc, subject), match in zip(todo, answers):
+        if match is None:
+            logger.error("We seem to have a Kim init error on (%r,%r)", *pairs[i])
+            results[i] = None
+            continue
+        results[i] = match
+        byrunner.setdefault(rdesc[1], []).append((sdesc[1], match))
+
+    if matrix:
+        try:
+            for runner_hash, recorded in byrunner.iteritems():
+                matrix.record(runner_hash, recorded)
+        except sqlite3.Error as e:
+            logger.warning("Could not record matches: %r", e)
+
+    return results
+
+def _checked(matches):
+    """ Raise for the pairs the KIM API failed on, as single checks always have """
+    if None in matches:
+        raise cf.KIMRuntimeError("KIM init error on %i pairs" % matches.count(None))
+    return matches
+
+def valid_matches(runner, subjects):
+    """ Return the list of subjects that match runner """
+    subjects = list(subjects)
+    matches = _checked(valid_match_pairs( (runner, subject) for subject in subjects ))
+    return [ subject for subject, match in zip(subjects, matches) if match ]
+
+def valid_runners(subject, runners):
+    """ Return the list of runners that match subject, the reverse of ``valid_matches`` """
+    runners = list(runners)
+    matches = _checked(valid_match_pairs( (runner, subject) for runner in runners ))
+    return [ runner for runner, match in zip(runners, matches) if match ]
 
 def valid_match(test,model):
     """ Test to see if a test and model match using the kim API, returns bool
 
-        Tests through ``kimservice.KIM_API_init``, running in its own forked process
+        Answers already in the match matrix are reused, otherwise tests
+        through ``kimservice.KIM_API_file_init`` in the match pool
     """
-    ver = version.Version
-    ver_pipspec = version.Specifier(__pipeline_version_spec__)
-    ver_kimspec = version.Specifier(__kim_api_version_spec__)
-
-    version_match = (
-        ver(test.kim_api_version) in ver_kimspec and
-        ver(model.kim_api_version) in ver_kimspec and
-        ver(test.pipeline_api_version) in ver_pipspec
-    )
-
-    logger.debug("Checking match for (%r, %r), version match %r" % (test,model,version_match))
-    return version_match and valid_match_codes(test, model)
+    match = _checked(valid_match_pairs([(test, model)]))[0]
+    logger.debug("Checking match for (%r, %r), match %r" % (test,model,match))
+    return match
@@ -22,11 +22,11 @@ classes, all of which inherit from ``KIMObject`` and aim to know how to handle t
 import template
 import shutil
 import subprocess
-import dircache
 import glob
 import os
 from packaging import version
 from contextlib import contextmanager
+from collections import OrderedDict
 
 import database
 import kimapi
@@ -37,6 +37,45 @@ from config import __kim_api_version_spec__
 from logger import logging
 logger = logging.getLogger("pipeline").getChild("kimobjects")
 
+#------------------------------------------------
+# kimspec cache
+#------------------------------------------------
+class KimspecCache(object):
+    """ A process wide, size bounded LRU of parsed kimspec files
+
+    Entries are keyed by path and remembered along with the (mtime, size)
+    of the file when it was read, so a changed file is parsed again on its
+    next access.  The parsed dicts are shared between callers and must not
+    be modified.
+    """
+    def __init__(self, size=None):
+        self.size = size or cf.KIMSPEC_CACHE_SIZE
+        self.entries = OrderedDict()
+
+    def get(self, path):
+        """ The parsed contents of the kimspec at path, or None if missing """
+        try:
+            st = os.stat(path)
+        except OSError:
+            self.entries.pop(path, None)
+            return None
+
+        stamp = (st.st_mtime, st.st_size)
+        entry = self.entries.pop(path, None)
+        if entry is None or entry[0] != stamp:
+            with open(path) as f:
+                entry = (stamp, cf.loadedn(f))
+
+        self.entries[path] = entry
+        while len(self.entries) > self.size:
+            self.entries.popitem(last=False)
+        return entry[1]
+
+    def clear(self):
+        self.entries.clear()
+
+kimspec_cache = KimspecCache()
+
 #------------------------------------------------
 # Base KIMObject
 #------------------------------------------------
@@ -253,13 +292,7 @@ class KIMObject(object):
     def all(cls):
         """ Return a generator of all of this type """
         logger.debug("Attempting to find all %r...", cls.__name__)
-        type_dir = os.path.join(cf.KIM_REPOSITORY_DIR, cls.required_leader.lower() )
-        kim_codes = (
-            subpath for subpath in dircache.listdir(type_dir) if (
-                os.path.isdir(os.path.join(type_dir, subpath)) and
-                database.iskimcode(subpath)
-            )
-        )
+        kim_codes = database.repository_index().kim_codes(cls.required_leader)
         for x in kim_codes:
             try:
                 yield cls(x)
@@ -268,25 +301,21 @@ class KIMObject(object):
 
     @property
     def kimspec(self):
-        specfile = os.path.join(self.path,cf.CONFIG_FILE)
-        if not os.path.exists(specfile):
-            return None
-
-        spec = {}
-        with open(specfile) as f:
-            spec = cf.loadedn(f)
-        return spec
+        """ The parsed kimspec of this object (through ``kimspec_cache``) or None """
+        return kimspec_cache.get(os.path.join(self.path,cf.CONFIG_FILE))
 
     @property
     def kim_api_version(self):
-        if self.kimspec:
-            return self.kimspec.get("kim-api-version")
+        spec = self.kimspec
+        if spec:
+            return spec.get("kim-api-version")
         return None
 
     @property
     def pipeline_api_version(self):
-        if self.kimspec:
-            return self.kimspec.get("pipeline-api-version")
+        spec = self.kimspec
+        if spec:
+            return spec.get("pipeline-api-version")
         return None
 
     @property
@@ -351,7 +380,7 @@ class Runner(KIMObject):
     @property
     def subjects(self):
         """ Return a generator for all of the valid subjects """
-        return (subject for subject in self.subject_type.all() if kimapi.valid_match(self,subject) )
+        return ( subject for subject in kimapi.valid_matches(self, self.subject_type.all()) )
 
     def processed_infile(self,subject):
         """ Process the input file, with template, and return a file object to the result """
@@ -396,7 +425,7 @@ class Subject(KIMObject):
     @property
     def runners(self):
         """ Return a generator of the valid matching tests that match this model """
-        return ( test for test in Test.all() if kimapi.valid_match(test,self) )
+        return ( test for test in kimapi.valid_runners(self, Test.all()) )
 
 
 #===============================================
@@ -426,15 +455,16 @@ class Model(Subject):
         """ Return the model driver if there is one, otherwise None,
             currently, this tries to parse the kim file for the MODEL_DRIVER_NAME line
         """
-        if not self.kimspec or not self.kimspec.get('model-driver'):
+        spec = self.kimspec
+        if not spec or not spec.get('model-driver'):
             return None 
         else:
-            return ModelDriver(self.kimspec['model-driver'])
+            return ModelDriver(spec['model-driver'])
 
     @property
     def tests(self):
         """ Return a generator of the valid matching tests that match this model """
-        return ( test for test in Test.all() if kimapi.valid_match(test,self) )
+        return self.runners
 
     @property
     def drivers(self):
@@ -485,10 +515,11 @@ class Test(Runner):
     @property
     def test_drivers(self):
         """ Return a generator of test drivers this guy relies on """
-        if not self.kimspec or not self.kimspec.get('test-driver'):
+        spec = self.kimspec
+        if not spec or not spec.get('test-driver'):
             return None 
         else:
-            return TestDriver(self.kimspec['test-driver'])
+            return TestDriver(spec['test-driver'])
 
     def result_with_model(self, model):
         """ Get the first result with the model: model, or None """
@@ -606,7 +637,8 @@ class TestDriver(KIMObject):
     @property
     def tests(self):
         """ Return a generator of all tests using this TestDriver """
-        return ( test for test in Test.all() if self in test.drivers )
+        index = database.repository_index()
+        return ( Test(code) for code in index.driven_by("te", self.kim_code) )
 
 
 #------------------------------------------
@@ -629,7 +661,8 @@ class ModelDriver(KIMObject):
     @property
     def models(self):
         """ Return a generator of all of the models using this model driver """
-        return ( model for model in Model.all() if self==model.model_driver )
+        index = database.repository_index()
+        return ( Model(code) for code in index.driven_by("mo", self.kim_code) )
 
 #------------------------------------------
 # VirtualMachine
@@ -1,23 +1,175 @@
+"""
+Queries to the OpenKIM websites: query.openkim.org (mongo), the datomic
+api and the property validator
+
+All of them go through a single ``QueryClient`` per process, which keeps
+the connections to each server open between queries, asks for gzipped
+responses, and retries failed requests with an exponential backoff.  The
+module level functions are thin wrappers over that shared client.
+"""
+import time
+import gzip
+import socket
 import urllib
-import urllib2
+import httplib
+import urlparse
 import itertools
-from config import PipelineQueryError
+import threading
+import StringIO
 import json
 import os
 
+import config as cf
+from config import PipelineQueryError
+from logger import logging
+logger = logging.getLogger("pipeline").getChild("kimquery")
+
+USER_AGENT = "OpenKIM Pipeline (http://pipeline.openkim.org/)"
+
+_dns_prepared = False
+
 def prepare_dns():
+    """ Make sure the local resolver is used, once per process """
+    global _dns_prepared
+    if _dns_prepared:
+        return
+
     resolv = "/etc/resolv.conf"
     dnsline = "nameserver 127.0.0.1"
     if not open(resolv).read().startswith(dnsline):
         os.system("sudo sed -i '1i"+dnsline+"' "+resolv)
+    _dns_prepared = True
+
+class _RetryableError(Exception):
+    """ A response from the server worth asking again for """
+
+class _StaleConnection(Exception):
+    """ A pooled connection that the server has closed since its last use """
+
+class QueryClient(object):
+    """
+    An HTTP client keeping a pool of keep-alive connections per server
+
+    Connections are taken from the pool for a request and returned to it
+    once the response has been read, unless the server asked to close
+    it.  A request that fails on a pooled connection, which the server may
+    have closed while it was idle, is sent again at once on a new one.
+    Otherwise a request that fails with a network error or a 5xx response
+    is retried up to ``retries`` times, waiting ``backoff`` seconds before
+    the first retry and doubling each time after.  After a fork the pool is
+    discarded, since the sockets belong to the parent.
+    """
+    def __init__(self, timeout=None, retries=None, backoff=None, gzip=None):
+        self.timeout = cf.QUERY_TIMEOUT if timeout is None else timeout
+        self.retries = cf.QUERY_RETRIES if retries is None else retries
+        self.backoff = cf.QUERY_BACKOFF if backoff is None else backoff
+        self.gzip = cf.QUERY_GZIP if gzip is None else gzip
+        self.lock = threading.Lock()
+        self._pool = {}
+        self._pid = os.getpid()
+
+    @property
+    def pool(self):
+        if self._pid != os.getpid():
+            self._pid = os.getpid()
+            self._pool = {}
+        return self._pool
+
+    def _connection(self, server, fresh=False):
+        """ A connection to (scheme, host, port), from the pool if one is
+            idle and not fresh, along with whether it was """
+        if not fresh:
+            with self.lock:
+                idle = self.pool.get(server)
+                if idle:
+                    return idle.pop(), True
+
+        scheme, host, port = server
+        if scheme == "https":
+            return httplib.HTTPSConnection(host, port, timeout=self.timeout), False
+        return httplib.HTTPConnection(host, port, timeout=self.timeout), False
+
+    def _release(self, server, conn):
+        with self.lock:
+            self.pool.setdefault(server, []).append(conn)
+
+    def close(self):
+        """ Close all of the idle connections """
+        with self.lock:
+            for conns in self.pool.itervalues():
+                for conn in conns:
+                    conn.close()
+            self.pool.clear()
+
+    def _request(self, server, path, data, headers, fresh=False):
+        conn, pooled = self._connection(server, fresh)
+        try:
+            conn.request("POST", path, data, headers)
+            response = conn.getresponse()
+            answer = response.read()
+        except (socket.error, httplib.HTTPException) as e:
+            conn.close()
+            if pooled:
+                raise _StaleConnection("%r" % e)
+            raise _RetryableError("%r" % e)
+
+        if response.will_close:
+            conn.close()
+        else:
+            self._release(server, conn)
+
+        if response.getheader("content-encoding", "") == "gzip":
+            answer = gzip.GzipFile(fileobj=StringIO.StringIO(answer)).read()
+
+        if response.status >= 500:
+            raise _RetryableError("HTTP %i %s" % (response.status, response.reason))
+        if response.status >= 400:
+            raise PipelineQueryError("HTTP %i %s from %s%s: %s" % (
+                response.status, response.reason, server[1], path, answer[:200]))
+        return answer
+
+    def post(self, url, data, content_type="application/x-www-form-urlencoded"):
+        """ POST data to url, returning the body of the response """
+        prepare_dns()
+
+        parts = urlparse.urlsplit(url)
+        port = parts.port or (443 if parts.scheme == "https" else 80)
+        server = (parts.scheme, parts.hostname, port)
+        path = parts.path or "/"
+        if parts.query:
+            path += "?" + parts.query
+
+        headers = {"User-Agent": USER_AGENT, "Content-type": content_type}
+        if self.gzip:
+            headers["Accept-Encoding"] = "gzip"
+
+        delay = self.backoff
+        for attempt in xrange(self.retries+1):
+            try:
+                try:
+                    return self._request(server, path, data, headers)
+                except _StaleConnection as e:
+                    logger.debug("Pooled connection to %s failed (%s), reconnecting", url, e)
+                    return self._request(server, path, data, headers, fresh=True)
+            except _RetryableError as e:
+                if attempt == self.retries:
+                    raise PipelineQueryError("Query to %s failed after %i attempts: %s" % (
+                        url, attempt+1, e))
+                logger.warning("Query to %s failed (%s), retrying in %r seconds", url, e, delay)
+                time.sleep(delay)
+                delay *= 2
+
+_client = None
+
+def client():
+    """ The process wide ``QueryClient``, created on first use """
+    global _client
+    if _client is None:
+        _client = QueryClient()
+    return _client
 
 def query_datomic(querydata, queryrules="", keys=None):
-    # set up the globals for how to interact with the website
-    prepare_dns()
-
     url = 'http://openkim.org:3000/api/query'
-    user_agent = "OpenKIM Pipeline (http://pipeline.openkim.org/)"
-    header = {'User-Agent' : user_agent, "Content-type": "application/x-www-form-urlencoded"}
 
     # build our actual query
     values = {"querydata": querydata}
@@ -25,11 +177,7 @@ def query_datomic(querydata, queryrules="", keys=None):
         values["queryrules"] = queryrules
 
     # encode, send, and read the response
-    data = urllib.urlencode(values)
-    request  = urllib2.Request(url, data, header)
-    response = urllib2.urlopen(request)
-    answer = response.read()
-    response.close()
+    answer = client().post(url, urllib.urlencode(values))
 
     if not answer:
         raise PipelineQueryError("No response")
@@ -42,17 +190,9 @@ def query_datomic(querydata, queryrules="", keys=None):
     return arr
 
 def query_mongo(query, url="", decode=False):
-    # set up the globals for how to interact with the website
-    prepare_dns()
-
     url = url or 'https://query.openkim.org/api'
-    user_agent = "OpenKIM Pipeline (http://pipeline.openkim.org/)"
-    header = {'User-Agent' : user_agent, "Content-type": "application/x-www-form-urlencoded"}
     data = urllib.urlencode(dict((key,json.dumps(val)) for (key,val) in query.iteritems()))
-    request  = urllib2.Request(url, data, header)
-    response = urllib2.urlopen(request)
-    answer = response.read()
-    response.close()
+    answer = client().post(url, data)
 
     if not answer:
         raise PipelineQueryError("No response")
@@ -63,21 +203,13 @@ def query_mongo(query, url="", decode=False):
         raise PipelineQueryError("Error received: %r" % check['error'])
 
     if decode:
-        return json.loads(answer)
+        return check
     return answer
 
 def query_property_validator(filename, url=""):
-    prepare_dns()
-
     url = url or "http://pipeline.openkim.org:5005/"
-    user_agent = "OpenKIM Pipeline (http://pipeline.openkim.org/)"
-    header = {'User-Agent' : user_agent, "Content-type": "application/x-www-form-urlencoded"}
-    #data = urllib.urlencode(open(filename).read())
-    data = open(filename).read()
-    request  = urllib2.Request(url, data, header)
-    response = urllib2.urlopen(request)
-    answer = response.read()
-    response.close()
+    with open(filename) as f:
+        answer = client().post(url, f.read())
 
     if not answer:
         raise PipelineQueryError("No response")
@@ -1,12 +1,23 @@
 #! /usr/bin/env python
-""" Simple wrapper for udunits2-bin for converting arbitrary units to SI units """
-VERSION = 0.3
+""" Conversion of arbitrary units to SI units, either natively or by wrapping
+    the units, udunits2 and cfunits-python tools """
+VERSION = 0.4
 
+import os
 import re
+import math
+import time
+import sqlite3
 import subprocess
 import warnings
 warnings.simplefilter("ignore")
 
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+import config as cf
 from logger import logging
 logger = logging.getLogger("pipeline").getChild("kimunits")
 logger.setLevel(logging.DEBUG)
@@ -123,35 +134,395 @@ def convert_cfunits(from_value, from_unit, wanted_unit=None, suppress_unit=False
         return out[0]
     return out
 
+#==========================================
+# native conversion
+#==========================================
+# SI base dimensions, in the order GNU units prints them
+BASE_UNITS = ('A', 'K', 'cd', 'kg', 'm', 'mol', 's')
+DIMENSIONLESS = (0,)*len(BASE_UNITS)
+
+def _dims(**powers):
+    return tuple( powers.get(base, 0) for base in BASE_UNITS )
+
+_A, _K, _cd, _kg, _m, _mol, _s = [ _dims(**{base: 1}) for base in BASE_UNITS ]
+
+def _mul(*dims):
+    return tuple( sum(d) for d in zip(*dims) )
+
+def _pow(dims, n):
+    return tuple( d*n for d in dims )
+
+_N  = _mul(_kg, _m, _pow(_s, -2))
+_J  = _mul(_N, _m)
+_C  = _mul(_A, _s)
+
+# name: (factor to SI, dimensions)
+UNITS = {
+    '1': (1., DIMENSIONLESS),
+    # base units
+    'm': (1., _m), 'kg': (1., _kg), 's': (1., _s), 'A': (1., _A),
+    'K': (1., _K), 'mol': (1., _mol), 'cd': (1., _cd),
+    # length
+    'angstrom': (1e-10, _m), 'Angstrom': (1e-10, _m), 'bohr': (0.52917721067e-10, _m),
+    'inch': (0.0254, _m), 'in': (0.0254, _m), 'ft': (0.3048, _m),
+    'foot': (0.3048, _m), 'meter': (1., _m), 'metre': (1., _m),
+    # mass
+    'g': (1e-3, _kg), 'gram': (1e-3, _kg), 'amu': (1.660539040e-27, _kg),
+    'u': (1.660539040e-27, _kg), 'dalton': (1.660539040e-27, _kg),
+    'Da': (1.660539040e-27, _kg), 'lb': (0.45359237, _kg),
+    # time
+    'second': (1., _s), 'sec': (1., _s), 'min': (60., _s),
+    'minute': (60., _s), 'hr': (3600., _s), 'hour': (3600., _s),
+    'day': (86400., _s), 'Hz': (1., _pow(_s, -1)),
+    # energy and force
+    'J': (1., _J), 'eV': (1.6021766208e-19, _J), 'erg': (1e-7, _J),
+    'cal': (4.184, _J), 'hartree': (4.359744650e-18, _J),
+    'Hartree': (4.359744650e-18, _J), 'Ha': (4.359744650e-18, _J),
+    'rydberg': (2.179872325e-18, _J), 'Ry': (2.179872325e-18, _J),
+    'N': (1., _N), 'dyn': (1e-5, _N), 'W': (1., _mul(_J, _pow(_s, -1))),
+    # pressure
+    'Pa': (1., _mul(_N, _pow(_m, -2))), 'bar': (1e5, _mul(_N, _pow(_m, -2))),
+    'atm': (101325., _mul(_N, _pow(_m, -2))),
+    'torr': (101325./760, _mul(_N, _pow(_m, -2))),
+    'psi': (6894.757293168361, _mul(_N, _pow(_m, -2))),
+    # electromagnetism
+    'C': (1., _C), 'e': (1.6021766208e-19, _C), 'V': (1., _mul(_J, _pow(_C, -1))),
+    'ohm': (1., _mul(_J, _pow(_C, -1), _pow(_A, -1))),
+    'T': (1., _mul(_kg, _pow(_s, -2), _pow(_A, -1))),
+    # amounts and angles, which GNU units treats as dimensionless
+    'radian': (1., DIMENSIONLESS), 'rad': (1., DIMENSIONLESS),
+    'degree': (math.pi/180, DIMENSIONLESS), 'deg': (math.pi/180, DIMENSIONLESS),
+    'sr': (1., DIMENSIONLESS), 'percent': (0.01, DIMENSIONLESS),
+    # temperature differences, only absolute when standing alone, see AFFINE
+    'kelvin': (1., _K), 'degC': (1., _K), 'celsius': (1., _K),
+    'degF': (5./9, _K), 'fahrenheit': (5./9, _K), 'degR': (5./9, _K),
+    'rankine': (5./9, _K),
+}
+
+# units with a zero that is not the SI zero: name -> offset in SI units,
+# applied only when the unit is the whole unit string, as udunits2 does
+AFFINE = {
+    'degC': 273.15, 'celsius': 273.15,
+    'degF': 459.67*5/9, 'fahrenheit': 459.67*5/9,
+}
+
+PREFIXES = {
+    'Y': 1e24, 'Z': 1e21, 'E': 1e18, 'P': 1e15, 'T': 1e12, 'G': 1e9,
+    'M': 1e6, 'k': 1e3, 'h': 1e2, 'da': 1e1, 'd': 1e-1, 'c': 1e-2,
+    'm': 1e-3, 'u': 1e-6, 'n': 1e-9, 'p': 1e-12, 'f': 1e-15, 'a': 1e-18,
+    'z': 1e-21, 'y': 1e-24,
+}
+
+_unit_token = re.compile(r"""\s*(?:
+     (?P<number>(?:\d+(?:\.\d*)?|\.\d+)(?:[eE][-+]?\d+)?)
+    |(?P<name>[A-Za-z_]+)
+    |(?P<op>\*\*|[*/^()+-])
+    )""", re.VERBOSE)
+
+def _lookup(name):
+    """ Factor and dimensions of a single, possibly prefixed, unit name """
+    if name in UNITS:
+        return UNITS[name]
+    for prefix in sorted(PREFIXES, key=len, reverse=True):
+        if name.startswith(prefix) and name[len(prefix):] in UNITS:
+            factor, dims = UNITS[name[len(prefix):]]
+            return PREFIXES[prefix]*factor, dims
+    raise UnitConversion("Unknown unit %r" % name)
+
+class _UnitParser(object):
+    """ Recursive descent parser for unit strings such as ``eV/angstrom^3``
+        or ``kg m^2 / s^2``.  As in GNU units, multiplication by a space
+        binds tighter than ``*`` and ``/``, so ``kg / m s^2`` is kg/(m s^2).
+        A unit name directly followed by an integer (``m2``, ``s-1``) is
+        raised to that power. """
+
+    def __init__(self, text):
+        self.text = text
+        self.tokens = []
+        pos = 0
+        text = text.strip()
+        while pos < len(text):
+            m = _unit_token.match(text, pos)
+            if m is None or m.end() == pos:
+                raise UnitConversion("Could not parse unit %r" % self.text)
+            self.tokens.append((m.lastgroup, m.group(m.lastgroup)))
+            pos = m.end()
+            # a name immediately followed by an integer is an exponent
+            if m.lastgroup == 'name':
+                e = re.match(r"[-+]?\d+(?![.\deE])", text[pos:])
+                if e:
+                    self.tokens.append(('op', '^'))
+                    self.tokens.append(('number', e.group()))
+                    pos += e.end()
+        self.pos = 0
+
+    def peek(self):
+        return self.tokens[self.pos] if self.pos < len(self.tokens) else (None, None)
+
+    def next(self):
+        tok = self.peek()
+        self.pos += 1
+        return tok
+
+    def parse(self):
+        if not self.tokens:
+            raise UnitConversion("Empty unit")
+        out = self.expression()
+        if self.pos != len(self.tokens):
+            raise UnitConversion("Could not parse unit %r" % self.text)
+        return out
+
+    def expression(self):
+        factor, dims = self.product()
+        while self.peek() in (('op', '*'), ('op', '/')):
+            op = self.next()[1]
+            f, d = self.product()
+            if op == '/':
+                f, d = 1./f, _pow(d, -1)
+            factor, dims = factor*f, _mul(dims, d)
+        return factor, dims
+
+    def product(self):
+        factor, dims = self.power()
+        while self.peek()[0] in ('number', 'name') or self.peek() == ('op', '('):
+            f, d = self.power()
+            factor, dims = factor*f, _mul(dims, d)
+        return factor, dims
+
+    def power(self):
+        factor, dims = self.atom()
+        if self.peek() in (('op', '^'), ('op', '**')):
+            self.next()
+            n = self.exponent()
+            factor, dims = factor**n, _pow(dims, n)
+        return factor, dims
+
+    def exponent(self):
+        kind, text = self.next()
+        if (kind, text) == ('op', '('):
+            n = self.exponent()
+            if self.next() != ('op', ')'):
+                raise UnitConversion("Unbalanced parentheses in %r" % self.text)
+            return n
+        sign = 1
+        if (kind, text) in (('op', '-'), ('op', '+')):
+            sign = -1 if text == '-' else 1
+            kind, text = self.next()
+        if kind != 'number':
+            raise UnitConversion("Bad exponent in unit %r" % self.text)
+        n = float(text)
+        return sign*(int(n) if n == int(n) else n)
+
+    def atom(self):
+        kind, text = self.next()
+        if kind == 'number':
+            return float(text), DIMENSIONLESS
+        if kind == 'name':
+            return _lookup(text)
+        if (kind, text) == ('op', '('):
+            out = self.expression()
+            if self.next() != ('op', ')'):
+                raise UnitConversion("Unbalanced parentheses in %r" % self.text)
+            return out
+        raise UnitConversion("Could not parse unit %r" % self.text)
+
+_parsed = {}
+
+def parse_unit(unit):
+    """ The (factor, dimensions, offset) of a unit string, such that a
+        value v in that unit is v*factor + offset in SI units """
+    unit = str(unit).strip()
+    if unit not in _parsed:
+        if unit in AFFINE:
+            factor, dims = UNITS[unit]
+            _parsed[unit] = (factor, dims, AFFINE[unit])
+        else:
+            factor, dims = _UnitParser(unit).parse()
+            _parsed[unit] = (factor, dims, 0.)
+    return _parsed[unit]
+
+def si_unit_name(dims):
+    """ The SI unit of some dimensions, written as GNU units would """
+    def term(base, n):
+        n = abs(n)
+        n = int(n) if n == int(n) else n
+        return base if n == 1 else "%s^%s" % (base, n)
+    num = [ term(b, n) for b, n in zip(BASE_UNITS, dims) if n > 0 ]
+    den = [ term(b, n) for b, n in zip(BASE_UNITS, dims) if n < 0 ]
+    if not num and not den:
+        return '1'
+    out = " ".join(num) if num else "1"
+    if den:
+        out += " / " + " ".join(den)
+    return out
+
+_conversions = {}
+
+def conversion(from_unit, wanted_unit=None):
+    """ The (scale, offset, unit) taking a value in from_unit to a value
+        scale*value + offset in wanted_unit, by default the SI unit """
+    key = (str(from_unit), wanted_unit)
+    if key not in _conversions:
+        factor, dims, offset = parse_unit(from_unit)
+        if wanted_unit:
+            w_factor, w_dims, w_offset = parse_unit(wanted_unit)
+            if w_dims != dims:
+                raise UnitConversion("Incompatible units %s and %s" % (from_unit, wanted_unit))
+            out = (factor/w_factor, (offset - w_offset)/w_factor, wanted_unit)
+        else:
+            out = (factor, offset, si_unit_name(dims))
+        _conversions[key] = out
+    return _conversions[key]
+
+def convert_native(from_value, from_unit, wanted_unit=None, suppress_unit=False):
+    """ Convert with the in-process unit tables, no external tools """
+    scale, offset, unit = conversion(from_unit, wanted_unit)
+    out = (float(from_value)*scale + offset, unit)
+    if suppress_unit:
+        return out[0]
+    return out
+
+def factors(from_unit, wanted_unit=None):
+    """ The (scale, offset, unit) of a conversion from the native tables,
+        asking GNU units through the ``ConversionCache`` for the units that
+        they do not know """
+    try:
+        return conversion(from_unit, wanted_unit)
+    except UnitConversion as e:
+        logger.debug("Native conversion of %r failed (%s), trying units", from_unit, e)
+        try:
+            return conversion_cache().get(convert_units, from_unit, wanted_unit)
+        except OSError:
+            raise e
+
+def convert_auto(from_value, from_unit, wanted_unit=None, suppress_unit=False):
+    """ Convert natively where possible, otherwise with GNU units """
+    scale, offset, unit = factors(from_unit, wanted_unit)
+    out = (float(from_value)*scale + offset, unit)
+    if suppress_unit:
+        return out[0]
+    return out
+
 #Set default behavior
-convert = convert_units
+convert = convert_auto
+
+#==========================================
+# conversion factors of external backends
+#==========================================
+UNIT_SCHEMA = """
+CREATE TABLE IF NOT EXISTS factors (
+    backend TEXT, from_unit TEXT, to_unit TEXT,
+    scale REAL, offset REAL, unit TEXT, used REAL,
+    PRIMARY KEY (backend, from_unit, to_unit)
+);
+"""
+
+class ConversionCache(object):
+    """ A persistent table of (scale, offset, unit) per conversion
+
+    The external backends are asked once for the images of 1 and 2 in a
+    unit, from which every other value follows.  The answers are kept in
+    ``UNIT_CACHE_FILE`` next to the repository so that all of the workers on
+    a box share them, holding at most ``UNIT_CACHE_SIZE`` of the most
+    recently used conversions.  If the file can't be used they are kept in
+    memory for the life of the process.
+    """
+    def __init__(self, dbfile=None, size=None):
+        self._dbfile = dbfile
+        self.size = size or cf.UNIT_CACHE_SIZE
+        self._db = None
+        self._pid = None
+        self.factors = {}
+
+    @property
+    def dbfile(self):
+        return self._dbfile or os.path.join(cf.KIM_REPOSITORY_DIR, cf.UNIT_CACHE_FILE)
+
+    @property
+    def db(self):
+        """ The connection to the cache file, or to one in memory if it
+            can't be used, reopened after a fork """
+        if self._pid != os.getpid():
+            self._pid = os.getpid()
+            try:
+                self._db = self._connect(self.dbfile)
+            except sqlite3.Error as e:
+                logger.warning("Could not use unit cache %r: %r", self.dbfile, e)
+                self._db = self._connect(":memory:")
+        return self._db
+
+    def _connect(self, dbfile):
+        db = sqlite3.connect(dbfile, timeout=60)
+        db.text_factory = str
+        db.executescript(UNIT_SCHEMA)
+        return db
+
+    def get(self, convert, from_unit, to_unit=None):
+        """ The (scale, offset, unit) of a conversion through the backend
+            function convert, running it only if no worker has before """
+        key = (convert.__name__, str(from_unit), to_unit or '')
+        if key not in self.factors:
+            db = self.db
+            row = db.execute("SELECT scale, offset, unit FROM factors WHERE "
+                    "backend=? AND from_unit=? AND to_unit=?", key).fetchone()
+            with db:
+                if row:
+                    db.execute("UPDATE factors SET used=? WHERE "
+                        "backend=? AND from_unit=? AND to_unit=?", (time.time(),) + key)
+                else:
+                    # not at 0, which udunits2 and cfunits take to be 0
+                    one, unit = convert(1., from_unit, to_unit)
+                    two, unit = convert(2., from_unit, to_unit)
+                    row = (two - one, 2*one - two, unit)
+                    db.execute("INSERT OR REPLACE INTO factors VALUES (?,?,?,?,?,?,?)",
+                        key + row + (time.time(),))
+                    db.execute("DELETE FROM factors WHERE rowid NOT IN "
+                        "(SELECT rowid FROM factors ORDER BY used DESC LIMIT ?)", (self.size,))
+            self.factors[key] = tuple(row)
+        return self.factors[key]
+
+_conversion_cache = None
+
+def conversion_cache():
+    """ The process wide ``ConversionCache``, created on first use """
+    global _conversion_cache
+    if _conversion_cache is None:
+        _conversion_cache = ConversionCache()
+    return _conversion_cache
+
+def _convert_linear( x, scale, offset ):
+    """ Apply value*scale + offset over a number, list or list of lists,
+        converting rectangular numeric lists as a single array """
+    if isinstance(x, (list,tuple)):
+        if numpy is not None and x:
+            arr = numpy.asarray(x)
+            if arr.dtype.kind in 'iuf':
+                out = (arr*scale + offset).tolist()
+                return out if isinstance(x, list) else type(x)(out)
+        return type(x)( _convert_linear(z, scale, offset) for z in x )
+    return float(x)*scale + offset
 
 def convert_list( x , from_unit, to_unit=None, convert=convert):
     """ Thread conversion over a list, or list of lists """
-    # Need a list for scoping reasons
     logger.debug("Attempting to convert <%r> from <%r> to <%r>.", x, from_unit, to_unit)
-    known_out = [None]
 
     # Constant shortcut
     if from_unit in ( 1, 1.0, '1' ):
-        known_out[0] = '1'
+        scale, offset, unit = 1., 0., '1'
 
-    def convert_inner( x ):
-        if isinstance(x, (list,tuple)):
-            return type(x)( convert_inner(z) for z in x )
-        else:
-            if known_out[0] == '1':
-                return float(x)
-            elif known_out[0]:
-                out = convert( x, from_unit, to_unit, suppress_unit=True )
-                return out
-            else:
-                out = convert( x, from_unit, to_unit )
-                known_out[0] = out[1]
-                return float(out[0])
-    output = convert_inner(x)
-    logger.debug("Obtained %r <%r> = %r <%r>.", x, from_unit, output, known_out[0])
-    return ( output, known_out[0] )
+    # The native engine gives us the conversion once for the whole list
+    elif convert is convert_native:
+        scale, offset, unit = conversion(from_unit, to_unit)
+    elif convert is convert_auto:
+        scale, offset, unit = factors(from_unit, to_unit)
+
+    # and the others do once per box
+    else:
+        scale, offset, unit = conversion_cache().get(convert, from_unit, to_unit)
+
+    output = _convert_linear(x, scale, offset)
+    logger.debug("Obtained %r <%r> = %r <%r>.", x, from_unit, output, unit)
+    return ( output, unit )
 
 
 def add_si_units(doc, convert=convert):
@@ -177,10 +548,10 @@ def add_si_units(doc, convert=convert):
             return doc
         else:
             # recurse
-            return type(doc)( (key, add_si_units(value)) for key,value in doc.iteritems() )
+            return type(doc)( (key, add_si_units(value, convert)) for key,value in doc.iteritems() )
 
     if isinstance(doc, (list,tuple)):
-        return type(doc)( add_si_units(x) for x in doc )
+        return type(doc)( add_si_units(x, convert) for x in doc )
 
     return doc
 
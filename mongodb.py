@@ -200,6 +200,21 @@ def deprecate_similar_objects(dbname, info, keys):
     if status['n'] > 0:
         logger.info("Updated %i existing documents to deprecated" % status['n'])
 
+def insert_documents(flname, leader, kimcode):
+    """ Insert the documents of an edn file as they are read, removing the
+        ones inserted again if the file is malformed part way through, so
+        that a file is stored whole or not at all.  Returns the last """
+    ids, stuff = [], None
+    try:
+        for doc in cf.iter_edn_documents(flname):
+            stuff = doc_to_dict(doc,leader,kimcode)
+            ids.append(db.data.insert(stuff))
+    except:
+        if ids:
+            db.data.remove({"_id": {"$in": ids}})
+        raise
+    return stuff
+
 def insert_one_object(kimcode):
     logger.info("Inserting object %s", kimcode)
     info = kimcode_to_dict(kimcode)
@@ -220,12 +235,8 @@ def insert_one_result(leader, kimcode):
         logger.error("Aready have %s", kimcode)
         return
     try:
-        with open(os.path.join(PATH_RESULT,leader,kimcode,'results.edn')) as f:
-            edn_docs = cf.loadedn(f)
-            edn_docs = edn_docs if isinstance(edn_docs, list) else [edn_docs]
-            for doc in edn_docs:
-                stuff = doc_to_dict(doc,leader,kimcode)
-                db.data.insert(stuff)
+        flname = os.path.join(PATH_RESULT,leader,kimcode,'results.edn')
+        stuff = insert_documents(flname, leader, kimcode)
         deprecate_similar_objects('data', stuff, ['meta.runner.kimcode', 'meta.subject.kimcode'])
     except:
         logger.info("Could not read document for %s/%s", leader, kimcode)
@@ -242,12 +253,8 @@ def insert_one_reference_data(leader, kimcode):
         logger.error("Aready have %s", kimcode)
         return
     try:
-        with open(os.path.join(PATH_APPROVED,leader,kimcode,kimcode+'.edn')) as f:
-            edn_docs = cf.loadedn(f)
-            edn_docs = edn_docs if isinstance(edn_docs, list) else [edn_docs]
-            for doc in edn_docs:
-                stuff = doc_to_dict(doc,leader,kimcode)
-                db.data.insert(stuff)
+        flname = os.path.join(PATH_APPROVED,leader,kimcode,kimcode+'.edn')
+        insert_documents(flname, leader, kimcode)
     except:
         logger.info("Could not read document for %s/%s", leader, kimcode)
         stuff = doc_to_dict({}, leader, kimcode)
@@ -66,8 +66,8 @@ class BeanstalkConnection(object):
         for tube in tubes:
             self.bsd.watch(tube)
 
-    def reserve(self):
-        return self.bsd.reserve()
+    def reserve(self, timeout=None):
+        return self.bsd.reserve(timeout=timeout)
 
 
 #==================================================================
@@ -188,6 +188,10 @@ class Agent(object):
         self.bean.send_msg(tube, msg)
         self.comm.send_msg(tube, msg)
 
+        # jobs of a wave plan also report straight back to the director
+        if jobmsg.wave and tube in (cf.TUBE_RESULTS, cf.TUBE_ERRORS):
+            self.bean.send_msg(cf.TUBE_WAVES, simplejson.dumps([tube, msg]))
+
     def make_all(self):
         self.logger.debug("Building everything...")
         with kimapi.in_api_dir():
@@ -212,12 +216,64 @@ class Agent(object):
 #==================================================================
 # director class for the pipeline
 #==================================================================
+def pairkey(pair):
+    return tuple(str(item) for item in pair)
+
+class WavePlan(object):
+    """ The waves of (test, model) pairs from ``dependencies.wave_plan``
+    that the Director is running one after another.  Pairs of a wave that
+    another plan is already running are not run again, but are waited for
+    in ``external`` before the wave after them is sent.  Along with the
+    waves left are the jobs of the current wave still running, the pairs
+    of it still waited for from other plans, the pairs of it that are done
+    and every pair of the plan that has finished, and the time by which the
+    jobs of the current wave have to report back.  Pairs without a priority
+    of their own, the dependencies pulled in, run at that of the plan """
+    def __init__(self, waves, external, priority, status, priorities=None):
+        self.waves = waves
+        self.external = external
+        self.priority = priority
+        self.priorities = priorities or {}
+        self.status = status
+        self.pairs = set(pairkey(pair) for wave in waves for pair in wave)
+        self.running = {}
+        self.waiting = set()
+        self.done = []
+        self.finished = set()
+        self.since = None
+        self.deadline = None
+
+    def needs(self, keys):
+        """ Whether any of the pairs (as keys) is one this plan waits for """
+        later = set(pairkey(pair) for wave in self.external for pair in wave)
+        return bool(keys & (self.waiting | later))
+
+    def priority_of(self, pair):
+        return self.priorities.get(pairkey(pair), self.priority)
+
+    def settle(self):
+        """ Note when the current wave has finished, if it has """
+        if not self.running and not self.waiting and self.since is None:
+            self.since = time.time()
+
 class Director(Agent):
     """ The Director object, knows to listen to incoming jobs, computes dependencies
     and passes them along to workers
+
+    A chain of runtime dependencies is planned as waves of pairs, each of
+    which can run once the one before it has.  The first wave is sent out
+    at once, and as the jobs of a wave report back on ``TUBE_WAVES`` and
+    their results show up in the database the next is sent, rather than
+    waiting for each result to come back through the website as an update.
+    Results that have not shown up when the jobs report back are looked
+    for again every ``WAVE_POLL_INTERVAL`` seconds, and a plan whose jobs
+    have not reported back within ``PIPELINE_JOB_TIMEOUT`` is given up on.
     """
     def __init__(self, num=0, *args, **kwargs):
         super(Director, self).__init__(name="director", num=num, *args, **kwargs)
+        self.plans = []
+        self.scheduled = {}
+        self.next_poll = 0
 
     def run(self):
         """
@@ -235,11 +291,14 @@ class Director(Agent):
         """
         # connect and grab the job thread
         self.connect()
-        self.bean.watch(cf.TUBE_UPDATES)
+        self.bean.watch(cf.TUBE_UPDATES, cf.TUBE_WAVES)
 
         while True:
             self.logger.info("Director Waiting for message...")
-            request = self.bean.reserve()
+            request = self.bean.reserve(timeout=cf.WAVE_POLL_INTERVAL if self.plans else None)
+            if request is None:
+                self.advance_waves()
+                continue
             self.job = request
 
             # make sure it doesn't come alive again soon
@@ -255,8 +314,17 @@ class Director(Agent):
                 except Exception as e:
                     self.logger.exception("Director had an error on update")
 
+            # a job of one of our wave plans has finished
+            elif request.stats()['tube'] == cf.TUBE_WAVES:
+                try:
+                    tube, body = simplejson.loads(request.body)
+                    self.advance_waves(self.wave_job_done(tube, network.Message(string=body)))
+                except Exception as e:
+                    self.logger.exception("Director had an error on a wave result")
+
             request.delete()
             self.job = None
+            self.advance_waves()
 
     def priority_to_number(self,priority):
         priorities = {"immediate": 0, "very high": 0.01, "high": 0.1,
@@ -275,7 +343,7 @@ class Director(Agent):
 
         if database.isuuid(kimid):
             priority = int(priority_factor*1000000)
-            self.check_dependencies_and_push(kimid, priority, status)
+            self.check_dependencies_and_push([kimid], priority, status)
             return
 
         name,leader,num,version = database.parse_kim_code(kimid)
@@ -296,6 +364,7 @@ class Director(Agent):
                 if leader=="TE":
                     # for all of the models, add a job
                     test = kimobjects.Test(kimid)
+                    dependencies.dependency_graph().update(test)
                     models = list(test.models)
                     tests = [test]*ll(models)
                 elif leader=="MO":
@@ -309,10 +378,11 @@ class Director(Agent):
                     # corresponding jobs
                     driver = kimobjects.TestDriver(kimid)
                     temp_tests = list(driver.tests)
+                    all_models = list(kimobjects.Model.all())
                     models = []
                     tests = []
                     for t in temp_tests:
-                        tmodels = list(t.models)
+                        tmodels = kimapi.valid_matches(t, all_models)
                         if len(tmodels) > 0:
                             models.extend(tmodels)
                             tests.extend([t]*ll(tmodels))
@@ -322,10 +392,11 @@ class Director(Agent):
                     # that rely on it and recompute their results
                     driver = kimobjects.ModelDriver(kimid)
                     temp_models = list(driver.models)
+                    all_tests = list(kimobjects.Test.all())
                     tests = []
                     models = []
                     for m in temp_models:
-                        mtests = list(m.tests)
+                        mtests = kimapi.valid_runners(m, all_tests)
                         if len(mtests) > 0:
                             tests.extend(mtests)
                             models.extend([m]*ll(mtests))
@@ -354,24 +425,147 @@ class Director(Agent):
                     self.logger.error("Tried to update an invalid KIM ID!: %r",kimid)
                 checkmatch = False
 
-        for test, model in zip(tests, models):
-            if not checkmatch or (checkmatch and kimapi.valid_match(test, model)):
-                priority = int(priority_factor*database.test_model_to_priority(test, model) * 1000000)
-                self.check_dependencies_and_push((test,model), priority, status)
+        pairs = zip(tests, models)
+        matches = kimapi.valid_match_pairs(pairs) if checkmatch else [True]*len(pairs)
+        targets = [ pair for pair, match in zip(pairs, matches) if match ]
+        if not targets:
+            return
+
+        priorities = dict( (pairkey((test, model)),
+                int(priority_factor*database.test_model_to_priority(test, model) * 1000000))
+                for test, model in targets )
+        self.check_dependencies_and_push(targets, min(priorities.values()), status, priorities)
+
+    def check_dependencies_and_push(self, targets, priority, status, priorities=None):
+        """ Check dependencies of all the targets of an update together, and
+            push them first if necessary, planning the rest of the chains to
+            run in waves after them """
+        waves = dependencies.get_wave_plan(targets)
+
+        # pairs that one of our plans is already going to run are waited for
+        own = [ [ pair for pair in wave if pairkey(pair) not in self.scheduled ]
+                for wave in waves ]
+        external = [ [ pair for pair in wave if pairkey(pair) in self.scheduled ]
+                     for wave in waves ]
+        while own and not own[-1]:
+            own.pop()
+            external.pop()
+        if not own:
+            return
 
-    def check_dependencies_and_push(self, target, priority, status):
-        """ Check dependencies, and push them first if necessary """
-        # run the test in its own directory
-        for te, mo in dependencies.get_run_list(target):
+        plan = WavePlan(own, external, priority, status, priorities)
+        self.logger.info("Planned %i waves of %i jobs", len(own), len(plan.pairs))
+        self.plans.append(plan)
+        for key in plan.pairs:
+            self.scheduled[key] = plan
+        self.submit_wave(plan)
+
+    def submit_wave(self, plan):
+        """ Send out the next wave of a plan """
+        wave, external = plan.waves.pop(0), plan.external.pop(0)
+        plan.deadline = time.time() + cf.PIPELINE_JOB_TIMEOUT
+        for te, mo in wave:
             trid = self.get_result_code()
             depids = (str(item) for item in te.dependencies + mo.dependencies)
 
-            self.logger.info("Submitting job <%s, %s, %s> priority %i" % (te, mo, trid, priority))
+            self.logger.info("Submitting job <%s, %s, %s> priority %i" % (te, mo, trid, plan.priority_of((te, mo))))
 
             msg = network.Message(job=(str(te),str(mo)), jobid=trid,
-                        depends=tuple(depids), status=status)
+                        depends=tuple(depids), status=plan.status, wave=True)
+            plan.running[trid] = (te, mo)
             self.job_message(msg, tube=cf.TUBE_JOBS)
 
+        # the results of the pairs run by other plans are needed too
+        plan.done = list(external)
+        for pair in external:
+            owner = self.scheduled.get(pairkey(pair))
+            if owner and pairkey(pair) not in owner.finished:
+                plan.waiting.add(pairkey(pair))
+        plan.settle()
+
+    def drop_plan(self, plan):
+        """ Forget a plan, along with the plans waiting on what it won't run """
+        if plan not in self.plans:
+            return
+        self.plans.remove(plan)
+        for key in plan.pairs:
+            if self.scheduled.get(key) is plan:
+                del self.scheduled[key]
+
+        lost = plan.pairs - plan.finished
+        for other in list(self.plans):
+            if other.needs(lost):
+                self.logger.error("Dropping the %i waves waiting on a dropped plan",
+                        len(other.waves))
+                self.drop_plan(other)
+
+    def wave_job_done(self, tube, jobmsg):
+        """ Note that a job of a wave has finished, on tube results or errors,
+            returning the plans whose current wave it may have finished """
+        for plan in self.plans:
+            if jobmsg.jobid in plan.running:
+                break
+        else:
+            return []
+
+        pair = plan.running.pop(jobmsg.jobid)
+        if tube == cf.TUBE_ERRORS:
+            # nothing that depends on it can run
+            self.logger.error("Job %s of a wave failed, dropping the %i waves after it",
+                    jobmsg.jobid, len(plan.waves))
+            self.drop_plan(plan)
+            return []
+
+        key = pairkey(pair)
+        plan.done.append(pair)
+        plan.finished.add(key)
+        affected = [plan] + [ other for other in self.plans if key in other.waiting ]
+        for other in affected:
+            other.waiting.discard(key)
+            other.settle()
+        return affected
+
+    def advance_waves(self, plans=None):
+        """ Send out the next wave of every plan (of those given, or of all
+            of them at most every ``WAVE_POLL_INTERVAL``) whose current wave
+            is done and whose results can be found for the next to use,
+            dropping those with jobs that were lost along the way """
+        if plans is None:
+            if time.time() < self.next_poll:
+                return
+            self.next_poll = time.time() + cf.WAVE_POLL_INTERVAL
+            plans = self.plans
+
+        for plan in list(plans):
+            if plan not in self.plans:
+                continue
+            if plan.running and time.time() > plan.deadline:
+                self.logger.error("Jobs %s of a wave never reported back, dropping the %i waves after it",
+                        ", ".join(plan.running), len(plan.waves))
+                self.drop_plan(plan)
+                continue
+            if plan.since is None:
+                continue
+            if not plan.waves:
+                self.drop_plan(plan)
+                continue
+
+            try:
+                found = dependencies.results_exist(plan.done)
+            except Exception as e:
+                self.logger.exception("Could not check the results of a wave")
+                continue
+
+            if not set(pairkey(pair) for pair in plan.done) <= found:
+                if time.time() - plan.since > cf.WAVE_SETTLE_TIMEOUT:
+                    self.logger.warning("Results of a wave never arrived, dropping the %i waves after it",
+                            len(plan.waves))
+                    self.drop_plan(plan)
+                continue
+
+            plan.since = None
+            self.submit_wave(plan)
+
 
     def get_result_code(self):
         return str(uuid.uuid1( uuid.UUID(self.boxinfo['uuid']).int >> 80 ))
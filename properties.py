@@ -0,0 +1,147 @@
+"""
+Validation of test results against the property definitions of
+openkim-properties, read from a local checkout at ``KIM_PROPERTIES_DIR``
+
+Each definition found there is compiled once per process into a checker
+holding, for every key of the property, whether it is required, whether
+it carries units, and a function testing the type and extent of its
+``source-value``.  A result, one property instance or a list of them, is
+then checked without leaving the process, giving a reply of the same
+form as the remote validator's::
+
+    [{"property-id": ..., "instance-id": 1, "valid": True, "errors": []}, ...]
+"""
+import os
+
+import config as cf
+from logger import logging
+logger = logging.getLogger("pipeline").getChild("properties")
+
+# keys of an instance which are not properties of it
+INSTANCE_KEYS = {"property-id", "instance-id", "disclaimer"}
+
+TYPES = {
+    "string": basestring,
+    "file": basestring,
+    "float": (int, long, float),
+    "int": (int, long),
+    "bool": bool,
+}
+
+def _element_checker(typename):
+    """ A function testing a single element against a property type """
+    types = TYPES[typename]
+    if typename == "bool":
+        return lambda v: isinstance(v, bool)
+    return lambda v: isinstance(v, types) and not isinstance(v, bool)
+
+def _value_checker(typename, extent):
+    """ A function testing a source-value against a type and an extent such
+        as [], [":"] or [":", 3] """
+    element = _element_checker(typename)
+    extent = tuple( None if n == ":" else int(n) for n in extent )
+
+    def check(value, extent=extent):
+        if not extent:
+            return element(value)
+        if not isinstance(value, list):
+            return False
+        if extent[0] is not None and len(value) != extent[0]:
+            return False
+        if len(extent) == 1:
+            return all(element(v) for v in value)
+        return all(check(v, extent[1:]) for v in value)
+    return check
+
+class PropertyDefinition(object):
+    def __init__(self, definition):
+        """ Compile a property definition (the parsed EDN) into a checker """
+        self.property_id = definition["property-id"]
+        self.keys = {}
+        self.required = set()
+        for key, spec in definition.iteritems():
+            if not isinstance(spec, dict):
+                continue
+            check = _value_checker(spec["type"], spec.get("extent", []))
+            self.keys[key] = (spec["type"], spec.get("has-unit", False), check)
+            if spec.get("required", False):
+                self.required.add(key)
+
+    def errors(self, instance):
+        """ The list of ways in which a property instance is invalid """
+        errors = []
+        for key in sorted(self.required - set(instance)):
+            errors.append("Missing required key %r" % key)
+
+        for key, value in instance.iteritems():
+            if key in INSTANCE_KEYS:
+                continue
+            if key not in self.keys:
+                errors.append("Key %r is not in the property definition" % key)
+                continue
+
+            typename, has_unit, check = self.keys[key]
+            if not isinstance(value, dict) or "source-value" not in value:
+                errors.append("Key %r has no source-value" % key)
+                continue
+            if has_unit and "source-unit" not in value:
+                errors.append("Key %r has no source-unit" % key)
+            if not has_unit and "source-unit" in value:
+                errors.append("Key %r has a source-unit but no units" % key)
+            if not check(value["source-value"]):
+                errors.append("Key %r does not have the type (%s) and extent "
+                        "of its definition" % (key, typename))
+        return errors
+
+_definitions = None
+
+def definitions():
+    """ The compiled definitions in the local checkout, keyed by property-id,
+        loaded on first use """
+    global _definitions
+    if _definitions is None:
+        _definitions = {}
+        for root, dirs, files in os.walk(cf.KIM_PROPERTIES_DIR):
+            for name in files:
+                if not name.endswith(".edn"):
+                    continue
+                try:
+                    doc = cf.loadedn(os.path.join(root, name))
+                    if isinstance(doc, dict) and "property-id" in doc:
+                        definition = PropertyDefinition(doc)
+                        _definitions[definition.property_id] = definition
+                except Exception as e:
+                    logger.warning("Could not load property definition %s: %r", name, e)
+        logger.debug("Loaded %i property definitions from %s",
+                len(_definitions), cf.KIM_PROPERTIES_DIR)
+    return _definitions
+
+def instances(doc):
+    return doc if isinstance(doc, list) else [doc]
+
+def unknown(doc):
+    """ The property-ids used in a result that have no local definition """
+    defs = definitions()
+    return [ inst.get("property-id") for inst in instances(doc)
+            if not isinstance(inst, dict) or inst.get("property-id") not in defs ]
+
+def validate(doc):
+    """ Check each property instance in a result, see module documentation """
+    defs = definitions()
+    reply = []
+    for inst in instances(doc):
+        if not isinstance(inst, dict):
+            reply.append({"valid": False, "errors": ["Instance is not a map"]})
+            continue
+
+        pid = inst.get("property-id")
+        if pid in defs:
+            errors = defs[pid].errors(inst)
+        else:
+            errors = ["Unknown property-id %r" % pid]
+        if not isinstance(inst.get("instance-id"), (int, long)):
+            errors.append("Missing or non-integer instance-id")
+
+        reply.append({"property-id": pid, "instance-id": inst.get("instance-id"),
+            "valid": not errors, "errors": errors})
+    return reply
@@ -9,7 +9,7 @@ logger = logging.getLogger("pipeline").getChild("rsync_tools")
 import os
 import subprocess
 import tempfile
-from database import parse_kim_code
+from database import parse_kim_code, repository_index
 from functools import partial
 
 # --delete ensures that we delete files that aren't on remote
@@ -67,6 +67,9 @@ def rsync_command(files, read=True, path=None, delete=False):
             logger.exception("RSYNC FAILED!")
             cf.RsyncRuntimeError("Rsync command failed `%s`" % cmd)
 
+    if read:
+        touch_index(files)
+
 def rsync_command_read_wildcard(files,path=None):
     """ run rsync, syncing the files (or folders) listed in files, assumed to be paths or partial
     paths from the RSYNC_LOCAL_ROOT
@@ -89,6 +92,23 @@ def rsync_command_read_wildcard(files,path=None):
             logger.exception("RSYNC FAILED!")
             cf.RsyncRuntimeError("Rsync command failed `%s`" % cmd)
 
+    touch_index(files)
+
+def touch_index(files):
+    """ Let the repository index know about the leaders and entries that
+        an rsync read may have written into """
+    touched = {}
+    for filename in files:
+        # paths are relative to the /./ marker when there is one
+        parts = filename.split("/./")[-1].strip("/").split("/")
+        entries = touched.setdefault(parts[0], set())
+        if len(parts) > 1 and parts[1]:
+            entries.add(parts[1])
+
+    index = repository_index()
+    for leader, entries in touched.iteritems():
+        index.touch(leader, entries)
+
 #======================================
 # Helper methods
 #======================================
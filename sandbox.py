@@ -0,0 +1,187 @@
+"""
+Building the temporary running directories that a ``Computation`` runs a
+test in, so that many jobs can run out of the same test folder at once.
+
+Rather than always copying the whole test folder, the tree can be built
+with one of several strategies, chosen with ``SANDBOX_STRATEGY``:
+
+    * copy - a full ``shutil.copytree``, as has always been done
+    * reflink - copy-on-write clones of every file where the filesystem
+      supports them (btrfs, xfs).  Whether it does is found once per pair
+      of filesystems, and where it doesn't (ext4) the folder is copied
+    * link - hard links to every file, which is only safe for runners that
+      never write into the files they were given
+    * overlay - mount a per-job writable layer over the test folder with
+      fuse-overlayfs (or the kernel overlay when running as root), so that
+      the cost no longer depends on the size of the folder.  If neither
+      can be mounted the folder is copied instead.
+
+Whatever the strategy, the files that a run writes to, the intermediate
+files and anything under ``OUTPUT_DIR``, are always private copies.
+"""
+import os
+import shutil
+import fcntl
+import tempfile
+import subprocess
+from distutils.spawn import find_executable
+
+import config as cf
+from logger import logging
+logger = logging.getLogger("pipeline").getChild("sandbox")
+
+# from linux/fs.h, _IOW(0x94, 9, int)
+FICLONE = 0x40049409
+
+PRIVATE_FILES = set(cf.INTERMEDIATE_FILES + ["kim.log"])
+
+def _private(relpath):
+    """ Whether a file, relative to the top of the tree, is written by runs """
+    return (relpath in PRIVATE_FILES or
+            relpath.split(os.sep)[0] == cf.OUTPUT_DIR)
+
+def copy_file(src, dst):
+    shutil.copy2(src, dst)
+
+def reflink_file(src, dst):
+    """ Clone src to dst sharing its blocks, or copy it if we can't """
+    try:
+        with open(src, 'rb') as fsrc, open(dst, 'wb') as fdst:
+            fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+    except (IOError, OSError):
+        shutil.copyfile(src, dst)
+    shutil.copystat(src, dst)
+
+def link_file(src, dst):
+    """ Hard link src to dst, or copy it if they are on different devices """
+    try:
+        os.link(src, dst)
+    except OSError:
+        shutil.copy2(src, dst)
+
+_reflinks = {}
+
+def reflink_supported(src, parent):
+    """ Whether files under src can be cloned into the directory parent,
+        found once per pair of filesystems by cloning a scratch file """
+    key = (os.stat(src).st_dev, os.stat(parent).st_dev)
+    if key not in _reflinks:
+        supported = key[0] == key[1]
+        if supported:
+            fd, probe = tempfile.mkstemp(dir=parent, prefix=".reflink")
+            try:
+                os.write(fd, "probe")
+                with open(probe+".clone", 'wb') as fdst:
+                    fcntl.ioctl(fdst.fileno(), FICLONE, fd)
+            except (IOError, OSError):
+                supported = False
+            finally:
+                os.close(fd)
+                for name in (probe, probe+".clone"):
+                    try:
+                        os.remove(name)
+                    except OSError:
+                        pass
+        logger.info("Running directories in %s are made by %s", parent,
+                "reflink" if supported else "copy, as files from %s can't be cloned there" % src)
+        _reflinks[key] = supported
+    return _reflinks[key]
+
+STRATEGIES = {
+    "copy": copy_file,
+    "reflink": reflink_file,
+    "link": link_file,
+}
+
+def populate(src, dst, strategy=None):
+    """ Build the tree at dst (which must not exist) from the one at src """
+    strategy = strategy or cf.SANDBOX_STRATEGY
+    if strategy == "copy":
+        shutil.copytree(src, dst)
+        return
+
+    place = STRATEGIES[strategy]
+    made = []
+    # follow symlinks as copytree does, placing what they point to
+    for root, dirs, files in os.walk(src, followlinks=True):
+        rel = os.path.relpath(root, src)
+        target = os.path.normpath(os.path.join(dst, rel))
+        os.mkdir(target)
+        made.append((root, target))
+        for name in files:
+            relpath = os.path.normpath(os.path.join(rel, name))
+            srcname = os.path.join(root, name)
+            if _private(relpath):
+                copy_file(srcname, os.path.join(target, name))
+            else:
+                place(os.path.realpath(srcname), os.path.join(target, name))
+
+    # directory permissions last, in case they make them read only
+    for root, target in reversed(made):
+        shutil.copystat(root, target)
+
+#=================================
+# overlay mounts
+#=================================
+def _layers(dst):
+    """ The upper and work directories of an overlay mounted at dst """
+    return dst+".upper", dst+".work"
+
+def _mount_command(src, dst):
+    """ The command mounting an overlay of src at dst, if we have one """
+    upper, work = _layers(dst)
+    options = "lowerdir=%s,upperdir=%s,workdir=%s" % (src, upper, work)
+    if find_executable("fuse-overlayfs"):
+        return ["fuse-overlayfs", "-o", options, dst]
+    if os.geteuid() == 0:
+        return ["mount", "-t", "overlay", "overlay", "-o", options, dst]
+    return None
+
+def _unmount_command(dst):
+    if find_executable("fusermount") and os.geteuid() != 0:
+        return ["fusermount", "-u", dst]
+    return ["umount", dst]
+
+def mount_overlay(src, dst):
+    """ Mount a writable overlay of src at dst, returning whether it worked """
+    cmd = _mount_command(src, dst)
+    if cmd is None:
+        return False
+
+    for folder in (dst,) + _layers(dst):
+        os.mkdir(folder)
+    try:
+        subprocess.check_output(cmd, stderr=subprocess.STDOUT)
+        return True
+    except (OSError, subprocess.CalledProcessError) as e:
+        logger.warning("Could not mount overlay at %s: %s %s", dst, e,
+                getattr(e, 'output', ''))
+        for folder in (dst,) + _layers(dst):
+            shutil.rmtree(folder, ignore_errors=True)
+        return False
+
+def create(src, dst, strategy=None):
+    """ Create the running directory dst from the folder src """
+    strategy = strategy or cf.SANDBOX_STRATEGY
+    if strategy not in STRATEGIES and strategy != "overlay":
+        raise ValueError("Unknown sandbox strategy %r" % strategy)
+
+    if strategy == "overlay":
+        if mount_overlay(src, dst):
+            logger.debug("Mounted %s over %s", dst, src)
+            return
+        strategy = "copy"
+
+    if strategy == "reflink" and not reflink_supported(src, os.path.dirname(dst)):
+        strategy = "copy"
+
+    logger.debug("Creating %s from %s by %s", dst, src, strategy)
+    populate(src, dst, strategy)
+
+def remove(dst):
+    """ Remove a running directory made by ``create`` """
+    if os.path.ismount(dst):
+        subprocess.check_call(_unmount_command(dst))
+        for folder in _layers(dst):
+            shutil.rmtree(folder)
+    shutil.rmtree(dst)
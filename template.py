@@ -7,7 +7,9 @@ are available
 
     * query(query) - run a general API query to query.openkim.org for any information
         including test results or reference data.  See query.openkim.org for
-        information on formatting these queries
+        information on formatting these queries.  Responses are shared by
+        all of the workers on a box for ``QUERY_CACHE_TTL`` seconds, and
+        every query a render makes is recorded in ``QUERY_RECORD_FILE``
     * MODELNAME - a global variable which represents the current model coupling
         for this particular test run
     * TESTNAME - the current runing testname, similar to MODELNAME
@@ -18,8 +20,12 @@ are available
     * asedata - the dictionary of reference data contained within ASE
 """
 import os
+import time
+import errno
+import sqlite3
 import ase.data
 import jinja2
+import jinja2.bccache
 import json
 import clj
 from functools import partial
@@ -60,9 +66,171 @@ def stripversion(kim):
 jsondump = partial(json.dumps, indent=4)
 edndump  = partial(clj.dumps)
 
+#-----------------------------------------
+# Cached queries
+#-----------------------------------------
+QUERY_SCHEMA = """
+CREATE TABLE IF NOT EXISTS queries (
+    key TEXT PRIMARY KEY, answer TEXT, fetched REAL
+);
+"""
+
+# the object types of results, as in the obj collection
+RESULT_TYPES = ("tr", "vr", "er")
+
+def results_query(q):
+    """ Whether a query may be answered by results, those in the data
+        collection or result objects in obj """
+    if not isinstance(q, dict):
+        return False
+    if q.get("database") == "data":
+        return True
+    if q.get("database") == "obj":
+        kind = (q.get("query") or {}).get("type")
+        return not isinstance(kind, basestring) or kind in RESULT_TYPES
+    return False
+
+class QueryCache(object):
+    """ The responses to the queries made by templates
+
+    Rendering one test against every model it matches asks the same
+    questions of query.openkim.org over and over, so responses are kept,
+    keyed by the canonical JSON of the query, in ``QUERY_CACHE_FILE`` next to
+    the repository where all of the workers on a box share them.  They are
+    reused for ``QUERY_CACHE_TTL`` seconds, and at most ``QUERY_CACHE_SIZE``
+    of the most recently fetched are kept.  Queries for results are never
+    cached, since a rerun has to see the results that a driver or test
+    update has just replaced, and neither are empty responses, which mostly
+    say that something has not arrived yet.  If the file can't be used
+    every query is asked.
+
+    Every query answered is appended to ``record`` along with its response
+    and when it was fetched, so that a run can say what it was given.
+    """
+    def __init__(self, dbfile=None, ttl=None, size=None):
+        self._dbfile = dbfile
+        self.ttl = cf.QUERY_CACHE_TTL if ttl is None else ttl
+        self.size = size or cf.QUERY_CACHE_SIZE
+        self._db = None
+        self._pid = None
+        self.record = []
+
+    @property
+    def dbfile(self):
+        return self._dbfile or os.path.join(cf.KIM_REPOSITORY_DIR, cf.QUERY_CACHE_FILE)
+
+    @property
+    def db(self):
+        """ The connection to the cache file, or None if it can't be used,
+            reopened after a fork """
+        if self._pid != os.getpid():
+            self._pid = os.getpid()
+            try:
+                self._db = sqlite3.connect(self.dbfile, timeout=60)
+                self._db.text_factory = str
+                self._db.executescript(QUERY_SCHEMA)
+            except sqlite3.Error as e:
+                logger.warning("Could not use query cache %r: %r", self.dbfile, e)
+                self._db = None
+        return self._db
+
+    def query(self, q, url="", decode=False):
+        """ Answer a query as ``kimquery.query`` would, from the cache if a
+            fresh enough response is there """
+        key = json.dumps([q, url], sort_keys=True, separators=(',', ':'))
+        now = time.time()
+
+        db = self.db if not results_query(q) else None
+        row = None
+        if db:
+            row = db.execute("SELECT answer, fetched FROM queries WHERE key=?", (key,)).fetchone()
+        if row and now - row[1] < self.ttl:
+            answer, fetched, cached = row[0], row[1], True
+        else:
+            answer, fetched, cached = query(q, url=url), now, False
+
+        response = json.loads(answer)
+        if db and not cached and response:
+            with db:
+                db.execute("INSERT OR REPLACE INTO queries (key, answer, fetched) "
+                        "VALUES (?,?,?)", (key, answer, fetched))
+                db.execute("DELETE FROM queries WHERE rowid NOT IN "
+                    "(SELECT rowid FROM queries ORDER BY fetched DESC LIMIT ?)", (self.size,))
+
+        logger.debug("query %s answered %s", key, "from cache" if cached else "remotely")
+        self.record.append({"query": q, "url": url, "fetched": fetched,
+            "cached": cached, "response": response})
+        return response if decode else answer
+
+_query_cache = None
+
+def query_cache():
+    """ The process wide ``QueryCache``, created on first use """
+    global _query_cache
+    if _query_cache is None:
+        _query_cache = QueryCache()
+    return _query_cache
+
+def cached_query(q, url="", decode=False):
+    return query_cache().query(q, url=url, decode=decode)
+
 #-----------------------------------------
 # Jinja Stuff
 #-----------------------------------------
+class ContentBytecodeCache(jinja2.FileSystemBytecodeCache):
+    """ A bytecode cache keyed by the content of a template rather than its
+    path, since every job renders its templates out of a new temporary
+    directory.  Compiled code is kept in memory for the life of the process
+    and on disk in ``TEMPLATE_CACHE_DIR`` so the other workers on the box
+    can share it """
+    def __init__(self, directory=None):
+        directory = directory or os.path.join(cf.KIM_REPOSITORY_DIR, cf.TEMPLATE_CACHE_DIR)
+        super(ContentBytecodeCache, self).__init__(directory, "%s.cache")
+        self.memory = {}
+
+    def get_bucket(self, environment, name, filename, source):
+        # the delimiters change what the same source compiles to
+        syntax = (environment.block_start_string, environment.block_end_string,
+                environment.variable_start_string, environment.variable_end_string,
+                environment.comment_start_string, environment.comment_end_string)
+        key = self.get_source_checksum(repr(syntax) + source)
+        bucket = jinja2.bccache.Bucket(environment, key, key)
+        self.load_bytecode(bucket)
+        return bucket
+
+    def load_bytecode(self, bucket):
+        code = self.memory.get(bucket.key)
+        if code is not None:
+            bucket.code = code
+            return
+
+        try:
+            super(ContentBytecodeCache, self).load_bytecode(bucket)
+        except Exception as e:
+            logger.debug("Ignoring unreadable template cache %s: %r",
+                    self._get_cache_filename(bucket), e)
+            bucket.reset()
+        if bucket.code is not None:
+            self.memory[bucket.key] = bucket.code
+
+    def dump_bytecode(self, bucket):
+        self.memory[bucket.key] = bucket.code
+        filename = self._get_cache_filename(bucket)
+        tmpname = "%s.%i" % (filename, os.getpid())
+        try:
+            if not os.path.isdir(self.directory):
+                try:
+                    os.makedirs(self.directory)
+                except OSError as e:
+                    if e.errno != errno.EEXIST:
+                        raise
+            # renamed into place so other workers never read a partial file
+            with open(tmpname, 'wb') as f:
+                bucket.write_bytecode(f)
+            os.rename(tmpname, filename)
+        except (IOError, OSError) as e:
+            logger.warning("Could not write template cache %s: %r", filename, e)
+
 template_environment = jinja2.Environment(
         loader=jinja2.FileSystemLoader('/'),
         block_start_string='@[',
@@ -72,6 +240,7 @@ template_environment = jinja2.Environment(
         comment_start_string='@#',
         comment_end_string='#@',
         undefined=jinja2.StrictUndefined,
+        bytecode_cache=ContentBytecodeCache(),
         )
 
 template_environment.filters.update(
@@ -86,7 +255,7 @@ template_environment.filters.update(
 template_environment.globals.update(
         {
             "path": path,
-            "query": query,
+            "query": cached_query,
             "convert": convert,
             "asedata": ase.data,
             "parse_kim_code": database.parse_kim_code,
@@ -108,6 +277,8 @@ def process(inppath, model, test, modelonly=False, outfile=cf.TEMP_INPUT_FILE):
                 "TESTNAME": test.kim_code,
                 "MODELNAME": model.kim_code,
             }
+        queries = query_cache()
+        queries.record = []
         output = template.render(**extrainfo)
 
         if not outfile:
@@ -115,3 +286,7 @@ def process(inppath, model, test, modelonly=False, outfile=cf.TEMP_INPUT_FILE):
 
         with open(outfile, 'w') as out:
                 out.write(output)
+
+        # keep what the queries answered with the rest of the run
+        if queries.record:
+            cf.dumpedn(queries.record, cf.QUERY_RECORD_FILE)
@@ -0,0 +1,47 @@
+import os, sys, json
+from StringIO import StringIO
+
+CODE_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+sys.path.insert(0, CODE_DIR)
+import edn
+
+DOC = {
+    "property-id": "tag:staff@noreply.openkim.org,2014-04-15:property/cohesive-energy",
+    "a": {"source-value": [1, 2.5, -3e-10], "source-unit": "angstrom"},
+    "nothing": None,
+    "flags": [True, False, "\xc3\xa9"],
+    "nested": [[], {}, [[1]]],
+}
+
+def test_write_layout():
+    assert edn.dumps(DOC) == json.dumps(DOC, separators=(' ', ' '), indent=4)
+
+def test_roundtrip():
+    assert edn.loads(edn.dumps(DOC)) == DOC
+
+def test_read_edn():
+    s = '{:a [1 2.5 -3e2 nil true] "b" {"c" #{1}} ; comment\n :d "x\\"y"}'
+    assert edn.loads(s) == {"a": [1, 2.5, -300.0, None, True], "b": {"c": set([1])}, "d": 'x"y'}
+
+def test_chunk_boundaries():
+    s = edn.dumps([{"source-value": range(200), "s": "a \\\" b"}]*10)
+    for size in (1, 3, 7, 100):
+        value = edn.iter_values(edn.tokenize(StringIO(s), size)).next()
+        assert edn.dumps(value) == s
+
+def test_unbalanced():
+    for s in ('[1 2', '{"a" 1]', '{"a"}'):
+        try:
+            edn.loads(s)
+        except edn.EDNDecodeError:
+            continue
+        assert False, s
+
+def test_iter_documents():
+    docs = [{"a": range(50)}, {"b": [[1], {"c": None}]}, {}]
+    s = edn.dumps(docs)
+    for size in (1, 5, 4096):
+        assert list(edn.iter_documents(StringIO(s), size)) == docs
+    assert list(edn.iter_documents(StringIO(edn.dumps(docs[0])))) == [docs[0]]
+    assert list(edn.iter_documents(StringIO("[]"))) == []
+    assert list(edn.iter_documents(StringIO(""))) == []
@@ -0,0 +1,134 @@
+import os, sys
+import pytest
+
+CODE_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+sys.path.insert(0, CODE_DIR)
+import kimunits
+
+def close(a, b):
+    return abs(a - b) <= 1e-9*max(abs(a), abs(b))
+
+def test_si():
+    value, unit = kimunits.convert_native(2.0, 'eV/angstrom^3')
+    assert close(value, 2*160.21766208e9) and unit == 'kg / m s^2'
+    assert kimunits.convert_native(1, 'kcal/mol')[1] == 'kg m^2 / mol s^2'
+    assert kimunits.convert_native(3, '1') == (3.0, '1')
+
+def test_wanted():
+    assert close(kimunits.convert_native(1, 'GPa', 'bar', suppress_unit=True), 1e4)
+    assert close(kimunits.convert_native(1, 'Hartree', 'eV')[0], 27.21138602)
+
+def test_affine():
+    assert close(kimunits.convert_native(0, 'degC')[0], 273.15)
+    assert close(kimunits.convert_native(212, 'degF', 'degC')[0], 100)
+    # in compound units a temperature is a difference
+    assert kimunits.convert_native(1, 'J/degC') == (1.0, 'kg m^2 / K s^2')
+
+def test_errors():
+    for args in (('foo',), ('eV/',), ('eV', 'K')):
+        try:
+            kimunits.convert_native(1, *args)
+        except kimunits.UnitConversion:
+            continue
+        assert False, args
+
+def test_add_si_units():
+    doc = {"a": [{"source-value": [[0, 1], [2, 3]], "source-unit": "angstrom"}]}
+    out = kimunits.add_si_units(doc)["a"][0]
+    assert out["si-unit"] == "m"
+    assert out["si-value"] == [[0.0, 1e-10], [2e-10, 3e-10]]
+
+def test_convert_list_shapes():
+    for x in ([[1, 2], [3, 4]], [[1, 2], [3]], [1, [2, [3]]], [], (1, 2)):
+        out, unit = kimunits.convert_list(x, 'nm')
+        pure = kimunits._convert_linear(x, 1e-9, 0.)
+        assert out == pure and type(out) == type(x) and unit == 'm'
+
+def test_conversion_cache(tmpdir):
+    calls = []
+    def backend(value, from_unit, to_unit=None, suppress_unit=False):
+        calls.append(value)
+        return kimunits.convert_native(value, from_unit, to_unit)
+
+    dbfile = str(tmpdir.join("units.sqlite"))
+    cache = kimunits.ConversionCache(dbfile=dbfile, size=2)
+    assert cache.get(backend, 'degC') == (1.0, 273.15, 'K')
+    cache.get(backend, 'degC')
+    assert len(calls) == 2
+
+    # another worker reads it from disk, and the table stays bounded
+    other = kimunits.ConversionCache(dbfile=dbfile, size=2)
+    assert other.get(backend, 'degC') == (1.0, 273.15, 'K')
+    other.get(backend, 'eV')
+    other.get(backend, 'nm')
+    assert len(calls) == 6
+    assert other.db.execute("SELECT COUNT(*) FROM factors").fetchone()[0] == 2
+
+def test_result_units_natively():
+    # unit strings as they appear in existing results
+    assert close(kimunits.convert(1, 'Angstrom')[0], 1e-10)
+    assert close(kimunits.convert(2, 'eV/Angstrom^3', 'GPa')[0], 320.43532416)
+    assert kimunits.convert is kimunits.convert_auto
+
+def test_unknown_units_fall_back(tmpdir, monkeypatch):
+    known = {'eV/atom': (1.6021766208e-19, 'kg m^2 / s^2'),
+             'ev': (1.6021766208e-19, 'kg m^2 / s^2'),
+             'a.u.': (1.495978707e11, 'm')}
+    calls = []
+    def convert_units(value, from_unit, to_unit=None, suppress_unit=False):
+        calls.append(from_unit)
+        if from_unit not in known:
+            raise kimunits.UnitConversion(from_unit)
+        return value*known[from_unit][0], known[from_unit][1]
+
+    cache = kimunits.ConversionCache(dbfile=str(tmpdir.join("units.sqlite")))
+    monkeypatch.setattr(kimunits, "convert_units", convert_units)
+    monkeypatch.setattr(kimunits, "_conversion_cache", cache)
+
+    for unit, (scale, si) in known.items():
+        assert kimunits.convert(2, unit) == (2*scale, si)
+    out = kimunits.add_si_units({"source-value": [1, 2], "source-unit": "eV/atom"})
+    assert out["si-unit"] == 'kg m^2 / s^2'
+    assert close(out["si-value"][1], 2*1.6021766208e-19)
+
+    # the backend was asked once per unit, for the images of 0 and 1
+    assert sorted(calls) == sorted(list(known)*2)
+
+    # and units which neither knows are still errors
+    try:
+        kimunits.convert(1, 'furlongs')
+    except kimunits.UnitConversion:
+        pass
+    else:
+        assert False
+
+@pytest.mark.skipif(not any(os.access(os.path.join(d, 'units'), os.X_OK)
+        for d in os.environ.get('PATH', '').split(os.pathsep)), reason="no GNU units")
+def test_gnu_units_fallback():
+    for unit in ('eV/atom', 'ev', 'a.u.'):
+        value, si = kimunits.convert(1, unit)
+        assert value > 0
+
+def test_conversion_cache_in_memory_without_its_file(tmpdir):
+    dbfile = str(tmpdir.join("missing", "units.sqlite"))
+    cache = kimunits.ConversionCache(dbfile=dbfile)
+    assert cache.get(kimunits.convert_native, 'nm') == (1e-9, 0.0, 'm')
+    assert not os.path.exists(os.path.dirname(dbfile))
+
+def test_conversion_cache_affine_with_zero_hack(tmpdir):
+    def convert_udunits2(value, from_unit, to_unit=None, suppress_unit=False):
+        # as the udunits2 and cfunits wrappers, 0 is taken to convert to 0
+        if float(value) == 0:
+            return 0.0, kimunits.convert_native(1, from_unit, to_unit)[1]
+        return kimunits.convert_native(value, from_unit, to_unit)
+
+    cache = kimunits.ConversionCache(dbfile=str(tmpdir.join("units.sqlite")))
+    scale, offset, unit = cache.get(convert_udunits2, 'degC')
+    assert unit == 'K' and close(100*scale + offset, 373.15)
+
+    # there and back again
+    scale, offset, unit = cache.get(convert_udunits2, 'degF', 'degC')
+    assert close(212*scale + offset, 100) and close(32*scale + offset + 1, 1)
+    back_scale, back_offset, unit = cache.get(convert_udunits2, 'degC', 'degF')
+    assert close(100*back_scale + back_offset, 212)
+    assert close((37*scale + offset)*back_scale + back_offset, 37)
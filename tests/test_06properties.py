@@ -0,0 +1,62 @@
+import os, sys
+
+CODE_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+sys.path.insert(0, CODE_DIR)
+import config as cf
+import properties
+
+PID = "tag:staff@noreply.openkim.org,2014-04-15:property/cohesive-potential-energy-cubic-crystal"
+
+DEFINITION = """{
+    "property-id" "%s"
+    "property-title" "Cohesive energy of a cubic crystal"
+    "short-name" {"type" "string" "has-unit" false "extent" [":"] "required" true}
+    "species" {"type" "string" "has-unit" false "extent" [":"] "required" true}
+    "a" {"type" "float" "has-unit" true "extent" [] "required" true}
+    "basis-atom-coordinates" {"type" "float" "has-unit" false "extent" [":" 3] "required" true}
+    "space-group" {"type" "string" "has-unit" false "extent" [] "required" false}
+    "cohesive-potential-energy" {"type" "float" "has-unit" true "extent" [] "required" true}
+}""" % PID
+
+def instance(**changes):
+    inst = {
+        "property-id": PID,
+        "instance-id": 1,
+        "short-name": {"source-value": ["fcc"]},
+        "species": {"source-value": ["Ar"]},
+        "a": {"source-value": 5.25, "source-unit": "angstrom"},
+        "basis-atom-coordinates": {"source-value": [[0, 0, 0], [0, 0.5, 0.5]]},
+        "cohesive-potential-energy": {"source-value": 0.08, "source-unit": "eV"},
+    }
+    inst.update(changes)
+    return dict((k, v) for k, v in inst.items() if v is not None)
+
+def setup_module(module):
+    import tempfile
+    folder = tempfile.mkdtemp()
+    os.makedirs(os.path.join(folder, "cohesive", "2014"))
+    with open(os.path.join(folder, "cohesive", "2014", "cohesive.edn"), "w") as f:
+        f.write(DEFINITION)
+    cf.KIM_PROPERTIES_DIR = folder
+    properties._definitions = None
+
+def test_valid():
+    reply = properties.validate([instance()])
+    assert reply[0]["valid"], reply
+
+def test_invalid():
+    bad = [
+        instance(a=None),
+        instance(a={"source-value": 5.25}),
+        instance(a={"source-value": "5.25", "source-unit": "angstrom"}),
+        instance(**{"basis-atom-coordinates": {"source-value": [[0, 0]]}}),
+        instance(extra={"source-value": 1}),
+        instance(**{"instance-id": None}),
+    ]
+    for reply in properties.validate(bad):
+        assert not reply["valid"] and reply["errors"]
+
+def test_unknown():
+    other = instance(**{"property-id": "tag:nobody,2014:property/other"})
+    assert properties.unknown([instance(), other]) == [other["property-id"]]
+    assert not properties.validate(other)[0]["valid"]
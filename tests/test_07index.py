@@ -0,0 +1,96 @@
+import os, sys, shutil, tempfile
+
+CODE_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+sys.path.insert(0, CODE_DIR)
+import database
+
+CODES = ["LJ_Ar__TE_000000000001_000", "LJ_Ar__TE_000000000001_001",
+         "Other__TE_000000000002_000"]
+
+def make_repo():
+    root = tempfile.mkdtemp()
+    for code in CODES:
+        os.makedirs(os.path.join(root, "te", code))
+    return root
+
+def make_index(root):
+    return database.RepositoryIndex(root=root, dbfile=os.path.join(root, "index.sqlite"))
+
+def test_find_versions():
+    root = make_repo()
+    index = make_index(root)
+    assert index.find(None, "TE", "000000000001", None) == [
+        ("LJ_Ar", "TE", "000000000001", "000"), ("LJ_Ar", "TE", "000000000001", "001")]
+    assert index.find("LJ_Ar", "TE", "000000000001", "001") == [
+        ("LJ_Ar", "TE", "000000000001", "001")]
+    assert index.find("Other", "TE", "000000000001", None) == []
+    assert index.find(None, "MO", "000000000001", None) == []
+    shutil.rmtree(root)
+
+def test_new_entries_seen():
+    root = make_repo()
+    index = make_index(root)
+    assert len(index.find(None, "TE", "000000000002", None)) == 1
+    os.makedirs(os.path.join(root, "te", "Other__TE_000000000002_001"))
+    assert index.find(None, "TE", "000000000002", None)[-1][-1] == "001"
+    assert index.contains("te", "Other__TE_000000000002_001")
+    assert index.kim_codes("TE") == sorted(CODES + ["Other__TE_000000000002_001"])
+    shutil.rmtree(root)
+
+RUNNING = "LJ_Ar_running4b3c1f2e-1d2a-11e6-8b2c-0800272c5d2a__TE_000000000001_001"
+
+def write_kimspec(root, code, driver):
+    with open(os.path.join(root, "te", code, "kimspec.edn"), "w") as f:
+        f.write('{"test-driver" "%s"}' % driver)
+
+def test_persisted_index(monkeypatch):
+    root = make_repo()
+    write_kimspec(root, CODES[0], "LJ__TD_000000000000_000")
+    make_index(root).leader("te")
+
+    # a new process answers from the index file without listing
+    def listdir(path):
+        raise AssertionError("listed %s" % path)
+    monkeypatch.setattr(database.os, "listdir", listdir)
+    index = make_index(root)
+    assert index.driven_by("te", "LJ__TD_000000000000_000") == [CODES[0]]
+    assert index.kimspec("te", CODES[0]) == {"test-driver": "LJ__TD_000000000000_000"}
+    monkeypatch.undo()
+    shutil.rmtree(root)
+
+def test_running_directories_ignored():
+    root = make_repo()
+    index = make_index(root)
+    index.leader("te")
+    changes = index.db.total_changes
+
+    for name in (RUNNING, RUNNING+".upper", RUNNING+".work"):
+        os.makedirs(os.path.join(root, "te", name))
+        write_kimspec(root, name, "LJ__TD_000000000000_000")
+
+    assert not index.contains("te", RUNNING)
+    assert index.kim_codes("TE") == sorted(CODES)
+    assert index.driven_by("te", "LJ__TD_000000000000_000") == []
+    assert index.db.total_changes == changes
+    shutil.rmtree(root)
+
+def test_touch_rereads_items():
+    root = make_repo()
+    index = make_index(root)
+    assert index.kimspec("te", CODES[1]) is None
+
+    write_kimspec(root, CODES[1], "LJ__TD_000000000000_000")
+    os.utime(os.path.join(root, "te", CODES[1], "kimspec.edn"), (1e9, 2e9))
+    index.touch("te", ["*TE_000000000001_001*"])
+    assert index.driven_by("te", "LJ__TD_000000000000_000") == [CODES[1]]
+    shutil.rmtree(root)
+
+def test_rsync_touches_only_what_it_read(monkeypatch):
+    import rsync_tools
+    touched = []
+    class Index(object):
+        def touch(self, leader, entries=None):
+            touched.append((leader, sorted(entries)))
+    monkeypatch.setattr(rsync_tools, "repository_index", lambda: Index())
+    rsync_tools.touch_index(["/./te/" + CODES[0], "/./mo/", "pipeline@host:/approved/./te/" + CODES[2]])
+    assert sorted(touched) == [("mo", []), ("te", sorted([CODES[0], CODES[2]]))]
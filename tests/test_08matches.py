@@ -0,0 +1,109 @@
+import os, sys, tempfile
+
+CODE_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+sys.path.insert(0, CODE_DIR)
+import kimapi
+
+def make_matrix(dbfile):
+    return kimapi.MatchMatrix(dbfile=dbfile, api="1.6.3")
+
+def test_matrix_lookup_record():
+    dbfile = tempfile.mktemp()
+    matrix = make_matrix(dbfile)
+    assert matrix.lookup("runner", ["a", "b"]) == [None, None]
+
+    matrix.record("runner", [("a", True), ("b", False)])
+    assert matrix.lookup("runner", ["a", "b", "c"]) == [True, False, None]
+
+    # persisted for the next process
+    assert make_matrix(dbfile).lookup("runner", ["b", "a"]) == [False, True]
+    assert kimapi.MatchMatrix(dbfile=dbfile, api="other").lookup("runner", ["a"]) == [None]
+    os.remove(dbfile)
+
+def test_matrix_workers_keep_each_others_bits():
+    dbfile = tempfile.mktemp()
+    one, two = make_matrix(dbfile), make_matrix(dbfile)
+    assert one.lookup("runner", ["a", "b"]) == [None, None]
+    assert two.lookup("runner", ["a", "b"]) == [None, None]
+
+    one.record("runner", [("a", True)])
+    two.record("runner", [("b", True)])
+    assert one.lookup("runner", ["a", "b"]) == [True, True]
+    assert make_matrix(dbfile).lookup("runner", ["a", "b"]) == [True, True]
+    os.remove(dbfile)
+
+def test_matrix_in_memory_without_its_file():
+    dbfile = os.path.join(tempfile.mktemp(), "missing", "matches.sqlite")
+    matrix = make_matrix(dbfile)
+    matrix.record("runner", [("a", True)])
+    assert matrix.lookup("runner", ["a", "b"]) == [True, None]
+    assert not os.path.exists(os.path.dirname(dbfile))
+
+def fake_file_init(kimfile, model):
+    import signal, time
+    if "Crash" in model:
+        os.kill(os.getpid(), signal.SIGSEGV)
+    if "Hang" in model:
+        time.sleep(100)
+    if "Raise" in model:
+        raise RuntimeError("init failed")
+    return ("Al" in model) == ("Al" in kimfile), None
+
+def test_pool_matches(monkeypatch):
+    monkeypatch.setattr(kimapi.kimservice, "KIM_API_file_init", fake_file_init)
+    monkeypatch.setattr(kimapi.kimservice, "KIM_API_free", lambda pkim: None)
+    pool = kimapi.MatchPool(size=2, timeout=2, maxrequests=2)
+    try:
+        requests = [("Al.kim", "Al_model"), ("Al.kim", "Ar_model"),
+                    ("Ar.kim", "Ar_model"), ("Ar.kim", "Al_model"), ("Al.kim", "Al_model")]
+        assert pool.match(requests) == [True, False, True, False, True]
+        assert len(pool.children) == 2
+    finally:
+        pool.close()
+    assert pool.children == []
+
+def test_pool_failures_are_isolated(monkeypatch):
+    monkeypatch.setattr(kimapi.kimservice, "KIM_API_file_init", fake_file_init)
+    monkeypatch.setattr(kimapi.kimservice, "KIM_API_free", lambda pkim: None)
+    pool = kimapi.MatchPool(size=2, timeout=1, maxrequests=100)
+    try:
+        requests = [("Al.kim", "Crash_model"), ("Al.kim", "Al_model"),
+                    ("Al.kim", "Hang_model"), ("Al.kim", "Raise_model"), ("Ar.kim", "Ar_model")]
+        assert pool.match(requests) == [None, True, None, None, True]
+        assert pool.match([("Al.kim", "Al_model")]) == [True]
+    finally:
+        pool.close()
+
+class Item(object):
+    def __init__(self, code, kimfile):
+        self.code = code
+        self.kimfile_name = kimfile
+    def __str__(self):
+        return self.code
+
+def test_match_errors_are_not_non_matches(monkeypatch):
+    import config as cf
+    folder = tempfile.mkdtemp()
+    for name in ("Al_test", "Crash_model", "Al_model", "Ar_model"):
+        with open(os.path.join(folder, name), "w") as f:
+            f.write(name)
+    item = lambda name: Item(name, os.path.join(folder, name))
+
+    monkeypatch.setattr(kimapi.kimservice, "KIM_API_file_init", fake_file_init)
+    monkeypatch.setattr(kimapi.kimservice, "KIM_API_free", lambda pkim: None)
+    monkeypatch.setattr(kimapi, "version_match", lambda obj, runner=False: True)
+    monkeypatch.setattr(kimapi, "_matrix", make_matrix(os.path.join(folder, "matrix")))
+    monkeypatch.setattr(kimapi, "_pool", kimapi.MatchPool(size=1, timeout=2))
+    try:
+        test = item("Al_test")
+        pairs = [(test, item("Al_model")), (test, item("Crash_model")), (test, item("Ar_model"))]
+        assert kimapi.valid_match_pairs(pairs) == [True, None, False]
+        assert kimapi.valid_match(test, item("Ar_model")) is False
+
+        import pytest
+        with pytest.raises(cf.KIMRuntimeError):
+            kimapi.valid_match(test, item("Crash_model"))
+        with pytest.raises(cf.KIMRuntimeError):
+            kimapi.valid_matches(test, [item("Al_model"), item("Crash_model")])
+    finally:
+        kimapi._pool.close()
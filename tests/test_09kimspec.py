@@ -0,0 +1,40 @@
+import os, sys, tempfile
+
+CODE_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+sys.path.insert(0, CODE_DIR)
+import kimobjects
+
+def write(path, text, mtime):
+    with open(path, "w") as f:
+        f.write(text)
+    os.utime(path, (mtime, mtime))
+
+def test_kimspec_cache_reuses_and_rereads():
+    folder = tempfile.mkdtemp()
+    path = os.path.join(folder, "kimspec.edn")
+    write(path, '{"kim-api-version" "1.6"}', 1e9)
+
+    cache = kimobjects.KimspecCache(size=4)
+    first = cache.get(path)
+    assert first == {"kim-api-version": "1.6"}
+    assert cache.get(path) is first
+
+    write(path, '{"kim-api-version" "1.7"}', 2e9)
+    assert cache.get(path) == {"kim-api-version": "1.7"}
+
+    os.remove(path)
+    assert cache.get(path) is None
+    assert path not in cache.entries
+
+def test_kimspec_cache_is_bounded():
+    folder = tempfile.mkdtemp()
+    cache = kimobjects.KimspecCache(size=2)
+    paths = [ os.path.join(folder, "%i.edn" % i) for i in range(3) ]
+    for i, path in enumerate(paths):
+        write(path, '{"n" %i}' % i, 1e9)
+
+    cache.get(paths[0])
+    cache.get(paths[1])
+    cache.get(paths[0])
+    cache.get(paths[2])
+    assert list(cache.entries) == [paths[0], paths[2]]
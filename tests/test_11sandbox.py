@@ -0,0 +1,111 @@
+import os, sys, tempfile
+
+CODE_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+sys.path.insert(0, CODE_DIR)
+import config as cf
+import sandbox
+
+def make_test_folder():
+    src = os.path.join(tempfile.mkdtemp(), "TE_000000000000_000")
+    os.makedirs(os.path.join(src, "data"))
+    os.makedirs(os.path.join(src, cf.OUTPUT_DIR))
+    for path in ("runner", "data/big", "kim.log",
+            os.path.join(cf.OUTPUT_DIR, "old.edn")):
+        with open(os.path.join(src, path), "w") as f:
+            f.write(path)
+    os.chmod(os.path.join(src, "runner"), 0755)
+    return src
+
+def inode(path):
+    return os.stat(path).st_ino
+
+def check_tree(src, dst):
+    for path in ("runner", "data/big", "kim.log",
+            os.path.join(cf.OUTPUT_DIR, "old.edn")):
+        assert open(os.path.join(dst, path)).read() == path
+    assert os.access(os.path.join(dst, "runner"), os.X_OK)
+
+def test_strategies_build_the_same_tree():
+    src = make_test_folder()
+    for strategy in ("copy", "reflink", "link"):
+        dst = src + "." + strategy
+        sandbox.create(src, dst, strategy)
+        check_tree(src, dst)
+        sandbox.remove(dst)
+        assert not os.path.exists(dst)
+        assert open(os.path.join(src, "data/big")).read() == "data/big"
+
+def test_link_shares_only_read_only_files():
+    src = make_test_folder()
+    dst = src + ".link"
+    sandbox.create(src, dst, "link")
+
+    assert inode(os.path.join(dst, "runner")) == inode(os.path.join(src, "runner"))
+    assert inode(os.path.join(dst, "data/big")) == inode(os.path.join(src, "data/big"))
+    # files that runs write to are never shared with the test folder
+    for path in ("kim.log", os.path.join(cf.OUTPUT_DIR, "old.edn")):
+        assert inode(os.path.join(dst, path)) != inode(os.path.join(src, path))
+
+def test_unknown_strategy():
+    src = make_test_folder()
+    try:
+        sandbox.create(src, src + ".x", "teleport")
+    except ValueError:
+        pass
+    else:
+        assert False
+    assert not os.path.exists(src + ".x")
+
+def test_overlay_falls_back_to_copy(monkeypatch):
+    src = make_test_folder()
+
+    # nothing to mount with
+    monkeypatch.setattr(sandbox, "_mount_command", lambda src, dst: None)
+    sandbox.create(src, src + ".a", "overlay")
+    check_tree(src, src + ".a")
+
+    # or a mount that fails, which leaves no layers behind
+    monkeypatch.setattr(sandbox, "_mount_command", lambda src, dst: ["false"])
+    sandbox.create(src, src + ".b", "overlay")
+    check_tree(src, src + ".b")
+    for folder in sandbox._layers(src + ".b"):
+        assert not os.path.exists(folder)
+
+def test_remove_unmounts_overlays(monkeypatch):
+    src = make_test_folder()
+    dst = src + ".overlay"
+    monkeypatch.setattr(sandbox, "_mount_command", lambda src, dst: ["true"])
+    assert sandbox.mount_overlay(src, dst)
+    for folder in (dst,) + sandbox._layers(dst):
+        assert os.path.isdir(folder)
+
+    unmounted = []
+    monkeypatch.setattr(os.path, "ismount", lambda path: path == dst)
+    monkeypatch.setattr(sandbox.subprocess, "check_call", unmounted.append)
+    sandbox.remove(dst)
+    assert unmounted == [sandbox._unmount_command(dst)]
+    for folder in (dst,) + sandbox._layers(dst):
+        assert not os.path.exists(folder)
+
+def test_reflink_probed_once_per_filesystem(monkeypatch):
+    monkeypatch.setattr(sandbox, "_reflinks", {})
+    used = []
+    monkeypatch.setattr(sandbox, "populate", lambda src, dst, strategy: used.append(strategy))
+    probes = []
+    def ioctl(fd, request, arg):
+        probes.append(request)
+        raise IOError(95, "Operation not supported")
+    monkeypatch.setattr(sandbox.fcntl, "ioctl", ioctl)
+
+    # a filesystem that can't clone is copied without trying every file
+    src = make_test_folder()
+    sandbox.create(src, src + ".a", "reflink")
+    sandbox.create(src, src + ".b", "reflink")
+    assert used == ["copy", "copy"] and len(probes) == 1
+    assert os.listdir(os.path.dirname(src)) == [os.path.basename(src)]
+
+    # and one that can is cloned
+    monkeypatch.setattr(sandbox, "_reflinks", {})
+    monkeypatch.setattr(sandbox.fcntl, "ioctl", lambda fd, request, arg: None)
+    sandbox.create(src, src + ".c", "reflink")
+    assert used[-1] == "reflink"
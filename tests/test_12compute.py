@@ -0,0 +1,219 @@
+import os, sys, time
+
+CODE_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+sys.path.insert(0, CODE_DIR)
+import config as cf
+import compute
+
+def live_group(pgid):
+    """ The processes of a group that are not zombies waiting for a reaper """
+    live = []
+    for pid in filter(str.isdigit, os.listdir("/proc")):
+        try:
+            with open("/proc/%s/stat" % pid) as f:
+                fields = f.read().rsplit(")", 1)[1].split()
+        except IOError:
+            continue
+        if int(fields[2]) == pgid and fields[0] != "Z":
+            live.append(pid)
+    return live
+
+def test_command_returncode():
+    assert compute.Command("exit 3").run(10) == 3
+    cmd = compute.Command("kill -9 $$")
+    assert cmd.run(10) == -9
+    assert cmd.rusage is not None
+
+def test_command_timeout_kills_the_group(monkeypatch):
+    monkeypatch.setattr(cf, "RUNNER_KILL_GRACE", 0.5)
+    # a shell that ignores SIGTERM, with a child that would outlive it
+    cmd = compute.Command("trap '' TERM; sleep 60 & sleep 60")
+    start = time.time()
+    try:
+        cmd.run(0.2)
+    except cf.PipelineTimeout:
+        pass
+    else:
+        assert False
+    assert time.time() - start < 10
+    assert cmd.returncode == -9
+    assert not live_group(cmd.process.pid), "process group survived"
+
+def test_command_samples_at_an_interval(monkeypatch):
+    samples = []
+    monkeypatch.setattr(compute, "tree_rss", lambda pid: samples.append(pid) or 1)
+    monkeypatch.setattr(cf, "RUNNER_SAMPLE_INTERVAL", 0.2)
+
+    # lots of output wakes the loop up for every chunk
+    capture = compute.OutputCapture(os.devnull)
+    cmd = compute.Command("head -c 20000000 /dev/zero; sleep 0.5", stdout=capture)
+    start = time.time()
+    assert cmd.run(30) == 0
+    took = time.time() - start
+    assert 1 <= len(samples) <= took/0.2 + 2
+    assert cmd.mempeak == 1
+
+def test_rusage_profiling():
+    # a runner that touches 64MB
+    cmd = compute.Command("python -c 'x = bytearray(64*2**20)'")
+    assert cmd.run(30) == 0
+    info = compute.rusage_info(cmd.rusage, cmd.mempeak)
+    assert info["memmax"] >= 64*1024
+    assert info["usertime"] + info["systime"] > 0
+    assert "mempeak" in info
+
+    comp = object.__new__(compute.Computation)
+    comp.runtime, comp.rusage, comp.mempeak, comp.cgroup_info = 1.5, cmd.rusage, 0, None
+    comp.gather_profiling_info({"host": "here"})
+    assert comp.info_dict["time"] == 1.5 and comp.info_dict["host"] == "here"
+    assert comp.info_dict["memmax"] == info["memmax"]
+    assert "mempeak" not in comp.info_dict
+
+def test_tree_rss_counts_children():
+    cmd = compute.Command("sleep 30 & sleep 30 & wait")
+    cmd.start()
+    try:
+        deadline = time.time() + 10
+        while len(compute.process_tree(cmd.process.pid)) < 3 and time.time() < deadline:
+            time.sleep(0.01)
+        pids = compute.process_tree(cmd.process.pid)
+        assert len(pids) == 3
+        assert compute.tree_rss(cmd.process.pid) == sum(map(compute.process_memory, pids))
+        assert compute.process_memory(pids[-1]) > 0
+    finally:
+        cmd.kill()
+        cmd.wait()
+
+def test_cgroup_enables_controllers_one_at_a_time(tmpdir, monkeypatch):
+    parent = str(tmpdir)
+    written = []
+    def write(self, name, value, path=None):
+        if value == "+io":
+            raise IOError(22, "Invalid argument")
+        written.append((name, value))
+        with open(os.path.join(path or self.path, name), 'w') as f:
+            f.write(str(value))
+    monkeypatch.setattr(compute.CGroup, "_write", write)
+
+    cgroup = compute.CGroup("job", parent=parent)
+    cgroup.create(memory_max=2**20, pids_max=10)
+    enabled = [ v for n, v in written if n == "cgroup.subtree_control" ]
+    assert enabled == ["+memory", "+cpu", "+pids"]
+    assert cgroup.read("memory.max") == str(2**20)
+    assert cgroup.read("pids.max") == "10"
+    assert cgroup.read("cpu.max") is None
+
+def test_cgroup_removed_when_setup_fails(tmpdir, monkeypatch):
+    def write(self, name, value, path=None):
+        if name == "pids.max":
+            raise IOError(2, "No such file or directory")
+    monkeypatch.setattr(compute.CGroup, "_write", write)
+
+    cgroup = compute.CGroup("job", parent=str(tmpdir))
+    try:
+        cgroup.create(pids_max=10)
+    except IOError:
+        pass
+    else:
+        assert False
+    assert not os.path.exists(cgroup.path)
+
+def test_cgroup_info(tmpdir):
+    cgroup = compute.CGroup("job", parent=str(tmpdir))
+    os.mkdir(cgroup.path)
+    files = {
+        "memory.peak": "2097152\n",
+        "cpu.stat": "usage_usec 1500000\nuser_usec 1000000\nthrottled_usec 0\n",
+        "io.stat": "8:0 rbytes=100 wbytes=20 rios=1\n8:16 rbytes=1 wbytes=2\n",
+        "memory.events": "low 0\nhigh 0\nmax 3\noom 1\noom_kill 1\n",
+    }
+    for name, text in files.items():
+        with open(os.path.join(cgroup.path, name), "w") as f:
+            f.write(text)
+    assert cgroup.info() == {"mempeak": 2048, "cpu-usage": 1.5,
+        "cpu-throttled": 0.0, "io-read-bytes": 101, "io-write-bytes": 22,
+        "oom-kills": 1}
+
+def test_out_of_memory_is_not_rewrapped():
+    from contextlib import contextmanager
+
+    class Killed(compute.Computation):
+        def __init__(self):
+            self.results = []
+        @contextmanager
+        def tempdir(self):
+            yield
+        def execute_in_place(self):
+            raise cf.PipelineOutOfMemory("over the limit")
+        def gather_profiling_info(self, extrainfo=None):
+            pass
+        def write_result(self, error=False):
+            self.results.append(error)
+
+    comp = Killed()
+    try:
+        comp.run()
+    except cf.PipelineOutOfMemory:
+        pass
+    else:
+        assert False
+    assert comp.results == [True]
+
+def test_output_capture_limit_and_tail(tmpdir):
+    filename = str(tmpdir.join("pipeline.stdout"))
+    with compute.OutputCapture(filename, limit=10, compress=False, lines=2) as capture:
+        capture.write("line one\nline two\n")
+        capture.write("line three\npartial")
+    text = open(filename).read()
+    assert text.startswith("line one\nl")
+    assert "[output truncated after 10 bytes, 26 more dropped]" in text
+    assert capture.tail() == "line two\nline three\npartial"
+
+def test_output_capture_compressed(tmpdir, monkeypatch):
+    import gzip
+    monkeypatch.setattr(cf, "RUNNER_OUTPUT_COMPRESS", True)
+    filename = str(tmpdir.join("pipeline.stderr"))
+    with compute.OutputCapture(filename) as capture:
+        capture.write("error\n")
+    assert capture.filename == filename + ".gz"
+    assert gzip.open(capture.filename).read() == "error\n"
+
+def test_compressed_output_is_cleaned(tmpdir, monkeypatch):
+    monkeypatch.chdir(str(tmpdir))
+    os.mkdir(cf.OUTPUT_DIR)
+    for name in (cf.STDOUT_FILE, cf.STDOUT_FILE + ".gz", cf.STDERR_FILE + ".gz"):
+        open(name, "w").close()
+    object.__new__(compute.Computation)._clean_old_run()
+    assert os.listdir(cf.OUTPUT_DIR) == []
+
+def test_batch_slot_is_not_indexed(tmpdir, monkeypatch):
+    import database
+    root = str(tmpdir)
+    code = "LJ_Ar__TE_000000000001_000"
+    os.makedirs(os.path.join(root, "te", code))
+    index = database.RepositoryIndex(root=root, dbfile=os.path.join(root, "index.sqlite"))
+
+    class Item(object):
+        def __init__(self, path):
+            self.path = path
+            self.kim_code, self.kim_code_name, self.kim_code_id = code, "LJ_Ar", "TE_000000000001_000"
+    runner = Item(os.path.join(root, "te", code))
+    monkeypatch.setattr(compute.kimobjects, "kim_obj",
+        lambda kim_code, search, subdir: Item(os.path.join(root, "te", subdir)))
+
+    seen = []
+    class Run(object):
+        def __init__(self, runner, subject, result_code, verify, runner_temp):
+            self.runner_temp = runner_temp
+        def run(self, extrainfo=None):
+            assert os.path.isdir(self.runner_temp.path)
+            seen.append(self.runner_temp.path)
+            index.invalidate("te")
+            assert index.kim_codes("TE") == [code]
+    monkeypatch.setattr(compute, "Computation", Run)
+
+    batch = compute.BatchComputation(runner, ["MO_1", "MO_2"], ["a", "b"])
+    assert batch.run() == [None, None]
+    assert len(seen) == 2 and seen[0] == seen[1]
+    assert os.path.basename(seen[0]) not in os.listdir(os.path.join(root, "te"))
+    assert not database.iskimcode(os.path.basename(seen[0]))
@@ -0,0 +1,118 @@
+import os, sys
+
+CODE_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+sys.path.insert(0, CODE_DIR)
+import jinja2
+import kimobjects
+import template
+
+SOURCE = "@[ for x in xs ]@@< x >@ @[ endfor ]@"
+
+def environment(cache, **syntax):
+    syntax = syntax or dict(block_start_string='@[', block_end_string=']@',
+        variable_start_string='@<', variable_end_string='>@')
+    return jinja2.Environment(loader=jinja2.DictLoader(
+        {"a/pipeline.stdin.tpl": SOURCE, "b/pipeline.stdin.tpl": SOURCE}),
+        bytecode_cache=cache, **syntax)
+
+def forbid_compiling(env):
+    def compile(*args, **kwargs):
+        raise AssertionError("compiled again")
+    env.compile = compile
+
+def test_same_content_compiles_once(tmpdir):
+    directory = str(tmpdir)
+    cache = template.ContentBytecodeCache(directory)
+    env = environment(cache)
+    assert env.get_template("a/pipeline.stdin.tpl").render(xs=[1, 2]) == "1 2 "
+    assert len(os.listdir(directory)) == 1
+
+    # the same template in another running directory, in this process
+    env = environment(cache)
+    forbid_compiling(env)
+    assert env.get_template("b/pipeline.stdin.tpl").render(xs=[3]) == "3 "
+
+    # and in another worker, from disk
+    env = environment(template.ContentBytecodeCache(directory))
+    forbid_compiling(env)
+    assert env.get_template("a/pipeline.stdin.tpl").render(xs=[4]) == "4 "
+
+def test_delimiters_are_part_of_the_key(tmpdir):
+    directory = str(tmpdir)
+    environment(template.ContentBytecodeCache(directory)).get_template("a/pipeline.stdin.tpl")
+    env = environment(template.ContentBytecodeCache(directory),
+            variable_start_string='@<', variable_end_string='>@')
+    assert env.get_template("a/pipeline.stdin.tpl").render(xs=[1]) == "@[ for x in xs ]@ @[ endfor ]@"
+    assert len(os.listdir(directory)) == 2
+
+def test_broken_cache_files_are_ignored(tmpdir):
+    directory = str(tmpdir)
+    environment(template.ContentBytecodeCache(directory)).get_template("a/pipeline.stdin.tpl")
+    for name in os.listdir(directory):
+        with open(os.path.join(directory, name), "wb") as f:
+            f.write("garbage")
+    env = environment(template.ContentBytecodeCache(directory))
+    assert env.get_template("a/pipeline.stdin.tpl").render(xs=[1]) == "1 "
+
+def test_query_cache(tmpdir, monkeypatch):
+    answers = {"a": '[{"x": 1}]', "pending": '[]'}
+    asked = []
+    def query(q, url=""):
+        asked.append(q["key"])
+        return answers[q["key"]]
+    monkeypatch.setattr(template, "query", query)
+
+    dbfile = str(tmpdir.join("queries.sqlite"))
+    cache = template.QueryCache(dbfile=dbfile, ttl=60, size=8)
+    assert cache.query({"key": "a"}, decode=True) == [{"x": 1}]
+    assert cache.query({"key": "a"}) == '[{"x": 1}]'
+    assert asked == ["a"]
+    assert [r["cached"] for r in cache.record] == [False, True]
+
+    # hits are only reads
+    changes = cache.db.total_changes
+    template.QueryCache(dbfile=dbfile, ttl=60).query({"key": "a"})
+    cache.query({"key": "a"})
+    assert cache.db.total_changes == changes and asked == ["a"]
+
+    # a result that isn't there yet is asked for again
+    assert cache.query({"key": "pending"}, decode=True) == []
+    answers["pending"] = '[{"x": 2}]'
+    assert cache.query({"key": "pending"}, decode=True) == [{"x": 2}]
+    assert asked == ["a", "pending", "pending"]
+
+    # and old responses are fetched again
+    monkeypatch.setattr(template.time, "time", lambda: 1e12)
+    cache.query({"key": "a"})
+    assert asked[-1] == "a"
+
+def test_query_cache_is_bounded(tmpdir, monkeypatch):
+    monkeypatch.setattr(template, "query", lambda q, url="": '[%i]' % q)
+    cache = template.QueryCache(dbfile=str(tmpdir.join("queries.sqlite")), size=2)
+    for q in range(3):
+        monkeypatch.setattr(template.time, "time", lambda: 1e9 + q)
+        cache.query(q)
+    keys = [ row[0] for row in cache.db.execute("SELECT key FROM queries ORDER BY fetched") ]
+    assert keys == ['[1,""]', '[2,""]']
+
+def test_results_are_never_cached(tmpdir, monkeypatch):
+    asked = []
+    monkeypatch.setattr(template, "query", lambda q, url="": asked.append(q) or '[1]')
+    cache = template.QueryCache(dbfile=str(tmpdir.join("queries.sqlite")))
+
+    results = [{"database": "data", "query": {"meta.runner.kimcode": "TE_000000000001"}},
+               {"database": "obj", "query": {"type": "tr"}},
+               {"database": "obj", "query": {"runner.kimcode": "TE_000000000001"}}]
+    items = {"database": "obj", "query": {"type": "mo"}}
+    for q in results + [items]:
+        cache.query(q)
+        cache.query(q)
+    assert asked == [ q for q in results for i in range(2) ] + [items]
+
+def test_query_cache_without_its_file(tmpdir, monkeypatch):
+    asked = []
+    monkeypatch.setattr(template, "query", lambda q, url="": asked.append(q) or '[1]')
+    cache = template.QueryCache(dbfile=str(tmpdir.join("missing", "queries.sqlite")))
+    assert cache.query({"key": "a"}, decode=True) == [1]
+    assert cache.query({"key": "a"}, decode=True) == [1]
+    assert len(asked) == 2 and len(cache.record) == 2
@@ -0,0 +1,114 @@
+import os, sys, gzip, json, threading, StringIO
+import BaseHTTPServer, SocketServer
+
+CODE_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+sys.path.insert(0, CODE_DIR)
+import config as cf
+import kimquery
+
+class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def do_POST(self):
+        server = self.server
+        body = self.rfile.read(int(self.headers["content-length"]))
+        server.requests.append((self.client_address, body, self.headers.get("accept-encoding")))
+        status = server.statuses.pop(0) if server.statuses else 200
+
+        answer = json.dumps({"echo": body})
+        self.send_response(status)
+        if "gzip" in (self.headers.get("accept-encoding") or ""):
+            out = StringIO.StringIO()
+            with gzip.GzipFile(fileobj=out, mode="wb") as f:
+                f.write(answer)
+            answer = out.getvalue()
+            self.send_header("Content-Encoding", "gzip")
+        self.send_header("Content-Length", str(len(answer)))
+        self.end_headers()
+        self.wfile.write(answer)
+        # as a server timing out an idle connection, without saying so
+        if server.hangup:
+            self.close_connection = 1
+
+    def log_message(self, *args):
+        pass
+
+class Server(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+def serve(statuses=()):
+    server = Server(("127.0.0.1", 0), Handler)
+    server.requests, server.statuses, server.hangup = [], list(statuses), False
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server, "http://127.0.0.1:%i/api" % server.server_address[1]
+
+def setup_function(function):
+    kimquery._dns_prepared = True
+
+def test_connections_are_kept_alive():
+    server, url = serve()
+    client = kimquery.QueryClient(gzip=False)
+    for i in range(3):
+        assert json.loads(client.post(url, "q=%i" % i)) == {"echo": "q=%i" % i}
+    assert len(set(address for address, body, enc in server.requests)) == 1
+    assert not any("gzip" in enc for address, body, enc in server.requests)
+    client.close()
+    server.shutdown()
+
+def test_gzipped_responses():
+    server, url = serve()
+    client = kimquery.QueryClient(gzip=True)
+    assert json.loads(client.post(url, "q")) == {"echo": "q"}
+    assert server.requests[0][2] == "gzip"
+    server.shutdown()
+
+def test_retries_server_errors(monkeypatch):
+    sleeps = []
+    monkeypatch.setattr(kimquery.time, "sleep", sleeps.append)
+    server, url = serve([503, 502])
+    client = kimquery.QueryClient(retries=2, backoff=0.5)
+    assert json.loads(client.post(url, "q")) == {"echo": "q"}
+    assert len(server.requests) == 3 and sleeps == [0.5, 1.0]
+
+    server.statuses = [500]*3
+    try:
+        client.post(url, "q")
+    except cf.PipelineQueryError:
+        pass
+    else:
+        assert False
+    server.shutdown()
+
+def test_client_errors_are_not_retried():
+    server, url = serve([404])
+    client = kimquery.QueryClient(retries=3)
+    try:
+        client.post(url, "q")
+    except cf.PipelineQueryError as e:
+        assert "404" in str(e)
+    else:
+        assert False
+    assert len(server.requests) == 1
+    server.shutdown()
+
+def test_query_mongo(monkeypatch):
+    server, url = serve()
+    monkeypatch.setattr(kimquery, "_client", kimquery.QueryClient())
+    answer = kimquery.query_mongo({"database": "data", "limit": 1}, url=url, decode=True)
+    assert sorted(answer["echo"].split("&")) == ["database=%22data%22", "limit=1"]
+    server.shutdown()
+
+def test_stale_connections_are_replaced_at_once(monkeypatch):
+    sleeps = []
+    monkeypatch.setattr(kimquery.time, "sleep", sleeps.append)
+    server, url = serve()
+    server.hangup = True
+    client = kimquery.QueryClient(retries=0, backoff=5)
+    for i in range(3):
+        assert json.loads(client.post(url, "q=%i" % i)) == {"echo": "q=%i" % i}
+    assert sleeps == [] and len(server.requests) == 3
+    assert len(set(address for address, body, enc in server.requests)) == 3
+    client.close()
+    server.shutdown()
@@ -0,0 +1,154 @@
+import os, sys, types
+
+CODE_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+sys.path.insert(0, CODE_DIR)
+import kimobjects
+import dependencies
+
+def fake_query(answer):
+    """ A kimquery.query answering with those of the asked pairs in answer """
+    asked = []
+    def query(q, decode=False):
+        asked.append(q)
+        if q["database"] == "obj":
+            pairs = [ (c["runner.kimcode"], c["subject.kimcode"]) for c in q["query"]["$or"] ]
+        else:
+            pairs = [ (c["test"], c["model"]) for c in q["query"]["$or"] ]
+        return [ list(p) for p in pairs if p in answer ]
+    return query, asked
+
+def test_results_are_asked_for_in_batches(monkeypatch):
+    pairs = [ ("TE_%012i" % i, "MO_000000000000") for i in range(600) ]
+    query, asked = fake_query(set(pairs[::100]))
+    monkeypatch.setattr(dependencies.kimquery, "query", query)
+
+    assert dependencies.results_exist(pairs + pairs[:10]) == set(pairs[::100])
+    assert len(asked) == 3
+    assert sorted(len(q["query"]["$or"]) for q in asked) == [88, 256, 256]
+    assert all(q["database"] == "obj" for q in asked)
+
+    del asked[:]
+    assert dependencies.results_inqueue(pairs[:3]) == set([pairs[0]])
+    assert asked[0]["database"] == "job" and asked[0]["project"] == ["test", "model"]
+
+    assert dependencies.result_exists(*pairs[100])
+    assert not dependencies.result_inqueue(*pairs[1])
+
+class Item(object):
+    def __init__(self, kim_code):
+        self.kim_code = kim_code
+    def __str__(self):
+        return self.kim_code
+    __repr__ = __str__
+    def __eq__(self, other):
+        return str(self) == str(other)
+    def __hash__(self):
+        return hash(self.kim_code)
+
+def fake_kimobjects(root):
+    """ A kimobjects with the tests in root, where versionless codes are
+        resolved to their newest version """
+    class Test(Item):
+        @property
+        def depfile_path(self):
+            return os.path.join(root, self.kim_code, "dependencies.edn")
+        @classmethod
+        def all(cls):
+            return [ cls(code) for code in sorted(os.listdir(root)) ]
+        def runtime_dependencies(self, subject=None):
+            raise AssertionError("dependencies read from the file")
+
+    def kim_obj(kim_code, search=True):
+        if "TE_" not in kim_code:
+            return Item(kim_code)
+        versions = sorted( code for code in os.listdir(root) if kim_code in code )
+        if not versions:
+            raise KeyError(kim_code)
+        return Test(versions[-1])
+
+    module = types.ModuleType("kimobjects")
+    module.Test, module.kim_obj = Test, kim_obj
+    return module
+
+def add_test(root, code, deps=()):
+    os.mkdir(os.path.join(root, code))
+    with open(os.path.join(root, code, "dependencies.edn"), "w") as f:
+        f.write("[%s]" % " ".join(
+            '"%s"' % d if isinstance(d, str) else '["%s" "%s"]' % d for d in deps))
+
+A0, A1 = "A__TE_000000000001_000", "A__TE_000000000001_001"
+B0 = "B__TE_000000000002_000"
+C0 = "C__TE_000000000003_000"
+D0 = "D__TE_000000000004_000"
+MO = "M__MO_000000000009_000"
+
+def make_graph(tmpdir, monkeypatch):
+    root = str(tmpdir.mkdir("te"))
+    add_test(root, A0)
+    add_test(root, B0, ["TE_000000000001"])
+    add_test(root, C0, [(B0, MO)])
+    add_test(root, D0, ["C__TE_000000000003"])
+    monkeypatch.setattr(dependencies, "kimobjects", fake_kimobjects(root))
+    graph = dependencies.DependencyGraph(dbfile=str(tmpdir.join("graph.sqlite")))
+    monkeypatch.setattr(dependencies, "_graph", graph)
+    return root, graph
+
+def test_graph_both_ways(tmpdir, monkeypatch):
+    root, graph = make_graph(tmpdir, monkeypatch)
+    assert graph.dependencies(B0) == [(A0, None)]
+    assert graph.dependencies(C0) == [(B0, MO)]
+    assert graph.dependents(A0, "X__MO_000000000001_000") == [B0]
+    assert graph.dependents(B0, MO) == [C0]
+    assert graph.dependents(B0, "X__MO_000000000001_000") == []
+
+def test_new_versions_reresolve_only_their_dependents(tmpdir, monkeypatch):
+    root, graph = make_graph(tmpdir, monkeypatch)
+    graph.refresh()
+
+    read = []
+    edges = graph._edges
+    monkeypatch.setattr(graph, "_edges", lambda test: read.append(str(test)) or edges(test))
+    add_test(root, A1)
+    graph.update(dependencies.kimobjects.kim_obj(A1))
+    assert sorted(read) == [A1, B0]
+    assert graph.dependencies(B0) == [(A1, None)]
+    assert graph.dependents(A0, MO) == []
+
+    # a new process reads only what changed since
+    del read[:]
+    os.utime(os.path.join(root, C0, "dependencies.edn"), (1e9, 1e9))
+    other = dependencies.DependencyGraph(dbfile=graph.dbfile)
+    monkeypatch.setattr(other, "_edges", lambda test: read.append(str(test)) or edges(test))
+    assert other.dependents(A1, MO) == [B0]
+    assert read == [C0]
+
+def test_graph_in_memory_without_its_file(tmpdir, monkeypatch):
+    root, graph = make_graph(tmpdir, monkeypatch)
+    graph._dbfile = str(tmpdir.join("missing", "graph.sqlite"))
+    assert graph.dependents(A0, MO) == [B0]
+
+def test_resolve_walks_the_graph(tmpdir, monkeypatch):
+    root, graph = make_graph(tmpdir, monkeypatch)
+    monkeypatch.setattr(dependencies, "results_exist", lambda pairs: set([(A0, "X")]))
+    monkeypatch.setattr(dependencies, "results_inqueue", lambda pairs: set())
+    kim_obj = dependencies.kimobjects.kim_obj
+
+    # C needs B with M, which needs A with M
+    assert dependencies.resolve([(kim_obj(C0), Item("X"))]) == [(kim_obj(A0), Item(MO))]
+    # while B with X can run now
+    assert dependencies.resolve([(kim_obj(B0), Item("X"))]) == [(kim_obj(B0), Item("X"))]
+
+def test_wave_plan_layers_the_chain(tmpdir, monkeypatch):
+    root, graph = make_graph(tmpdir, monkeypatch)
+    queued = set()
+    monkeypatch.setattr(dependencies, "results_exist", lambda pairs: set())
+    monkeypatch.setattr(dependencies, "results_inqueue", lambda pairs: queued & set(pairs))
+    kim_obj = dependencies.kimobjects.kim_obj
+
+    waves = dependencies.wave_plan([(kim_obj(C0), Item("X"))])
+    assert waves == [[(kim_obj(A0), Item(MO))], [(kim_obj(B0), Item(MO))],
+                     [(kim_obj(C0), Item("X"))]]
+
+    # what waits on a queued job is left for its result to bring in
+    queued.add((A0, MO))
+    assert dependencies.wave_plan([(kim_obj(C0), Item("X"))]) == []
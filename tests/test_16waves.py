@@ -0,0 +1,158 @@
+import os, sys, uuid
+
+CODE_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+sys.path.insert(0, CODE_DIR)
+import config as cf
+import network
+import pipeline
+
+class Item(object):
+    dependencies = []
+    def __init__(self, kim_code):
+        self.kim_code = kim_code
+    def __str__(self):
+        return self.kim_code
+    __repr__ = __str__
+
+A, B, C, D = [ (Item("%s__TE_00000000000%i_000" % (n, i)), Item("M__MO_000000000009_000"))
+               for i, n in enumerate("ABCD") ]
+
+class Director(pipeline.Director):
+    """ A Director without its connections, keeping what it sends """
+    def __init__(self, monkeypatch, plans):
+        self.plans, self.scheduled, self.next_poll = [], {}, 0
+        self.logger = pipeline.logger
+        self.boxinfo = {"uuid": str(uuid.uuid4())}
+        self.sent, self.polled, self.results = [], [], set()
+
+        monkeypatch.setattr(pipeline.dependencies, "get_wave_plan", lambda targets: plans[targets[0]])
+        def results_exist(pairs):
+            self.polled.append([ pipeline.pairkey(p) for p in pairs ])
+            return set(pipeline.pairkey(p) for p in pairs) & self.results
+        monkeypatch.setattr(pipeline.dependencies, "results_exist", results_exist)
+
+    def job_message(self, msg, tube=cf.TUBE_RESULTS):
+        assert tube == cf.TUBE_JOBS and msg.wave
+        self.sent.append(msg)
+
+    def jobid(self, pair):
+        return [ m.jobid for m in self.sent if tuple(m.job) == pipeline.pairkey(pair) ][-1]
+
+    def finish(self, pair, tube=cf.TUBE_RESULTS):
+        """ The job of a pair reports back, with its result in place """
+        if tube == cf.TUBE_RESULTS:
+            self.results.add(pipeline.pairkey(pair))
+        msg = network.Message(string=str(network.Message(jobid=self.jobid(pair))))
+        self.advance_waves(self.wave_job_done(tube, msg))
+
+    def submitted(self):
+        return [ tuple(m.job) for m in self.sent ]
+
+def test_waves_are_sent_as_the_ones_before_finish(monkeypatch):
+    director = Director(monkeypatch, {"t": [[A], [B, C]]})
+    director.check_dependencies_and_push(["t"], 1, "approved")
+    assert director.submitted() == [pipeline.pairkey(A)]
+
+    # no polling while a wave runs, whatever else comes in
+    director.advance_waves()
+    assert director.polled == []
+
+    director.finish(A)
+    assert director.polled == [[pipeline.pairkey(A)]]
+    assert director.submitted()[1:] == [pipeline.pairkey(B), pipeline.pairkey(C)]
+
+    director.finish(B)
+    director.finish(C)
+    assert director.plans == [] and director.scheduled == {}
+    # the last wave has nothing after it to wait for
+    assert len(director.polled) == 1
+
+def test_results_that_are_late_are_polled_for(monkeypatch):
+    director = Director(monkeypatch, {"t": [[A], [B]]})
+    director.check_dependencies_and_push(["t"], 1, "approved")
+    director.wave_job_done(cf.TUBE_RESULTS, network.Message(jobid=director.jobid(A)))
+    director.advance_waves()
+    assert len(director.polled) == 1 and len(director.sent) == 1
+
+    # not again until the interval is up
+    director.results.add(pipeline.pairkey(A))
+    director.advance_waves()
+    assert len(director.polled) == 1
+    director.next_poll = 0
+    director.advance_waves()
+    assert len(director.sent) == 2
+
+def test_single_wave_plans_are_tracked(monkeypatch):
+    director = Director(monkeypatch, {"a": [[A]], "ab": [[A], [B]]})
+    director.check_dependencies_and_push(["a"], 1, "approved")
+    assert pipeline.pairkey(A) in director.scheduled
+
+    # another plan needing the pair waits for it instead of running it again
+    director.check_dependencies_and_push(["ab"], 1, "approved")
+    assert director.submitted() == [pipeline.pairkey(A)]
+
+    director.finish(A)
+    assert director.submitted() == [pipeline.pairkey(A), pipeline.pairkey(B)]
+    assert director.polled == [[pipeline.pairkey(A)]]
+
+def test_pairs_of_other_plans_are_waited_for(monkeypatch):
+    director = Director(monkeypatch, {"abc": [[A], [B], [C]], "bd": [[B], [D]]})
+    director.check_dependencies_and_push(["abc"], 1, "approved")
+    director.check_dependencies_and_push(["bd"], 1, "approved")
+    assert director.submitted() == [pipeline.pairkey(A)]
+
+    director.finish(A)
+    assert director.submitted()[-1] == pipeline.pairkey(B)
+    assert pipeline.pairkey(D) not in director.submitted()
+
+    director.finish(B)
+    assert sorted(director.submitted()[2:]) == sorted([pipeline.pairkey(C), pipeline.pairkey(D)])
+
+def test_failures_drop_the_plans_waiting_on_them(monkeypatch):
+    director = Director(monkeypatch, {"abc": [[A], [B], [C]], "bd": [[B], [D]]})
+    director.check_dependencies_and_push(["abc"], 1, "approved")
+    director.check_dependencies_and_push(["bd"], 1, "approved")
+    director.finish(A)
+    director.finish(B, tube=cf.TUBE_ERRORS)
+    assert director.plans == [] and director.scheduled == {}
+    assert pipeline.pairkey(D) not in director.submitted()
+
+def test_lost_jobs_let_their_pairs_run_again(monkeypatch):
+    director = Director(monkeypatch, {"ab": [[A], [B]], "bc": [[B], [C]]})
+    director.check_dependencies_and_push(["ab"], 1, "approved")
+    director.check_dependencies_and_push(["bc"], 1, "approved")
+    assert director.submitted() == [pipeline.pairkey(A)]
+
+    # the job of A never reports back
+    now = pipeline.time.time() + cf.PIPELINE_JOB_TIMEOUT + 1
+    monkeypatch.setattr(pipeline.time, "time", lambda: now)
+    director.advance_waves()
+    assert director.plans == [] and director.scheduled == {}
+
+    # so a later update needing B runs it instead of waiting on the lost plan
+    director.check_dependencies_and_push(["bc"], 1, "approved")
+    assert director.submitted()[-1] == pipeline.pairkey(B)
+
+def test_the_pairs_of_an_update_are_planned_together(monkeypatch):
+    tests = [ Item("%s__TE_00000000000%i_000" % (n, i)) for i, n in enumerate("ABCD") ]
+    model = type("Model", (Item,), {"tests": tests})
+    monkeypatch.setattr(pipeline.kimobjects, "Model", model)
+    monkeypatch.setattr(pipeline.kimapi, "valid_match_pairs", lambda pairs: [True]*len(pairs))
+    monkeypatch.setattr(pipeline.dependencies, "dependency_graph",
+            lambda: type("Graph", (), {"dependencies": lambda self, test: []})())
+
+    results_exist, get_wave_plan = (pipeline.dependencies.results_exist,
+                                    pipeline.dependencies.get_wave_plan)
+    director = Director(monkeypatch, {})
+    director.make_all = lambda: 0
+    monkeypatch.setattr(pipeline.dependencies, "results_exist", results_exist)
+    monkeypatch.setattr(pipeline.dependencies, "get_wave_plan", get_wave_plan)
+    asked = []
+    monkeypatch.setattr(pipeline.dependencies.kimquery, "query",
+            lambda q, decode=False: asked.append(q) or [])
+
+    director.push_jobs({"kimid": "M__MO_000000000009_000", "status": "approved",
+                        "priority": "normal"})
+    assert len(asked) == 1 and len(asked[0]["query"]["$or"]) == 4
+    assert len(director.plans) == 1
+    assert sorted(director.submitted()) == sorted((str(te), "M__MO_000000000009_000") for te in tests)